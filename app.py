@@ -3,27 +3,38 @@
 # — Запрашивает телефон, формирует чек (54-ФЗ)
 # — Медиа из .env (WELCOME_VIDEO, FORMAL_PHOTO)
 # — НЕТ служебных отчётов пользователю
-# — CSV-логи: starts.csv, payments.csv, cancellations.csv
+# — Логи стартов/оплат в SQLite, выгрузка в CSV по /export_csv; cancellations.csv
 
 import asyncio
+import atexit
 import csv
 import logging
 import os
 import re
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from functools import partial
-from typing import Optional, Iterable
+from functools import lru_cache, partial
+from typing import AsyncIterator, Optional, Iterable
 
 import aiosqlite
-from aiogram import Bot, Dispatcher, F
+import certifi
+from aiogram import Bot, Dispatcher, F, __version__ as AIOGRAM_VERSION
 from aiogram.client.default import DefaultBotProperties
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiohttp import ClientSession
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+from aiohttp_socks import ProxyConnector
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (
     Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
-    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, BotCommand, WebAppInfo
+    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, BotCommand, WebAppInfo,
+    FSInputFile
 )
 from dotenv import load_dotenv
 from yookassa import Configuration, Payment
@@ -70,10 +81,11 @@ GROUP_ID = _env_int("GROUP_ID", 0)
 
 # админские ID для служебных команд (через запятую в .env)
 _ADMIN_IDS_RAW = _env("ADMIN_IDS") or ""
-ADMIN_IDS = {int(x) for x in re.split(r"[,\s]+", _ADMIN_IDS_RAW) if x.isdigit()}
+_ADMIN_SPLIT = re.compile(r"[,\s]+")
+ADMIN_IDS: frozenset[int] = frozenset(int(x) for x in _ADMIN_SPLIT.split(_ADMIN_IDS_RAW) if x.isdigit())
 
 def _is_admin_id(uid: int) -> bool:
-    return bool(ADMIN_IDS) and uid in ADMIN_IDS
+    return uid in ADMIN_IDS
 
 MONTH_PRICE = _env_int("MONTH_PRICE", 0)
 BASE_PRICE_TEXT = _env("BASE_PRICE_TEXT")
@@ -99,34 +111,200 @@ CHECK_INTERVAL_SEC = _env_int("CHECK_INTERVAL_SEC", 1800)
 # YooKassa
 Configuration.account_id = SHOP_ID
 Configuration.secret_key = SHOP_SECRET_KEY
+# SDK синхронный: держим для него свой пул, чтобы медленные ответы ЮKassa
+# не занимали дефолтный executor (CSV, экспорт и прочие to_thread)
+PAYMENT_POOL = ThreadPoolExecutor(max_workers=_env_int("PAYMENT_POOL_SIZE", 16), thread_name_prefix="yookassa")
+
+YOOKASSA_TIMEOUT = _env_int("YOOKASSA_TIMEOUT", 5)  # сек на Payment.create в интерактивном pay_start
+# автосписание не торопим: обрыв ожидания не отменяет сам вызов SDK, деньги могут списаться
+AUTO_RENEWAL_TIMEOUT = _env_int("AUTO_RENEWAL_TIMEOUT", 120)
+
+def _yookassa(call):
+    """Выполнить синхронный вызов SDK ЮKassa в PAYMENT_POOL."""
+    return asyncio.get_running_loop().run_in_executor(PAYMENT_POOL, call)
 
 # CSV файлы
-STARTS_CSV = _env("STARTS_CSV") or "starts.csv"
-PAYMENTS_CSV = _env("PAYMENTS_CSV") or "payments.csv"
 CANCELS_CSV = _env("CANCELS_CSV") or "cancellations.csv"
+EXPORT_DIR = _env("EXPORT_DIR") or "exports"  # куда /export_csv кладёт выгрузки
 
-def _csv_append(path: str, row: list[str]):
+_CSV_HEADER = ["ts_iso", "user_id", "username", "full_name", "extra"]
+_CSV_BATCH_MAX = 500
+_CSV_FLUSH_SEC = 1.0
+
+# Строки копятся в очереди и пишутся фоновой задачей пачками в отдельном потоке,
+# чтобы дисковые syscalls не стопорили event loop.
+_csv_queue: asyncio.Queue = asyncio.Queue()
+_csv_ready: set[str] = set()  # файлы, для которых заголовок уже проверен
+_csv_task: Optional[asyncio.Task] = None
+
+def _csv_write_rows(path: str, rows: list[list[str]]):
     try:
-        exists = os.path.exists(path)
-        with open(path, "a", newline="", encoding="utf-8") as f:
+        with open(path, "a", newline="", encoding="utf-8", buffering=65536) as f:
             w = csv.writer(f)
-            if not exists:
-                w.writerow(["ts_iso", "user_id", "username", "full_name", "extra"])
-            w.writerow(row)
+            if path not in _csv_ready:
+                # в режиме "a" позиция стоит в конце файла: 0 — файл новый/пустой
+                if f.tell() == 0:
+                    w.writerow(_CSV_HEADER)
+                _csv_ready.add(path)
+            w.writerows(rows)
     except Exception as e:
         log.error("CSV append failed (%s): %s", path, e)
 
+def _csv_append(path: str, row: list[str]):
+    """Не блокирует loop: строка уходит в очередь фонового писателя."""
+    if _csv_task is None:
+        # писатель не запущен (скрипты, импорт вне бота) — пишем сразу
+        _csv_write_rows(path, [row])
+        return
+    _csv_queue.put_nowait((path, row))
+
+async def _csv_writer():
+    while True:
+        batch = [await _csv_queue.get()]
+        if batch[0] is not None:
+            await asyncio.sleep(_CSV_FLUSH_SEC)
+        while not _csv_queue.empty() and (None in batch or len(batch) < _CSV_BATCH_MAX):
+            batch.append(_csv_queue.get_nowait())
+        by_path: dict[str, list[list[str]]] = {}
+        for item in batch:
+            if item is not None:
+                by_path.setdefault(item[0], []).append(item[1])
+        for path, rows in by_path.items():
+            await asyncio.to_thread(_csv_write_rows, path, rows)
+        if None in batch:
+            return
+
+def start_csv_writer():
+    global _csv_task
+    if _csv_task is None:
+        _csv_task = asyncio.create_task(_csv_writer())
+
+async def stop_csv_writer():
+    """Дописывает хвост очереди и останавливает писателя."""
+    global _csv_task
+    if _csv_task is None:
+        return
+    _csv_queue.put_nowait(None)
+    try:
+        await _csv_task
+    finally:
+        _csv_task = None
+
+@atexit.register
+def _csv_drain():
+    """Если бот упал мимо on_shutdown — дописываем то, что осталось в очереди."""
+    by_path: dict[str, list[list[str]]] = {}
+    while not _csv_queue.empty():
+        item = _csv_queue.get_nowait()
+        if item is not None:
+            by_path.setdefault(item[0], []).append(item[1])
+    for path, rows in by_path.items():
+        _csv_write_rows(path, rows)
+
 def log_cancellation(user_id: int, reason: str):
     """Логирует отмену подписки в CSV файл"""
     _csv_append(CANCELS_CSV, [
         now_iso(), str(user_id), "", "", reason
     ])
 
-session = AiohttpSession(proxy="socks5://127.0.0.1:1080")
+TG_PROXY = "socks5://127.0.0.1:1080"
+
+
+class KeepAliveSession(AiohttpSession):
+    """
+    Одна сессия aiohttp на весь бот (лимит 100 соединений с запасом покрывает TG_SEM);
+    keep-alive дольше дефолтных 15 с, чтобы пачки киков/рассылок не открывали соединения заново.
+    Коннектор собираем сами через публичные create_session/close (проверено на aiogram 3.31):
+    у AiohttpSession нет публичного способа передать аргументы коннектора.
+    """
+
+    def __init__(self, proxy: str, keepalive_timeout: float = 60, limit: int = 100):
+        super().__init__()
+        self._proxy_url = proxy
+        self._keepalive_timeout = keepalive_timeout
+        self._limit = limit
+        self._client: Optional[ClientSession] = None
+
+    async def create_session(self) -> ClientSession:
+        if self._client is None or self._client.closed:
+            # ssl, ttl_dns_cache и User-Agent — как у AiohttpSession.create_session;
+            # отличаются только limit и keepalive_timeout
+            self._client = ClientSession(
+                connector=ProxyConnector.from_url(
+                    self._proxy_url,
+                    ssl=ssl.create_default_context(cafile=certifi.where()),
+                    limit=self._limit,
+                    ttl_dns_cache=3600,
+                    keepalive_timeout=self._keepalive_timeout,
+                ),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{AIOGRAM_VERSION}"},
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+            await asyncio.sleep(0.25)  # дать SSL-соединениям закрыться, как в AiohttpSession.close
+        await super().close()
+
+
+session = KeepAliveSession(TG_PROXY, keepalive_timeout=60)
 bot = Bot(BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 bot_username_cache: Optional[str] = None
 
+async def get_bot_username() -> str:
+    """@username бота: getMe один раз за процесс, дальше из памяти."""
+    global bot_username_cache
+    if not bot_username_cache:
+        me = await bot.me()
+        bot_username_cache = me.username
+    return bot_username_cache
+
+# ---- Ограничение нагрузки на Bot API (рассылки, чистки) ----
+TG_SEM = asyncio.Semaphore(25)  # одновременных запросов к Telegram
+TG_RATE = 25  # вызовов в секунду на весь бот — с запасом до лимита Telegram ~30/с
+TG_CHAT_INTERVAL = 1.0  # не чаще 1 сообщения в секунду в один чат
+TG_RETRIES = 3
+_tg_last_send: dict[int, float] = {}
+_tg_next_slot = 0.0
+_tg_pause_until = 0.0  # после RetryAfter притормаживаем все вызовы, а не только упавший
+
+async def _tg_slot():
+    """Общий темп: слоты раз в 1/TG_RATE секунды, с учётом глобальной паузы."""
+    global _tg_next_slot
+    now = time.monotonic()
+    slot = max(now, _tg_next_slot, _tg_pause_until)
+    _tg_next_slot = slot + 1.0 / TG_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+async def _send(uid: int, coro_factory, throttle: bool = True):
+    """
+    Вызов Bot API под общим семафором.
+    coro_factory(uid) создаёт корутину заново на каждую попытку;
+    на RetryAfter ставим общую паузу для всех вызовов на retry_after и повторяем.
+    throttle=False — без поштучного лимита на чат (ban/unban и т.п.).
+    """
+    global _tg_pause_until
+    async with TG_SEM:
+        for attempt in range(TG_RETRIES):
+            await _tg_slot()
+            if throttle:
+                wait = _tg_last_send.get(uid, 0.0) + TG_CHAT_INTERVAL - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if len(_tg_last_send) > 10000:
+                    _tg_last_send.clear()
+                _tg_last_send[uid] = time.monotonic()
+            try:
+                return await coro_factory(uid)
+            except TelegramRetryAfter as e:
+                if attempt == TG_RETRIES - 1:
+                    raise
+                log.warning("Telegram RetryAfter %ss (uid=%s)", e.retry_after, uid)
+                _tg_pause_until = max(_tg_pause_until, time.monotonic() + e.retry_after)
+
 async def notify_admins(text: str):
     if not ADMIN_IDS:
         log.error("ADMIN_IDS is empty; cannot send admin alert: %s", text)
@@ -144,6 +322,7 @@ CANCEL_REASONS: list[tuple[str, str]] = [
     ("Нашёл другой формат", "other_service"),
     ("Другая причина", "other"),
 ]
+CANCEL_REASONS_DICT: dict[str, str] = {key: title for title, key in CANCEL_REASONS}
 
 RENEWAL_ACTION_PREFIX = {
     "disable": "renewal_off",
@@ -161,10 +340,20 @@ RENEWAL_ACTION_LABEL = {
 MSK = timezone(timedelta(hours=3))
 
 def now_ts() -> int:
-    return int(datetime.now(MSK).timestamp())
+    # unix-время не зависит от пояса: time.time() без лишних datetime-объектов
+    return int(time.time())
+
+_MSK_OFFSET_SEC = 3 * 3600
+
+def iso_msk(ts: float) -> str:
+    # то же, что datetime.fromtimestamp(ts, MSK).strftime("%Y-%m-%d %H:%M:%S%z"), но без strftime:
+    # смещение МСК фиксированное, так что хватает gmtime
+    tm = time.gmtime(ts + _MSK_OFFSET_SEC)
+    return (f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d} "
+            f"{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}+0300")
 
 def now_iso() -> str:
-    return datetime.now(MSK).strftime("%Y-%m-%d %H:%M:%S%z")
+    return iso_msk(time.time())
 
 def webapp_url(path: str = "") -> str:
     base_url = WEBAPP_URL.rstrip("/")
@@ -199,19 +388,20 @@ def add_hours_ts(hours: int) -> int:
 def is_active(expires_at: Optional[int]) -> bool:
     return bool(expires_at and expires_at > now_ts())
 
+_NON_DIGIT = re.compile(r"\D+")
+
+# одни и те же номера приходят повторно (/phone с опечатками, повторный контакт)
+@lru_cache(maxsize=4096)
 def normalize_phone(raw: str) -> Optional[str]:
     if not raw:
         return None
-    digits = re.sub(r"\D+", "", raw)
-    if not digits:
+    digits = _NON_DIGIT.sub("", raw)
+    # после очистки остались только цифры — длину проверяем один раз, до "+"
+    if len(digits) < 11:
         return None
     if len(digits) == 11 and digits.startswith("8"):
         digits = "7" + digits[1:]
-    if not digits.startswith("+"):
-        digits = "+" + digits
-    if len(re.sub(r"\D+", "", digits)) < 11:
-        return None
-    return digits
+    return "+" + digits
 
 def kb(rows: Iterable[Iterable[InlineKeyboardButton]]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[list(r) for r in rows])
@@ -227,12 +417,38 @@ def ask_phone_kb() -> ReplyKeyboardMarkup:
         input_field_placeholder="Нажми, чтобы отправить номер"
     )
 
+# Статичные клавиатуры собираем один раз: pydantic-валидация разметки не бесплатна
+ASK_PHONE_KB = ask_phone_kb()
+
 def price_text_block() -> str:
     parts = []
     parts.append(f"💳 Ежемесячная подписка — <s>3 690 ₽</s> <b>{MONTH_PRICE} ₽</b> в честь 8 Марта 🌷")
     return "\n".join(parts) if parts else ""
 
+PRICE_TEXT_BLOCK = price_text_block()  # зависит только от конфигурации — считаем один раз
+
+def _markup_key(markup: Optional[InlineKeyboardMarkup]):
+    # pydantic-сравнение учитывает привязанный bot, поэтому сравниваем только суть кнопок
+    if markup is None:
+        return None
+    return tuple(
+        tuple((b.text, b.callback_data, b.url, getattr(b.web_app, "url", None)) for b in row)
+        for row in markup.inline_keyboard
+    )
+
+def _shows_same(message, text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> bool:
+    """Сообщение под кнопкой уже показывает ровно это (повторное нажатие)."""
+    try:
+        if not (message.text or message.caption):
+            return False
+        return message.html_text == text and _markup_key(message.reply_markup) == _markup_key(reply_markup)
+    except Exception:
+        # InaccessibleMessage и прочее — просто перерисовываем
+        return False
+
 async def replace_with_text(cb: CallbackQuery, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    if _shows_same(cb.message, text, reply_markup):
+        return
     try:
         await cb.message.delete()
     except Exception:
@@ -306,12 +522,26 @@ CREATE TABLE IF NOT EXISTS admin_events (
     created_at  INTEGER
 );
 """
+DDL_STARTS = """
+CREATE TABLE IF NOT EXISTS starts (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id     INTEGER NOT NULL,
+    username    TEXT,
+    full_name   TEXT,
+    extra       TEXT,
+    created_at  INTEGER
+);
+"""
 DDL_INDEXES = [
     "CREATE INDEX IF NOT EXISTS idx_users_expires ON users(expires_at)",
     "CREATE INDEX IF NOT EXISTS idx_payments_pid ON payments(payment_id)",
     "CREATE INDEX IF NOT EXISTS idx_payments_uid ON payments(user_id)",
     "CREATE INDEX IF NOT EXISTS idx_cancellations_uid ON cancellations(user_id)",
-    "CREATE INDEX IF NOT EXISTS idx_admin_events_open ON admin_events(resolved, created_at)"
+    "CREATE INDEX IF NOT EXISTS idx_admin_events_open ON admin_events(resolved, created_at)",
+    # get_users_for_auto_renewal: ограниченный range scan вместо фильтрации всех по expires_at
+    """CREATE INDEX IF NOT EXISTS idx_users_autorenew ON users(auto_renewal, expires_at)
+       WHERE payment_method_id IS NOT NULL AND auto_renewal_failures < 2""",
+    "CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))",
 ]
 
 @dataclass
@@ -319,17 +549,256 @@ class UserRow:
     user_id: int
     expires_at: int
 
+# Тексты запросов с подставленными именами колонок — готовыми константами,
+# без f-строк в горячем пути (кэш подготовленных выражений SQLite ключуется по тексту)
+_SQL_UPDATE_REMIND = {
+    3: "UPDATE users SET remind_3_sent=1 WHERE user_id=?",
+    2: "UPDATE users SET remind_2_sent=1 WHERE user_id=?",
+    1: "UPDATE users SET remind_1_sent=1 WHERE user_id=?",
+}
+# Один проход планировщика по idx_users_expires: истёкшие, но не обработанные
+# (expires_at=0 — доступ уже закрыт), и активные, у кого осталось ≤ 3 дней
+# и не отправлено хотя бы одно напоминание. Раскладываем строки уже в Python.
+_SQL_SUBSCRIPTION_SCAN = """
+    SELECT user_id, expires_at,
+           COALESCE(remind_3_sent,0), COALESCE(remind_2_sent,0), COALESCE(remind_1_sent,0),
+           COALESCE(auto_renewal,0) != 0 AND COALESCE(payment_method_id,'') != '',
+           COALESCE(last_known_status,'') = 'administrator'
+    FROM users
+    WHERE expires_at > 0 AND expires_at <= ? + 3*86400
+      AND (expires_at <= ?
+           OR COALESCE(remind_3_sent,0)=0 OR COALESCE(remind_2_sent,0)=0 OR COALESCE(remind_1_sent,0)=0)
+"""
+REMIND_DAYS = (3, 2, 1)
+
+# Выгрузки /export_csv — в формате прежних CSV-логов
+_SQL_EXPORT = {
+    "starts": """
+        SELECT created_at, user_id, COALESCE(username,''), COALESCE(full_name,''), COALESCE(extra,'')
+        FROM starts ORDER BY id
+    """,
+    "payments": """
+        SELECT p.created_at, p.user_id, COALESCE(u.username,''), COALESCE(u.full_name,''),
+               'amount=' || p.amount || '; payment_id=' || p.payment_id || '; phone=' || COALESCE(u.phone,'-')
+        FROM payments p LEFT JOIN users u ON u.user_id = p.user_id
+        WHERE p.status='succeeded'
+        ORDER BY p.created_at
+    """,
+    "cancellations": """
+        SELECT created_at, user_id, '', '', COALESCE(reason,'')
+        FROM cancellations ORDER BY created_at
+    """,
+}
+
+# Пакетная запись: мутации копятся в очереди и коммитятся одной транзакцией
+WRITE_BATCH_MAX = 256
+WRITE_BATCH_WINDOW = 0.05  # сек — сколько ждём попутчиков для пачки
+WRITE_MANY_CHUNK = 500  # строк на один executemany
+SQL_IN_CHUNK = 900  # id в одном IN (...) — ниже дефолтного SQLITE_MAX_VARIABLE_NUMBER (999)
+
+# Короткий кэш get_user/get_user_phone: один callback дёргает их по нескольку раз
+_CACHE_TTL = 5.0  # сек
+_CACHE_MAX = 4096
+
+READ_POOL_SIZE = _env_int("DB_READ_POOL", 4)  # соединений только для чтения
+
 class DB:
     def __init__(self, path: str):
         self.path = path
         self.conn: Optional[aiosqlite.Connection] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._user_cache: dict[int, tuple[float, Optional[UserRow]]] = {}
+        self._phone_cache: dict[int, tuple[float, Optional[str]]] = {}
+        self._readers: list[aiosqlite.Connection] = []
+        self._rr = 0
 
     async def connect(self):
         self.conn = await aiosqlite.connect(self.path)
         await self.conn.execute("PRAGMA journal_mode=WAL;")
+        # NORMAL безопасен с WAL; OFF не используем — платежи должны переживать падение
         await self.conn.execute("PRAGMA synchronous=NORMAL;")
         await self.conn.execute("PRAGMA foreign_keys=ON;")
+        await self.conn.execute("PRAGMA temp_store=MEMORY;")
+        await self.conn.execute("PRAGMA cache_size=-20000;")  # ~20 МБ
+        await self.conn.execute("PRAGMA mmap_size=268435456;")  # 256 МБ
+        await self.conn.execute("PRAGMA wal_autocheckpoint=1000;")
+        await self.conn.execute("PRAGMA busy_timeout=5000;")
         await self.conn.commit()
+        # Отдельные соединения под чтение: в WAL читатели не ждут писателя,
+        # а у каждого aiosqlite-соединения свой поток — SELECT'ы идут параллельно
+        if self.path != ":memory:":
+            for _ in range(READ_POOL_SIZE):
+                rc = await aiosqlite.connect(self.path)
+                await rc.execute("PRAGMA query_only=ON;")
+                await rc.execute("PRAGMA temp_store=MEMORY;")
+                await rc.execute("PRAGMA cache_size=-20000;")
+                await rc.execute("PRAGMA mmap_size=268435456;")
+                await rc.execute("PRAGMA busy_timeout=5000;")
+                self._readers.append(rc)
+        self._queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._flusher())
+
+    async def close(self):
+        if self._writer_task is not None:
+            await self.flush()
+            self._writer_task.cancel()
+            self._writer_task = None
+        for rc in self._readers:
+            await rc.close()
+        self._readers.clear()
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+    @property
+    def rconn(self) -> aiosqlite.Connection:
+        """Соединение для чтения (по кругу из пула); без пула — основное."""
+        if not self._readers:
+            return self.conn
+        self._rr = (self._rr + 1) % len(self._readers)
+        return self._readers[self._rr]
+
+    # --- Очередь записи ---
+    async def _write(self, sql: Optional[str], params: tuple = (), many: bool = False):
+        """
+        Ставит запрос в очередь писателя и ждёт коммита пачки.
+        Возвращает rowcount, а для запросов с RETURNING — список строк.
+        sql=None — пустой барьер (см. flush).
+        many=True — params это список кортежей для executemany.
+        """
+        assert self._queue is not None
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((sql, params, fut, many))
+        return await fut
+
+    async def _write_many(self, sql: str, seq: Iterable[tuple]) -> int:
+        """
+        executemany кусками по WRITE_MANY_CHUNK. Все куски встают в очередь разом,
+        поэтому писатель коммитит их одной транзакцией.
+        """
+        assert self._queue is not None
+        seq = list(seq)
+        if not seq:
+            return 0
+        loop = asyncio.get_running_loop()
+        futs = []
+        for i in range(0, len(seq), WRITE_MANY_CHUNK):
+            fut = loop.create_future()
+            self._queue.put_nowait((sql, seq[i:i + WRITE_MANY_CHUNK], fut, True))
+            futs.append(fut)
+        return sum(await asyncio.gather(*futs))
+
+    async def _write_in(self, sql: str, ids: Iterable[int]) -> int:
+        """
+        UPDATE/DELETE по списку id: sql содержит "IN ({})", куда подставляются
+        плейсхолдеры. Куски по SQL_IN_CHUNK коммитятся одной транзакцией, как в _write_many.
+        """
+        assert self._queue is not None
+        ids = list(ids)
+        if not ids:
+            return 0
+        loop = asyncio.get_running_loop()
+        futs = []
+        for i in range(0, len(ids), SQL_IN_CHUNK):
+            chunk = tuple(ids[i:i + SQL_IN_CHUNK])
+            fut = loop.create_future()
+            self._queue.put_nowait((sql.format(",".join("?" * len(chunk))), chunk, fut, False))
+            futs.append(fut)
+        return sum(await asyncio.gather(*futs))
+
+    def _write_nowait(self, sql: str, params: tuple = ()):
+        """Поставить запись в очередь и не ждать коммита (журналы, где подтверждение не нужно)."""
+        assert self._queue is not None
+        fut = asyncio.get_running_loop().create_future()
+
+        def _done(f: asyncio.Future):
+            if not f.cancelled() and f.exception() is not None:
+                log.error("DB background write failed: %s", f.exception())
+
+        fut.add_done_callback(_done)
+        self._queue.put_nowait((sql, params, fut, False))
+
+    async def flush(self):
+        """Дождаться, пока всё, что уже стоит в очереди, будет закоммичено."""
+        await self._write(None)
+
+    async def _flusher(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() < WRITE_BATCH_MAX:
+                await asyncio.sleep(WRITE_BATCH_WINDOW)
+            while len(batch) < WRITE_BATCH_MAX:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await self._commit_batch(batch)
+            except Exception as e:
+                log.error("DB writer error: %s", e)
+
+    async def _commit_batch(self, batch: list):
+        results = []
+        try:
+            if not self.conn.in_transaction:
+                await self.conn.execute("BEGIN IMMEDIATE")
+            for sql, params, fut, many in batch:
+                if sql is None:
+                    results.append((fut, 0, None))
+                    continue
+                try:
+                    if many:
+                        cur = await self.conn.executemany(sql, params)
+                    else:
+                        cur = await self.conn.execute(sql, params)
+                    # RETURNING дочитываем до коммита
+                    value = await cur.fetchall() if cur.description else cur.rowcount
+                    results.append((fut, value, None))
+                except Exception as e:
+                    # ошибка одного запроса (например, UNIQUE) не валит всю пачку
+                    results.append((fut, None, e))
+            await self.conn.commit()
+        except Exception as e:
+            log.error("DB batch commit failed (%d stmts): %s", len(batch), e)
+            try:
+                await self.conn.rollback()
+            except Exception:
+                pass
+            for _, _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut, value, err in results:
+            if fut.done():
+                continue  # вызывающий уже отменён
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(value)
+
+    # --- Кэш пользователей ---
+    @staticmethod
+    def _cache_get(cache: dict, uid: int):
+        hit = cache.get(uid)
+        if hit is not None and hit[0] > time.monotonic():
+            return True, hit[1]
+        return False, None
+
+    @staticmethod
+    def _cache_put(cache: dict, uid: int, value):
+        if len(cache) >= _CACHE_MAX:
+            now = time.monotonic()
+            for k in [k for k, (exp, _) in cache.items() if exp <= now]:
+                del cache[k]
+            if len(cache) >= _CACHE_MAX:
+                cache.clear()
+        cache[uid] = (time.monotonic() + _CACHE_TTL, value)
+
+    def _evict(self, *uids: int):
+        for uid in uids:
+            self._user_cache.pop(uid, None)
+            self._phone_cache.pop(uid, None)
 
     async def init_schema(self):
         assert self.conn is not None
@@ -337,38 +806,30 @@ class DB:
         await self.conn.execute(DDL_PAYMENTS)
         await self.conn.execute(DDL_CANCEL)
         await self.conn.execute(DDL_ADMIN_EVENTS)
-        for stmt in DDL_INDEXES:
-            await self.conn.execute(stmt)
-        # на случай старой БД — тихая миграция phone
-        try:
-            await self.conn.execute("ALTER TABLE users ADD COLUMN phone TEXT;")
-        except Exception:
-            pass
-        # Миграции для напоминаний
-        try:
-            await self.conn.execute("ALTER TABLE users ADD COLUMN remind_3_sent INTEGER DEFAULT 0;")
-        except Exception:
-            pass
-        try:
-            await self.conn.execute("ALTER TABLE users ADD COLUMN remind_2_sent INTEGER DEFAULT 0;")
-        except Exception:
-            pass
-        try:
-            await self.conn.execute("ALTER TABLE users ADD COLUMN remind_1_sent INTEGER DEFAULT 0;")
-        except Exception:
-            pass
-        # Автопродление + рефералка
+        await self.conn.execute(DDL_STARTS)
+        # Миграции старых БД: схему читаем один раз и добавляем только недостающие колонки
+        cur = await self.conn.execute("PRAGMA table_info(users)")
+        user_columns = {row[1] for row in await cur.fetchall()}
         for col, defn in [
+            ("phone", "TEXT"),
+            # напоминания
+            ("remind_3_sent", "INTEGER DEFAULT 0"),
+            ("remind_2_sent", "INTEGER DEFAULT 0"),
+            ("remind_1_sent", "INTEGER DEFAULT 0"),
+            # автопродление + рефералка
             ("payment_method_id", "TEXT"),
             ("auto_renewal", "INTEGER DEFAULT 0"),
             ("auto_renewal_agreed_at", "INTEGER"),
             ("auto_renewal_failures", "INTEGER DEFAULT 0"),
             ("referral_code", "TEXT"),
+            # статус в группе по последней проверке ('administrator' — не кикаем)
+            ("last_known_status", "TEXT"),
         ]:
-            try:
+            if col not in user_columns:
                 await self.conn.execute(f"ALTER TABLE users ADD COLUMN {col} {defn};")
-            except Exception:
-                pass
+        # индексы — после миграций: часть из них по добавляемым колонкам
+        for stmt in DDL_INDEXES:
+            await self.conn.execute(stmt)
         # Рефералы, награды, достижения, broadcast
         await self.conn.execute("""
             CREATE TABLE IF NOT EXISTS referrals (
@@ -397,17 +858,32 @@ class DB:
                 failed_count INTEGER DEFAULT 0, blocked_count INTEGER DEFAULT 0,
                 created_at INTEGER
             )""")
+        # Индексы рефералки — после создания таблиц
+        await self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)"
+        )
+        try:
+            await self.conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_refcode ON users(referral_code) "
+                "WHERE referral_code IS NOT NULL"
+            )
+        except Exception as e:
+            # в старой БД могли остаться дубли кодов — индексируем хотя бы без уникальности
+            log.warning("unique referral_code index failed (%s), falling back to plain index", e)
+            await self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_users_refcode_plain ON users(referral_code)"
+            )
         await self.conn.commit()
 
     async def upsert_user_meta(self, user, expires_at: Optional[int] = None):
         assert self.conn is not None
         if expires_at is None:
-            await self.conn.execute(
+            await self._write(
                 "INSERT OR IGNORE INTO users(user_id, username, full_name) VALUES(?,?,?)",
                 (user.id, user.username, user.full_name)
             )
         else:
-            await self.conn.execute(
+            await self._write(
                 """
                 INSERT INTO users(user_id, username, full_name, expires_at)
                 VALUES(?,?,?,?)
@@ -418,18 +894,28 @@ class DB:
                 """,
                 (user.id, user.username, user.full_name, expires_at)
             )
-        await self.conn.commit()
+        self._evict(user.id)
 
     async def get_user(self, uid: int) -> Optional[UserRow]:
         assert self.conn is not None
-        cur = await self.conn.execute("SELECT user_id, expires_at FROM users WHERE user_id=?", (uid,))
+        hit, cached = self._cache_get(self._user_cache, uid)
+        if hit:
+            return cached
+        cur = await self.rconn.execute("SELECT user_id, expires_at FROM users WHERE user_id=?", (uid,))
         row = await cur.fetchone()
-        return UserRow(row[0], row[1]) if row else None
+        result = UserRow(row[0], row[1]) if row else None
+        self._cache_put(self._user_cache, uid, result)
+        return result
+
+    async def has_active_sub(self, uid: int) -> bool:
+        # через кэш get_user: повторные /habits, /referral не ходят в SQLite вовсе
+        row = await self.get_user(uid)
+        return bool(row and is_active(row.expires_at))
 
     async def set_user_expires(self, uid: int, expires_at: int,
                                username: Optional[str] = None, full_name: Optional[str] = None):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             """
             INSERT INTO users(user_id, username, full_name, expires_at, remind_3_sent, remind_2_sent, remind_1_sent)
             VALUES(?,?,?,?,0,0,0)
@@ -443,53 +929,155 @@ class DB:
             """,
             (uid, username, full_name, expires_at)
         )
-        await self.conn.commit()
+        self._evict(uid)
+
+    async def bump_user_expires(self, user, min_expires: int) -> int:
+        """
+        Оплата: expires_at = max(текущий, min_expires) одним UPSERT.
+        Возвращает итоговый expires_at (RETURNING вместо отдельного get_user).
+        """
+        assert self.conn is not None
+        rows = await self._write(
+            """
+            INSERT INTO users(user_id, username, full_name, expires_at)
+            VALUES(?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username=excluded.username,
+                full_name=excluded.full_name,
+                expires_at=MAX(COALESCE(users.expires_at,0), excluded.expires_at)
+            RETURNING expires_at
+            """,
+            (user.id, user.username, user.full_name, min_expires)
+        )
+        self._evict(user.id)
+        return rows[0][0]
+
+    async def extend_user_expires(self, uid: int, seconds: int,
+                                  username: Optional[str] = None, full_name: Optional[str] = None) -> int:
+        """
+        Продление: expires_at = max(текущий, now) + seconds, флаги напоминаний сбрасываются.
+        Возвращает итоговый expires_at.
+        """
+        assert self.conn is not None
+        now = now_ts()
+        rows = await self._write(
+            """
+            INSERT INTO users(user_id, username, full_name, expires_at, remind_3_sent, remind_2_sent, remind_1_sent)
+            VALUES(?,?,?,?,0,0,0)
+            ON CONFLICT(user_id) DO UPDATE SET
+              expires_at=MAX(COALESCE(users.expires_at,0), ?) + ?,
+              username=COALESCE(excluded.username, users.username),
+              full_name=COALESCE(excluded.full_name, users.full_name),
+              remind_3_sent=0,
+              remind_2_sent=0,
+              remind_1_sent=0
+            RETURNING expires_at
+            """,
+            (uid, username, full_name, now + seconds, now, seconds)
+        )
+        self._evict(uid)
+        return rows[0][0]
 
     async def set_user_phone(self, uid: int, phone: str):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             """
             INSERT INTO users(user_id, phone) VALUES(?,?)
             ON CONFLICT(user_id) DO UPDATE SET phone=excluded.phone
             """,
             (uid, phone)
         )
-        await self.conn.commit()
+        self._evict(uid)
 
     async def get_user_phone(self, uid: int) -> Optional[str]:
         assert self.conn is not None
-        cur = await self.conn.execute("SELECT phone FROM users WHERE user_id=?", (uid,))
+        hit, cached = self._cache_get(self._phone_cache, uid)
+        if hit:
+            return cached
+        cur = await self.rconn.execute("SELECT phone FROM users WHERE user_id=?", (uid,))
         row = await cur.fetchone()
-        return row[0] if row and row[0] else None
+        result = row[0] if row and row[0] else None
+        self._cache_put(self._phone_cache, uid, result)
+        return result
+
+    async def get_user_state(self, uid: int) -> tuple[Optional[int], Optional[str]]:
+        """(expires_at, phone) одним запросом; expires_at=None — пользователя нет."""
+        assert self.conn is not None
+        hit_u, row = self._cache_get(self._user_cache, uid)
+        hit_p, phone = self._cache_get(self._phone_cache, uid)
+        if hit_u and hit_p:
+            return (row.expires_at if row else None), phone
+        cur = await self.rconn.execute("SELECT expires_at, phone FROM users WHERE user_id=?", (uid,))
+        r = await cur.fetchone()
+        row = UserRow(uid, r[0]) if r else None
+        phone = r[1] if r and r[1] else None
+        self._cache_put(self._user_cache, uid, row)
+        self._cache_put(self._phone_cache, uid, phone)
+        return (row.expires_at if row else None), phone
 
     async def mark_reminder_sent(self, uid: int, days: int):
         assert self.conn is not None
-        col = {3: "remind_3_sent", 2: "remind_2_sent", 1: "remind_1_sent"}.get(days)
-        if not col:
+        sql = _SQL_UPDATE_REMIND.get(days)
+        if not sql:
             return
-        await self.conn.execute(f"UPDATE users SET {col}=1 WHERE user_id=?", (uid,))
-        await self.conn.commit()
+        await self._write(sql, (uid,))
+
+    async def mark_reminders_sent_bulk(self, days: int, uids: Iterable[int]):
+        assert self.conn is not None
+        sql = _SQL_UPDATE_REMIND.get(days)
+        if not sql:
+            return
+        await self._write_many(sql, ((u,) for u in uids))
+
+    async def reset_expires_bulk(self, uids: Iterable[int]):
+        """expires_at=0 (доступ закрыт, повторно не трогаем) + сброс флагов напоминаний."""
+        assert self.conn is not None
+        uids = list(uids)
+        await self._write_in(
+            "UPDATE users SET expires_at=0, remind_3_sent=0, remind_2_sent=0, remind_1_sent=0 WHERE user_id IN ({})",
+            uids
+        )
+        self._evict(*uids)
+
+    def log_start(self, user, extra: str = "start"):
+        """Журнал /start — в таблицу starts через очередь писателя, без ожидания."""
+        self._write_nowait(
+            "INSERT INTO starts(user_id, username, full_name, extra, created_at) VALUES(?,?,?,?,?)",
+            (user.id, user.username, user.full_name, extra, now_ts())
+        )
+
+    async def export_log_rows(self, kind: str) -> list[tuple]:
+        """Строки для CSV-выгрузки: (created_at, user_id, username, full_name, extra)."""
+        assert self.conn is not None
+        cur = await self.rconn.execute(_SQL_EXPORT[kind])
+        return await cur.fetchall()
 
     async def save_payment(self, user_id: int, payment_id: str, amount: int, status: str):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             "INSERT INTO payments(user_id, payment_id, amount, status, created_at) VALUES(?,?,?,?,?)",
             (user_id, payment_id, amount, status, now_ts())
         )
-        await self.conn.commit()
 
     async def update_payment_status(self, payment_id: str, status: str):
         assert self.conn is not None
-        await self.conn.execute("UPDATE payments SET status=? WHERE payment_id=?", (status, payment_id))
-        await self.conn.commit()
+        await self._write("UPDATE payments SET status=? WHERE payment_id=?", (status, payment_id))
 
     async def save_cancellation(self, user_id: int, reason: str):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             "INSERT INTO cancellations(user_id, reason, created_at) VALUES(?,?,?)",
             (user_id, reason, now_ts())
         )
-        await self.conn.commit()
+
+    async def bulk_save_cancellations(self, rows: Iterable[tuple[int, str]]):
+        """rows: (user_id, reason) — одной executemany в общей транзакции писателя."""
+        assert self.conn is not None
+        now = now_ts()
+        await self._write_many(
+            "INSERT INTO cancellations(user_id, reason, created_at) VALUES(?,?,?)",
+            ((uid, reason, now) for uid, reason in rows)
+        )
 
     async def log_admin_event(
         self,
@@ -500,14 +1088,13 @@ class DB:
         payment_id: str = None,
     ):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             """
             INSERT INTO admin_events(event_type, severity, user_id, payment_id, message, created_at)
             VALUES(?,?,?,?,?,?)
             """,
             (event_type, severity, user_id, payment_id, message, now_ts())
         )
-        await self.conn.commit()
 
     async def admin_snapshot(self) -> dict:
         assert self.conn is not None
@@ -516,7 +1103,7 @@ class DB:
         old_pending_cutoff = now - 15 * 60
 
         async def scalar(sql: str, params: tuple = ()) -> int:
-            cur = await self.conn.execute(sql, params)
+            cur = await self.rconn.execute(sql, params)
             row = await cur.fetchone()
             return row[0] or 0
 
@@ -583,12 +1170,12 @@ class DB:
 
     async def cancellation_report(self, limit: int = 10) -> dict:
         assert self.conn is not None
-        cur = await self.conn.execute(
+        cur = await self.rconn.execute(
             "SELECT reason, COUNT(*) FROM cancellations GROUP BY reason ORDER BY COUNT(*) DESC"
         )
         reasons = {row[0] or "unknown": row[1] for row in await cur.fetchall()}
 
-        cur = await self.conn.execute(
+        cur = await self.rconn.execute(
             """
             SELECT c.user_id, COALESCE(u.username,''), COALESCE(u.full_name,''),
                    c.reason, c.created_at
@@ -614,20 +1201,33 @@ class DB:
     async def get_user_id_by_username(self, username: str) -> Optional[int]:
         assert self.conn is not None
         username = username.lstrip("@").lower()
-        cur = await self.conn.execute("SELECT user_id FROM users WHERE LOWER(IFNULL(username,'')) = ? LIMIT 1", (username,))
+        if not username:
+            return None
+        # выражение совпадает с idx_users_username_lower
+        cur = await self.rconn.execute("SELECT user_id FROM users WHERE LOWER(username) = ? LIMIT 1", (username,))
         row = await cur.fetchone()
         return row[0] if row else None
 
     async def expired_user_ids(self, at_ts: int) -> list[int]:
         assert self.conn is not None
-        cur = await self.conn.execute("SELECT user_id FROM users WHERE expires_at > 0 AND expires_at < ?", (at_ts,))
+        cur = await self.rconn.execute(
+            "SELECT user_id FROM users WHERE expires_at > 0 AND expires_at < ?"
+            " AND COALESCE(last_known_status,'') != 'administrator'",
+            (at_ts,))
         rows = await cur.fetchall()
         return [r[0] for r in rows]
 
+    async def sync_admin_statuses(self, admin_ids: Iterable[int]):
+        """last_known_status='administrator' ровно у текущих админов группы."""
+        assert self.conn is not None
+        # обе записи попадают в одну пачку писателя — одна транзакция
+        self._write_nowait("UPDATE users SET last_known_status=NULL WHERE last_known_status='administrator'")
+        await self._write_in("UPDATE users SET last_known_status='administrator' WHERE user_id IN ({})", admin_ids)
+
     # --- Автопродление ---
     async def set_payment_method(self, uid: int, payment_method_id: str):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             """
             UPDATE users
             SET payment_method_id=?,
@@ -637,12 +1237,11 @@ class DB:
             WHERE user_id=?
             """,
             (payment_method_id, now_ts(), uid))
-        await self.conn.commit()
 
     async def set_auto_renewal(self, uid: int, enabled: bool):
         assert self.conn is not None
         if enabled:
-            await self.conn.execute(
+            await self._write(
                 """
                 UPDATE users
                 SET auto_renewal=1,
@@ -652,13 +1251,12 @@ class DB:
                 """,
                 (now_ts(), uid))
         else:
-            await self.conn.execute(
+            await self._write(
                 "UPDATE users SET auto_renewal=0 WHERE user_id=?", (uid,))
-        await self.conn.commit()
 
     async def get_auto_renewal_info(self, uid: int) -> dict:
         assert self.conn is not None
-        cur = await self.conn.execute(
+        cur = await self.rconn.execute(
             """
             SELECT auto_renewal, payment_method_id, auto_renewal_agreed_at,
                    auto_renewal_failures, expires_at
@@ -684,18 +1282,17 @@ class DB:
 
     async def clear_payment_method(self, uid: int):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             "UPDATE users SET payment_method_id=NULL, auto_renewal=0, auto_renewal_failures=0 WHERE user_id=?",
             (uid,))
-        await self.conn.commit()
 
     async def get_users_for_auto_renewal(self, within_seconds: int = 172800) -> list[dict]:
         """Пользователи с auto_renewal=1, истекающие в ближайшие within_seconds (по умолчанию 2 дня)."""
         assert self.conn is not None
         now = now_ts()
         deadline = now + within_seconds
-        cur = await self.conn.execute(
-            """SELECT user_id, username, full_name, expires_at, payment_method_id, auto_renewal_failures
+        cur = await self.rconn.execute(
+            """SELECT user_id, username, full_name, expires_at, payment_method_id, auto_renewal_failures, phone
                FROM users
                WHERE auto_renewal=1 AND payment_method_id IS NOT NULL
                  AND expires_at > ? AND expires_at <= ?
@@ -703,51 +1300,76 @@ class DB:
             (now, deadline))
         rows = await cur.fetchall()
         return [{"user_id": r[0], "username": r[1], "full_name": r[2],
-                 "expires_at": r[3], "payment_method_id": r[4], "failures": r[5] or 0}
+                 "expires_at": r[3], "payment_method_id": r[4], "failures": r[5] or 0,
+                 "phone": r[6]}
                 for r in rows]
 
     async def increment_auto_renewal_failures(self, uid: int):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             "UPDATE users SET auto_renewal_failures = COALESCE(auto_renewal_failures,0)+1 WHERE user_id=?", (uid,))
-        await self.conn.commit()
 
     async def reset_auto_renewal_failures(self, uid: int):
         assert self.conn is not None
-        await self.conn.execute("UPDATE users SET auto_renewal_failures=0 WHERE user_id=?", (uid,))
-        await self.conn.commit()
+        await self._write("UPDATE users SET auto_renewal_failures=0 WHERE user_id=?", (uid,))
+
+    async def increment_auto_renewal_failures_bulk(self, uids: Iterable[int]):
+        assert self.conn is not None
+        # вторая неудача подряд сразу выключает автопродление — той же записью
+        await self._write_in(
+            """
+            UPDATE users
+            SET auto_renewal_failures = COALESCE(auto_renewal_failures,0)+1,
+                auto_renewal = CASE WHEN COALESCE(auto_renewal_failures,0)+1 >= 2 THEN 0 ELSE auto_renewal END
+            WHERE user_id IN ({})
+            """,
+            uids
+        )
+
+    async def reset_auto_renewal_failures_bulk(self, uids: Iterable[int]):
+        assert self.conn is not None
+        await self._write_in("UPDATE users SET auto_renewal_failures=0 WHERE user_id IN ({})", uids)
 
     # --- Рефералка ---
     async def get_referral_code(self, uid: int) -> Optional[str]:
         assert self.conn is not None
-        cur = await self.conn.execute("SELECT referral_code FROM users WHERE user_id=?", (uid,))
+        cur = await self.rconn.execute("SELECT referral_code FROM users WHERE user_id=?", (uid,))
         row = await cur.fetchone()
         return row[0] if row and row[0] else None
 
     async def set_referral_code(self, uid: int, code: str):
         assert self.conn is not None
-        await self.conn.execute("UPDATE users SET referral_code=? WHERE user_id=?", (code, uid))
-        await self.conn.commit()
+        await self._write("UPDATE users SET referral_code=? WHERE user_id=?", (code, uid))
+
+    async def claim_referral_code(self, uid: int, code: str) -> Optional[str]:
+        """
+        Ставит код, только если у пользователя его ещё нет.
+        None — код уже был; IntegrityError — такой код занят другим.
+        """
+        assert self.conn is not None
+        rows = await self._write(
+            "UPDATE users SET referral_code=? WHERE user_id=? AND referral_code IS NULL RETURNING referral_code",
+            (code, uid))
+        return rows[0][0] if rows else None
 
     async def find_user_by_referral_code(self, code: str) -> Optional[int]:
         assert self.conn is not None
-        cur = await self.conn.execute("SELECT user_id FROM users WHERE referral_code=?", (code,))
+        cur = await self.rconn.execute("SELECT user_id FROM users WHERE referral_code=?", (code,))
         row = await cur.fetchone()
         return row[0] if row else None
 
     async def create_referral(self, referrer_id: int, referred_id: int):
         assert self.conn is not None
         try:
-            await self.conn.execute(
+            await self._write(
                 "INSERT INTO referrals(referrer_id, referred_id, created_at) VALUES(?,?,?)",
                 (referrer_id, referred_id, now_ts()))
-            await self.conn.commit()
         except Exception:
             pass  # duplicate
 
     async def get_referral_for_user(self, referred_id: int) -> Optional[dict]:
         assert self.conn is not None
-        cur = await self.conn.execute(
+        cur = await self.rconn.execute(
             "SELECT referrer_id, referred_paid, reward_granted FROM referrals WHERE referred_id=?", (referred_id,))
         row = await cur.fetchone()
         if not row:
@@ -756,15 +1378,14 @@ class DB:
 
     async def mark_referral_paid(self, referred_id: int):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             "UPDATE referrals SET referred_paid=1, reward_granted=1 WHERE referred_id=? AND referred_paid=0",
             (referred_id,))
-        await self.conn.commit()
 
     async def get_unused_referral_reward(self, uid: int) -> Optional[int]:
         """Возвращает discount_percent если есть неиспользованная награда."""
         assert self.conn is not None
-        cur = await self.conn.execute(
+        cur = await self.rconn.execute(
             "SELECT id, discount_percent FROM referral_rewards WHERE user_id=? AND used=0 ORDER BY created_at LIMIT 1",
             (uid,))
         row = await cur.fetchone()
@@ -772,58 +1393,75 @@ class DB:
 
     async def use_referral_reward(self, uid: int):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             """UPDATE referral_rewards SET used=1 WHERE id=(
                  SELECT id FROM referral_rewards WHERE user_id=? AND used=0 ORDER BY created_at LIMIT 1
                )""", (uid,))
-        await self.conn.commit()
 
     async def create_referral_reward(self, uid: int, discount_percent: int = 30):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             "INSERT INTO referral_rewards(user_id, discount_percent, created_at) VALUES(?,?,?)",
             (uid, discount_percent, now_ts()))
-        await self.conn.commit()
 
     async def get_referral_stats(self, uid: int) -> dict:
         assert self.conn is not None
-        cur = await self.conn.execute(
-            "SELECT COUNT(*) FROM referrals WHERE referrer_id=?", (uid,))
-        total = (await cur.fetchone())[0]
-        cur = await self.conn.execute(
-            "SELECT COUNT(*) FROM referrals WHERE referrer_id=? AND referred_paid=1", (uid,))
-        paid = (await cur.fetchone())[0]
-        cur = await self.conn.execute(
-            "SELECT COUNT(*) FROM referral_rewards WHERE user_id=? AND used=0", (uid,))
-        rewards = (await cur.fetchone())[0]
-        return {"total_invited": total, "total_paid": paid, "available_rewards": rewards}
+        # один проход по idx_referrals_referrer + подзапрос по наградам — один round trip
+        cur = await self.rconn.execute(
+            """
+            SELECT COUNT(*),
+                   SUM(referred_paid=1),
+                   (SELECT COUNT(*) FROM referral_rewards WHERE user_id=? AND used=0)
+            FROM referrals WHERE referrer_id=?
+            """,
+            (uid, uid))
+        total, paid, rewards = await cur.fetchone()
+        return {"total_invited": total, "total_paid": paid or 0, "available_rewards": rewards}
 
     # --- Broadcast / Сегменты ---
-    async def get_all_user_ids(self) -> list[int]:
+    async def iter_user_ids(self, sql: str, params: tuple = ()) -> AsyncIterator[int]:
+        """
+        Потоково отдаёт первый столбец выборки — без fetchall и промежуточного списка кортежей.
+        Для рассылок: async for uid in db.iter_user_ids(...).
+        """
         assert self.conn is not None
-        cur = await self.conn.execute("SELECT user_id FROM users")
-        return [r[0] for r in await cur.fetchall()]
+        async with self.rconn.execute(sql, params) as cur:
+            async for row in cur:
+                yield row[0]
+
+    async def get_all_user_ids(self) -> list[int]:
+        return [uid async for uid in self.iter_user_ids("SELECT user_id FROM users")]
 
     async def get_active_user_ids(self) -> list[int]:
-        assert self.conn is not None
-        cur = await self.conn.execute(
-            "SELECT user_id FROM users WHERE expires_at > ?", (now_ts(),))
-        return [r[0] for r in await cur.fetchall()]
+        return [uid async for uid in self.iter_user_ids(
+            "SELECT user_id FROM users WHERE expires_at > ?", (now_ts(),))]
 
     async def get_expired_user_ids_all(self) -> list[int]:
+        return [uid async for uid in self.iter_user_ids(
+            "SELECT user_id FROM users WHERE expires_at > 0 AND expires_at < ?", (now_ts(),))]
+
+    async def get_segmented_user_ids(self) -> dict[str, list[int]]:
+        """
+        Все сегменты рассылки за один проход по users:
+        all / active (expires_at > now) / expired (0 < expires_at < now).
+        """
         assert self.conn is not None
-        cur = await self.conn.execute(
-            "SELECT user_id FROM users WHERE expires_at > 0 AND expires_at < ?", (now_ts(),))
-        return [r[0] for r in await cur.fetchall()]
+        now = now_ts()
+        cur = await self.rconn.execute("SELECT user_id, COALESCE(expires_at,0) FROM users")
+        rows = await cur.fetchall()
+        return {
+            "all": [uid for uid, _ in rows],
+            "active": [uid for uid, exp in rows if exp > now],
+            "expired": [uid for uid, exp in rows if 0 < exp < now],
+        }
 
     async def log_broadcast(self, admin_id: int, segment: str, text: str,
                             sent: int, failed: int, blocked: int):
         assert self.conn is not None
-        await self.conn.execute(
+        await self._write(
             """INSERT INTO broadcast_log(admin_id, segment, message_text, sent_count,
                failed_count, blocked_count, created_at) VALUES(?,?,?,?,?,?,?)""",
             (admin_id, segment, text, sent, failed, blocked, now_ts()))
-        await self.conn.commit()
 
 db = DB(DB_PATH)
 
@@ -837,7 +1475,7 @@ def _welcome_text() -> str:
         "— Экспресс-комплексам, растяжке, разминке/заминке\n"
         "— Закрытому комьюнити\n\n"
     )
-    pb = price_text_block()
+    pb = PRICE_TEXT_BLOCK
     return head + pb if pb else head
 
 WELCOME_TEXT = _welcome_text()
@@ -860,17 +1498,31 @@ def terms_kb() -> InlineKeyboardMarkup:
         kb_row(InlineKeyboardButton(text="✅ Я согласен(на)", callback_data="agree_terms"))
     ])
 
+TERMS_KB = terms_kb()
+
 def cancel_or_keep_kb() -> InlineKeyboardMarkup:
     return kb([
         kb_row(InlineKeyboardButton(text="Я хочу отменить подписку", callback_data="cancel_reason")),
         kb_row(InlineKeyboardButton(text="Я передумал, хочу остаться", callback_data="cancel_keep"))
     ])
 
+CANCEL_OR_KEEP_KB = cancel_or_keep_kb()
+
+# Статичные кнопки из хендлеров — собираем один раз при импорте
+SHOW_FORMALITIES_KB = kb([kb_row(InlineKeyboardButton(text="Что дальше? 💖", callback_data="show_formalities"))])
+MANAGE_SUB_KB = kb([kb_row(InlineKeyboardButton(text="Управлять подпиской", callback_data="cancel_warn"))])
+PAY_START_KB = kb([kb_row(InlineKeyboardButton(text="Оформить доступ (1 месяц)", callback_data="pay_start"))])
+
 def subscription_manage_kb(info: dict) -> InlineKeyboardMarkup:
+    return _subscription_manage_kb(bool(info.get("enabled")), bool(info.get("has_payment_method")))
+
+# вариантов всего четыре (enabled × has_payment_method) — кэшируем все
+@lru_cache(maxsize=4)
+def _subscription_manage_kb(enabled: bool, has_payment_method: bool) -> InlineKeyboardMarkup:
     rows: list[list[InlineKeyboardButton]] = []
-    if info.get("enabled") and info.get("has_payment_method"):
+    if enabled and has_payment_method:
         rows.append([InlineKeyboardButton(text="Отключить автопродление", callback_data="renewal_start:disable")])
-    if info.get("has_payment_method"):
+    if has_payment_method:
         rows.append([InlineKeyboardButton(text="Отвязать карту", callback_data="renewal_start:unlink")])
     rows.append([InlineKeyboardButton(text="Закрыть доступ сейчас", callback_data="renewal_start:close")])
     rows.append([InlineKeyboardButton(text="Оставить всё как есть", callback_data="cancel_keep")])
@@ -882,12 +1534,17 @@ def cancel_reasons_kb() -> InlineKeyboardMarkup:
     rows.append([InlineKeyboardButton(text="Назад", callback_data="cancel_warn")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+CANCEL_REASONS_KB = cancel_reasons_kb()
+
+# action и reason_key — из маленьких конечных наборов, разметку кэшируем
+@lru_cache(maxsize=8)
 def renewal_reasons_kb(action: str) -> InlineKeyboardMarkup:
     rows = [[InlineKeyboardButton(text=title, callback_data=f"renewal_reason:{action}:{key}")]
             for (title, key) in CANCEL_REASONS]
     rows.append([InlineKeyboardButton(text="Назад", callback_data="cancel_warn")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+@lru_cache(maxsize=len(CANCEL_REASONS))
 def cancel_confirm_kb(reason_key: str) -> InlineKeyboardMarkup:
     return kb([
         kb_row(InlineKeyboardButton(text="Всё равно отменить", callback_data=f"renewal_final:close:{reason_key}")),
@@ -895,6 +1552,7 @@ def cancel_confirm_kb(reason_key: str) -> InlineKeyboardMarkup:
         kb_row(InlineKeyboardButton(text="Назад", callback_data="cancel_reason"))
     ])
 
+@lru_cache(maxsize=64)
 def renewal_confirm_kb(action: str, reason_key: str) -> InlineKeyboardMarkup:
     label = RENEWAL_ACTION_LABEL.get(action, "Подтвердить")
     return kb([
@@ -904,9 +1562,13 @@ def renewal_confirm_kb(action: str, reason_key: str) -> InlineKeyboardMarkup:
     ])
 
 def autorenewal_kb(info: dict) -> Optional[InlineKeyboardMarkup]:
+    return _autorenewal_kb(bool(info.get("enabled")), bool(info.get("has_payment_method")))
+
+@lru_cache(maxsize=4)
+def _autorenewal_kb(enabled: bool, has_payment_method: bool) -> Optional[InlineKeyboardMarkup]:
     rows: list[list[InlineKeyboardButton]] = []
-    if info.get("has_payment_method"):
-        if info.get("enabled"):
+    if has_payment_method:
+        if enabled:
             rows.append([InlineKeyboardButton(text="Отключить автопродление", callback_data="autorenew_off")])
         else:
             rows.append([InlineKeyboardButton(text="Включить автопродление", callback_data="autorenew_on")])
@@ -935,43 +1597,36 @@ async def start(m: Message):
                 await db.create_referral(referrer_id, m.from_user.id)
                 log.info("Referral created: %s -> %s (code %s)", referrer_id, m.from_user.id, referral_code)
 
-    # CSV лог старта
-    _csv_append(STARTS_CSV, [
-        now_iso(), str(m.from_user.id), f"@{m.from_user.username}" if m.from_user.username else "",
-        m.from_user.full_name or "", "start"
-    ])
+    # Лог старта — в SQLite (CSV выгружается по /export_csv)
+    db.log_start(m.from_user)
 
-    btn = kb([kb_row(InlineKeyboardButton(text="Что дальше? 💖", callback_data="show_formalities"))])
-    await send_video_or_text(m.chat.id, WELCOME_VIDEO or "", WELCOME_TEXT, reply_markup=btn)
+    await send_video_or_text(m.chat.id, WELCOME_VIDEO or "", WELCOME_TEXT, reply_markup=SHOW_FORMALITIES_KB)
 
-@dp.callback_query(F.data == "show_formalities")
 async def show_formalities(cb: CallbackQuery):
     await cb.answer()
     try:
         await cb.message.delete()
     except Exception:
         pass
-    await send_photo_or_text(cb.message.chat.id, FORMAL_PHOTO or "", FORM_TEXT, reply_markup=terms_kb())
+    await send_photo_or_text(cb.message.chat.id, FORMAL_PHOTO or "", FORM_TEXT, reply_markup=TERMS_KB)
 
-@dp.callback_query(F.data == "agree_terms")
 async def agree_terms(cb: CallbackQuery):
     await cb.answer("Принято ✅")
-    row = await db.get_user(cb.from_user.id)
-    active = is_active(row.expires_at) if row else False
-    phone = await db.get_user_phone(cb.from_user.id)
+    expires_at, phone = await db.get_user_state(cb.from_user.id)
+    active = is_active(expires_at)
 
     if not phone and not active:
         await replace_with_text(
             cb,
             "Чтобы оформить доступ, нужен номер для чека. Нажми кнопку ниже — Telegram передаст его автоматически."
         )
-        await bot.send_message(cb.from_user.id, "Поделитесь номером телефона:", reply_markup=ask_phone_kb())
+        await bot.send_message(cb.from_user.id, "Поделитесь номером телефона:", reply_markup=ASK_PHONE_KB)
         return
 
     if active:
         link = await create_one_time_invite()
         if link:
-            buttons = kb([kb_row(InlineKeyboardButton(text="Управлять подпиской", callback_data="cancel_warn"))])
+            buttons = MANAGE_SUB_KB
             await replace_with_text(
                 cb,
                 "Подписка активна.\n"
@@ -985,7 +1640,7 @@ async def agree_terms(cb: CallbackQuery):
             )
     else:
         text = "Теперь перейдём к оплате: доступ на 1 месяц, оплата на странице ЮKassa."
-        buttons = kb([kb_row(InlineKeyboardButton(text="Оформить доступ (1 месяц)", callback_data="pay_start"))])
+        buttons = PAY_START_KB
         await replace_with_text(cb, text, buttons)
 
 @dp.message(Command("status"))
@@ -995,7 +1650,7 @@ async def status(m: Message):
         left = days_left(row.expires_at)
         await m.answer(
             f"Подписка активна. Осталось ≈ {left} дн.",
-            reply_markup=kb([kb_row(InlineKeyboardButton(text="Управлять подпиской", callback_data="cancel_warn"))])
+            reply_markup=MANAGE_SUB_KB
         )
     else:
         await m.answer("Подписка не активна. Нажми /start и оформи доступ.")
@@ -1038,7 +1693,7 @@ async def got_contact(m: Message):
     await m.answer("Телефон получен. Можно оформлять доступ.", reply_markup=ReplyKeyboardRemove())
     await m.answer(
         "Оформить доступ:",
-        reply_markup=kb([kb_row(InlineKeyboardButton(text="Оформить доступ (1 месяц)", callback_data="pay_start"))])
+        reply_markup=PAY_START_KB
     )
 
 @dp.message(Command("cancel_subscription"))
@@ -1101,7 +1756,6 @@ CANCEL_REASON_TEXTS = {
     ),
 }
 
-@dp.callback_query(F.data == "cancel_warn")
 async def cancel_warn(cb: CallbackQuery):
     await cb.answer()
     row = await db.get_user(cb.from_user.id)
@@ -1118,25 +1772,21 @@ async def cancel_warn(cb: CallbackQuery):
         subscription_manage_kb(info)
     )
 
-@dp.callback_query(F.data == "cancel_reason")
 async def cancel_reason(cb: CallbackQuery):
     await cb.answer()
     info = await db.get_auto_renewal_info(cb.from_user.id)
     await replace_with_text(cb, "Что хотите сделать с подпиской?", subscription_manage_kb(info))
 
-@dp.callback_query(F.data.startswith("cancel_reason:"))
 async def cancel_reason_selected(cb: CallbackQuery):
     reason_key = cb.data.split(":", 1)[1]
     text = CANCEL_REASON_TEXTS.get(reason_key, CANCEL_REASON_TEXTS["other"])
     await replace_with_text(cb, text, renewal_confirm_kb("close", reason_key))
     await cb.answer()
 
-@dp.callback_query(F.data == "cancel_keep")
 async def cancel_keep(cb: CallbackQuery):
     await cb.answer("Остаёмся 💛")
     await replace_with_text(cb, "Ура, ты с нами! 💛 Если будут вопросы — пиши @petukhovaas, всегда поможем.")
 
-@dp.callback_query(F.data.startswith("renewal_start:"))
 async def renewal_start(cb: CallbackQuery):
     action = cb.data.split(":", 1)[1]
     if action not in RENEWAL_ACTION_LABEL:
@@ -1169,7 +1819,6 @@ async def renewal_start(cb: CallbackQuery):
     await cb.answer()
     await replace_with_text(cb, texts[action], renewal_reasons_kb(action))
 
-@dp.callback_query(F.data.startswith("renewal_reason:"))
 async def renewal_reason_selected(cb: CallbackQuery):
     _, action, reason_key = cb.data.split(":", 2)
     if action not in RENEWAL_ACTION_LABEL:
@@ -1192,63 +1841,120 @@ async def renewal_reason_selected(cb: CallbackQuery):
     await replace_with_text(cb, text, renewal_confirm_kb(action, reason_key))
     await cb.answer()
 
+_can_restrict: Optional[bool] = None  # права бота в группе; None — ещё не проверяли
+
+async def bot_can_restrict(refresh: bool = False) -> bool:
+    """can_restrict_members бота в GROUP_ID: спрашиваем один раз (на старте), дальше из памяти."""
+    global _can_restrict
+    if _can_restrict is None or refresh:
+        try:
+            me = await bot.me()
+            chat_member = await bot.get_chat_member(GROUP_ID, me.id)
+            _can_restrict = bool(getattr(chat_member, "can_restrict_members", False))
+        except Exception as e:
+            log.error("bot rights check failed for group %s: %s", GROUP_ID, e)
+            return False
+        if not _can_restrict:
+            log.error("Bot has no rights to restrict members in group %s", GROUP_ID)
+    return _can_restrict
+
 async def kick_from_group(uid: int) -> bool:
     """
     Удаляет пользователя из группы (бан на минуту + анбан).
     Возвращает True — если успешно, False — если ошибка.
     """
-    try:
-        # Проверяем, что бот в группе с нужными правами
-        chat_member = await bot.get_chat_member(GROUP_ID, bot.id)
-        if not chat_member.can_restrict_members:
-            log.error("Bot has no rights to restrict members in group %s", GROUP_ID)
+    if not await bot_can_restrict():
+        return False
+
+    for attempt in range(2):
+        try:
+            # Кик через бан и анбан
+            await bot.ban_chat_member(
+                GROUP_ID,
+                uid,
+                until_date=now_ts() + 60  # бан на 60 секунд
+            )
+            await bot.unban_chat_member(GROUP_ID, uid)
+            log.info("User %s successfully kicked from group %s", uid, GROUP_ID)
+            return True
+
+        except Exception as e:
+            # права могли отобрать после старта — перепроверяем один раз
+            if attempt == 0 and "right" in str(e).lower() and await bot_can_restrict(refresh=True):
+                continue
+            log.error("kick_from_group failed for uid=%s: %s", uid, e)
             return False
+    return False
 
-        # Кик через бан и анбан
-        await bot.ban_chat_member(
-            GROUP_ID,
-            uid,
-            until_date=now_ts() + 60  # бан на 60 секунд
-        )
-        await bot.unban_chat_member(GROUP_ID, uid)
-        log.info("User %s successfully kicked from group %s", uid, GROUP_ID)
-        return True
+# ---- Удаление пользователя из группы (мягкий кик) ----
+ADMIN_CACHE_TTL = 300.0  # состав админов группы меняется редко
+_admin_cache: tuple[float, frozenset[int]] = (0.0, frozenset())
+
+async def group_admin_ids() -> frozenset[int]:
+    """Id админов/создателя группы: один get_chat_administrators раз в ADMIN_CACHE_TTL."""
+    global _admin_cache
+    ts, ids = _admin_cache
+    if time.monotonic() - ts < ADMIN_CACHE_TTL:
+        return ids
+    try:
+        admins = await _send(GROUP_ID, lambda c: bot.get_chat_administrators(c), throttle=False)
+        fresh = frozenset(a.user.id for a in admins)
+        if fresh != ids:
+            # состав сменился — переносим в БД, чтобы выборки истёкших сразу отсекали админов
+            await db.sync_admin_statuses(fresh)
+        ids = fresh
+        _admin_cache = (time.monotonic(), ids)
+    except Exception as e:
+        # оставляем прежний (возможно пустой) набор — админов всё равно не кикнет Telegram
+        log.warning("get_chat_administrators failed: %s", e)
+    return ids
+
+# Ответы ban_chat_member, означающие «в группе его уже нет»
+_NOT_MEMBER_ERRORS = ("USER_NOT_PARTICIPANT", "PARTICIPANT_ID_INVALID")
 
+async def _remove_from_group(uid: int, admins: frozenset[int]) -> str:
+    """
+    "admin" — админ/создатель (не трогаем), "kicked" — мягко кикнут (ban+unban),
+    "left" — уже вне чата, "failed" — остался в группе.
+    Статус заранее не спрашиваем: сразу ban, а «не участник» узнаём по тексту ошибки.
+    """
+    if uid in admins:
+        return "admin"
+    try:
+        await _send(uid, lambda u: bot.ban_chat_member(GROUP_ID, u, until_date=now_ts() + 60), throttle=False)
+        await _send(uid, lambda u: bot.unban_chat_member(GROUP_ID, u), throttle=False)
+        return "kicked"
     except Exception as e:
-        log.error("kick_from_group failed for uid=%s: %s", uid, e)
-        return False
+        err = str(e)
+        if any(code in err.upper() for code in _NOT_MEMBER_ERRORS):
+            return "left"
+        if "administrator" in err:
+            # стал админом позже, чем мы взяли список админов
+            return "admin"
+        log.error("ban/unban failed for uid=%s: %s", uid, e)
+        return "failed"
 
-# ---- Удаление пользователя из группы (мягкий кик) ----
 async def ensure_user_removed(uid: int) -> bool:
     """
     True  — пользователя точно нет в группе (уже вышел/кикнут) или кик прошёл успешно.
-    False — пользователь остаётся в группе (нет прав/ошибка).
+    False — пользователь остаётся в группе (админ/нет прав/ошибка).
     """
-    try:
-        member = await bot.get_chat_member(GROUP_ID, uid)
-        status = getattr(member, "status", None)
+    return await _remove_from_group(uid, await group_admin_ids()) in ("left", "kicked")
 
-        # Уже не состоит
-        if status in ("left", "kicked"):
-            return True
-
-        # Можно кикнуть (ban+unban = «мягкий кик»)
-        if status not in ("administrator", "creator"):
-            try:
-                await bot.ban_chat_member(GROUP_ID, uid, until_date=now_ts() + 60)
-                await bot.unban_chat_member(GROUP_ID, uid)
-                return True
-            except Exception as e:
-                log.error("ban/unban failed for uid=%s: %s", uid, e)
-                return False
-
-        # Админов кикать нельзя
-        return False
 
-    except Exception as e:
-        # Обычно USER_NOT_PARTICIPANT — считаем, что он уже не в чате
-        log.info("get_chat_member failed for uid=%s: %s (treat as removed)", uid, e)
-        return True
+async def sync_expired_users(ids: list[int]) -> dict[str, int]:
+    """
+    Параллельно (в пределах TG_SEM/TG_RATE) сверяет истёкших с группой,
+    вышедших и кикнутых помечает expires_at=0 одной записью. Возвращает счётчики по исходам.
+    """
+    admins = await group_admin_ids()
+    results = await asyncio.gather(*(_remove_from_group(uid, admins) for uid in ids), return_exceptions=True)
+    await db.reset_expires_bulk(uid for uid, r in zip(ids, results) if r in ("left", "kicked"))
+    counts: dict[str, int] = {}
+    for r in results:
+        key = r if isinstance(r, str) else "failed"
+        counts[key] = counts.get(key, 0) + 1
+    return counts
 
 
 def _renewal_reason(action: str, reason_key: str) -> str:
@@ -1308,13 +2014,11 @@ async def _finish_subscription_action(cb: CallbackQuery, action: str, reason_key
     await cb.answer("Неизвестное действие", show_alert=True)
 
 
-@dp.callback_query(F.data.startswith("cancel_final:"))
 async def cancel_final(cb: CallbackQuery):
     reason_key = cb.data.split(":", 1)[1]
     await _finish_subscription_action(cb, "close", reason_key)
 
 
-@dp.callback_query(F.data.startswith("renewal_final:"))
 async def renewal_final(cb: CallbackQuery):
     _, action, reason_key = cb.data.split(":", 2)
     if action not in RENEWAL_ACTION_LABEL:
@@ -1338,11 +2042,18 @@ async def create_one_time_invite() -> Optional[str]:
         log.error("create_one_time_invite failed: %s", e)
         return None
 
+_IN_GROUP_STATUSES = frozenset({"member", "administrator", "creator", "restricted"})
+
+async def _is_in_group(uid: int) -> bool:
+    try:
+        member = await bot.get_chat_member(GROUP_ID, uid)
+        return member.status in _IN_GROUP_STATUSES
+    except Exception:
+        return False
+
 # ---- YooKassa: старт платежа ----
-@dp.callback_query(F.data == "pay_start")
 async def pay_start(cb: CallbackQuery):
     await cb.answer("Открываю платёж…")
-    global bot_username_cache
 
     user = cb.from_user
 
@@ -1360,7 +2071,7 @@ async def pay_start(cb: CallbackQuery):
         await bot.send_message(
             user.id,
             "Поделитесь номером телефона:",
-            reply_markup=ask_phone_kb()
+            reply_markup=ASK_PHONE_KB
         )
         return
 
@@ -1373,10 +2084,7 @@ async def pay_start(cb: CallbackQuery):
     )
 
     # формируем return_url (куда ЮKassa вернёт после оплаты)
-    if not bot_username_cache:
-        me = await bot.me()
-        bot_username_cache = me.username
-    return_url = f"https://t.me/{bot_username_cache}"
+    return_url = f"https://t.me/{await get_bot_username()}"
 
     # формируем чек (receipt), который уйдёт в фискализацию
     receipt = {
@@ -1412,10 +2120,11 @@ async def pay_start(cb: CallbackQuery):
         await db.use_referral_reward(user.id)
         log.info("User %s using referral discount %d%% — price %d -> %d", user.id, referral_discount, MONTH_PRICE, actual_price)
 
-    # создаём платёж в ЮKassa
+    # создаём платёж в ЮKassa; ключ идемпотентности — повторное нажатие
+    # в ту же минуту вернёт уже созданный платёж, а не второй
     try:
         payment = await asyncio.wait_for(
-            asyncio.to_thread(partial(Payment.create, {
+            _yookassa(partial(Payment.create, {
                 "amount": {
                     "value": amount_rub,
                     "currency": "RUB"
@@ -1435,8 +2144,8 @@ async def pay_start(cb: CallbackQuery):
                     "payment_amount": str(actual_price),
                 },
                 "receipt": receipt                    # <- чек с телефоном
-            })),
-            timeout=15
+            }, f"pay:{user.id}:{amount_rub}:{now_ts() // 60}")),
+            timeout=YOOKASSA_TIMEOUT
         )
     except ApiError as e:
         # например, магазин не принимает фискальные данные / неверный ИНН и т.д.
@@ -1487,14 +2196,13 @@ async def pay_start(cb: CallbackQuery):
     await db.save_payment(user.id, payment.id, actual_price, payment.status)
 
 # ---- Проверка платежа ----
-@dp.callback_query(F.data.startswith("pay_check:"))
 async def pay_check(cb: CallbackQuery):
     payment_id = cb.data.split(":", 1)[1]
     await cb.answer("Проверяю платёж…")
 
     try:
         payment = await asyncio.wait_for(
-            asyncio.to_thread(Payment.find_one, payment_id),
+            _yookassa(partial(Payment.find_one, payment_id)),
             timeout=10
         )
     except asyncio.TimeoutError:
@@ -1522,9 +2230,7 @@ async def pay_check(cb: CallbackQuery):
 
     if status == "succeeded":
         desired_expires = add_days_ts(PAID_DAYS + GRACE_DAYS)
-        existing = await db.get_user(cb.from_user.id)
-        new_expires = max(desired_expires, existing.expires_at if existing else 0)
-        await db.upsert_user_meta(cb.from_user, expires_at=new_expires)
+        await db.bump_user_expires(cb.from_user, desired_expires)
 
         # Сохраняем способ оплаты для автопродления
         auto_renewal_note = ""
@@ -1560,14 +2266,6 @@ async def pay_check(cb: CallbackQuery):
         except Exception as e:
             log.warning("Referral reward error for user %s: %s", cb.from_user.id, e)
 
-        # CSV лог оплаты
-        _csv_append(PAYMENTS_CSV, [
-            now_iso(), str(cb.from_user.id),
-            f"@{cb.from_user.username}" if cb.from_user.username else "",
-            cb.from_user.full_name or "",
-            f"amount={MONTH_PRICE}; payment_id={payment_id}; phone={phone or '-'}"
-        ])
-
         link = await create_one_time_invite()
         if link:
             await replace_with_text(
@@ -1621,153 +2319,88 @@ async def pay_check(cb: CallbackQuery):
         )
 
 
-# ---- Периодические проверки срока подписки ----
-async def periodic_checks():
+# ---- Планировщик подписок: истёкшие + напоминания за 3/2/1 день ----
+def _reminder_for(exp: int, now: int, sent_flags: tuple, autorenew: bool) -> Optional[tuple[list[int], str]]:
     """
-    Каждые CHECK_INTERVAL_SEC:
-    1) Берём всех просроченных из БД.
-    2) Для каждого уточняем реальный статус в чате:
-       - left/kicked/ошибка получения статуса → считаем, что его уже нет,
-         обнуляем expires_at (чтобы больше не трогать).
-       - administrator/creator → пропускаем.
-       - member/restricted → мягко кикаем (ban+unban). Если успешно — обнуляем expires_at.
+    Наступившие и ещё не отправленные корзины (3/2/1 дн.) и текст напоминания.
+    Сообщение одно — по самой срочной корзине, остальные просто отмечаются,
+    чтобы после даунтайма не слать пачку подряд.
     """
-    while True:
-        try:
-            now = now_ts()
-            ids = await db.expired_user_ids(now)
-            for uid in ids:
-                # 2.1 пытаемся узнать реальный статус в группе
-                try:
-                    member = await bot.get_chat_member(GROUP_ID, uid)
-                    status = getattr(member, "status", None)
-                except Exception as e:
-                    # например USER_NOT_PARTICIPANT — считаем, что уже вне чата
-                    log.info("get_chat_member failed for uid=%s: %s (treat as removed)", uid, e)
-                    status = "left"
-
-                if status in ("left", "kicked", None):
-                    # Уже вне чата — помечаем как обработанного, чтобы не перебирать постоянно
-                    await db.set_user_expires(uid, 0)
-                    continue
-
-                if status in ("administrator", "creator"):
-                    # Админов не трогаем
-                    log.debug("skip admin/creator uid=%s", uid)
-                    continue
-
-                # Обычный участник — пробуем мягкий кик
-                removed = await ensure_user_removed(uid)
-                if removed:
-                    await db.set_user_expires(uid, 0)
-                else:
-                    log.warning("could not remove uid=%s (still member)", uid)
-
-        except Exception as e:
-            log.error("periodic_checks error: %s", e)
-
-        await asyncio.sleep(CHECK_INTERVAL_SEC)
-
-
-# ---- Автоочистка истёкших пользователей ----
-async def auto_clean_expired():
-    """
-    Каждые 60 минут проверяет базу (users) и кикает всех, у кого подписка истекла (expires_at <= now() или NULL).
-    Логирует количество найденных пользователей, успешные и неуспешные кики.
-    Использует ban_chat_member + unban_chat_member для мягкого кика.
-    """
-    while True:
-        try:
-            log.info("auto_clean_expired: запущена проверка истёкших пользователей")
-            now = now_ts()
-            # Берём только ещё не обработанные истекшие подписки.
-            # expires_at=0 означает, что доступ уже закрыт и повторно кикать не нужно.
-            async with db.conn.execute(
-                "SELECT user_id FROM users WHERE expires_at IS NOT NULL AND expires_at > 0 AND expires_at <= ?",
-                (now,)
-            ) as cur:
-                rows = await cur.fetchall()
-                expired_ids = [row[0] for row in rows]
-            total = len(expired_ids)
-            log.info("auto_clean_expired: найдено %d истёкших пользователей", total)
-            kicked = 0
-            not_kicked = 0
-            for uid in expired_ids:
-                try:
-                    # Мягкий кик: ban + unban
-                    await bot.ban_chat_member(GROUP_ID, uid, until_date=now + 60)
-                    await bot.unban_chat_member(GROUP_ID, uid)
-                    await db.set_user_expires(uid, 0)
-                    kicked += 1
-                    log.info("auto_clean_expired: успешно кикнут uid=%s", uid)
-                except Exception as e:
-                    not_kicked += 1
-                    log.warning("auto_clean_expired: не удалось кикнуть uid=%s: %s", uid, e)
-            log.info(
-                "auto_clean_expired: завершено. Всего: %d, кикнуто: %d, не удалось кикнуть: %d",
-                total, kicked, not_kicked
-            )
-        except Exception as e:
-            log.error("auto_clean_expired error: %s", e)
-        await asyncio.sleep(60 * 60)  # 60 минут
-
+    due = [d for d, done in zip(REMIND_DAYS, sent_flags) if not done and exp - now <= d * 86400]
+    if not due:
+        return None
+    days = due[-1]
+    left = max(0, (exp - now) // 86400)
+    if autorenew:
+        txt = (
+            f"Подписка скоро продлится автоматически. "
+            f"Сумма списания: {MONTH_PRICE} ₽. "
+            "Управление автопродлением: /autorenewal"
+        )
+    elif days > 1:
+        txt = f"Напоминание: до конца подписки осталось {left} дн."
+    else:
+        txt = (
+            "Напоминание: остался последний день подписки. Завтра доступ закроется. "
+            "Продлите, чтобы сохранить доступ 😊"
+        )
+    return due, txt
 
-# ---- Уведомления об окончании подписки за 3/2/1 день ----
-async def reminder_notifier():
+async def send_reminders(todo: list[tuple[int, list[int], str]]) -> int:
+    """Шлёт напоминания параллельно (темп держит _send) и пачкой отмечает remind_N_sent."""
+    results = await asyncio.gather(
+        *(_send(uid, lambda u, t=txt: bot.send_message(u, t)) for uid, _, txt in todo),
+        return_exceptions=True,
+    )
+    sent: dict[int, list[int]] = {d: [] for d in REMIND_DAYS}
+    for (uid, due, _), res in zip(todo, results):
+        if isinstance(res, BaseException):
+            log.warning("reminder: failed to DM uid=%s: %s", uid, res)
+            continue
+        for d in due:
+            sent[d].append(uid)
+        log.info("reminder %sd sent to %s", due[-1], uid)
+    for days, uids in sent.items():
+        await db.mark_reminders_sent_bulk(days, uids)
+    return sum(1 for r in results if not isinstance(r, BaseException))
+
+async def subscription_tick():
     """
-    Каждые 30 минут:
-    - находит пользователей, у кого до конца подписки осталось ≤ N дней (N ∈ {3,2,1})
-    - у кого соответствующее напоминание ещё не отправлялось (remind_N_sent = 0)
-    - шлёт личное сообщение и отмечает отправку, чтобы не спамить
+    Каждые CHECK_INTERVAL_SEC одна выборка по users вместо трёх отдельных циклов:
+    - истёкшие (кроме админов) — мягкий кик и expires_at=0, см. sync_expired_users;
+    - у кого до конца ≤ N дней (N ∈ {3,2,1}) и remind_N_sent = 0 — личное напоминание.
+    Повторы отсекает состояние строки (expires_at=0, remind_N_sent=1), а не расписание.
     """
-    CHECK_EVERY = 30 * 60
-    while True:
-        try:
-            now = now_ts()
-            for days, col in [(3, "remind_3_sent"), (2, "remind_2_sent"), (1, "remind_1_sent")]:
-                # условие: expires_at > now (подписка ещё активна) и осталось не больше N дней
-                # чтобы не проскочить из-за даунтайма — если бот был оффлайн, всё равно отправим при первой возможности
-                sql = f"""
-                    SELECT user_id, expires_at
-                    FROM users
-                    WHERE expires_at > ?
-                      AND (? + {days}*86400) >= expires_at
-                      AND COALESCE({col},0)=0
-                """
-                async with db.conn.execute(sql, (now, now)) as cur:
-                    rows = await cur.fetchall()
-                for uid, exp in rows:
-                    left = max(0, (exp - now) // 86400)
-                    # Проверяем автопродление
-                    ar_info = await db.get_auto_renewal_info(uid)
-                    try:
-                        if ar_info["enabled"] and ar_info["has_payment_method"]:
-                            txt = (
-                                f"Подписка скоро продлится автоматически. "
-                                f"Сумма списания: {MONTH_PRICE} ₽. "
-                                "Управление автопродлением: /autorenewal"
-                            )
-                        elif days > 1:
-                            txt = f"Напоминание: до конца подписки осталось {left} дн."
-                        else:
-                            txt = (
-                                "Напоминание: остался последний день подписки. Завтра доступ закроется. "
-                                "Продлите, чтобы сохранить доступ 😊"
-                            )
-                        await bot.send_message(uid, txt)
-                        await db.mark_reminder_sent(uid, days)
-                        log.info("reminder %sd sent to %s", days, uid)
-                    except Exception as e:
-                        log.warning("reminder: failed to DM uid=%s: %s", uid, e)
-        except Exception as e:
-            log.error("reminder_notifier error: %s", e)
-        await asyncio.sleep(CHECK_EVERY)
+    try:
+        now = now_ts()
+        expired: list[int] = []
+        todo: list[tuple[int, list[int], str]] = []
+        async with db.rconn.execute(_SQL_SUBSCRIPTION_SCAN, (now, now)) as cur:
+            async for uid, exp, r3, r2, r1, autorenew, is_admin in cur:
+                if exp <= now:
+                    if not is_admin:
+                        expired.append(uid)
+                    continue
+                reminder = _reminder_for(exp, now, (r3, r2, r1), autorenew)
+                if reminder:
+                    todo.append((uid, *reminder))
+
+        if expired or todo:
+            if expired:
+                # кики и напоминания идут одновременно через общий лимитер _send
+                counts, reminded = await asyncio.gather(sync_expired_users(expired), send_reminders(todo))
+            else:
+                counts, reminded = {}, await send_reminders(todo)
+            log.info("subscription_tick: expired %d %s, reminders %d/%d",
+                     len(expired), counts, reminded, len(todo))
+    except Exception as e:
+        log.error("subscription_tick error: %s", e)
 
 
 # ---- Автопродление подписки ----
 AUTO_RENEWAL_INTERVAL = 6 * 3600  # каждые 6 часов
 
-async def auto_renewal_job():
+async def auto_renewal_tick():
     """
     Каждые 6 часов:
     - Находит пользователей с auto_renewal=1, у кого подписка истекает в ближайшие 2 дня
@@ -1775,18 +2408,21 @@ async def auto_renewal_job():
     - При успехе — продляет подписку и уведомляет
     - При неудаче — инкрементирует failures, после 2 — отключает auto_renewal
     """
-    while True:
-        try:
-            users = await db.get_users_for_auto_renewal()
-            if users:
-                log.info("auto_renewal_job: %d users to process", len(users))
+    try:
+        users = await db.get_users_for_auto_renewal()
+        if users:
+            log.info("auto_renewal_tick: %d users to process", len(users))
 
+        succeeded: list[int] = []
+        failed: list[int] = []
+        cancellations: list[tuple[int, str]] = []
+        try:
             for u in users:
                 uid = u["user_id"]
                 pm_id = u["payment_method_id"]
                 try:
                     amount_rub = f"{MONTH_PRICE}.00"
-                    phone = await db.get_user_phone(uid)
+                    phone = u["phone"]
 
                     receipt_data = {}
                     if phone:
@@ -1807,24 +2443,25 @@ async def auto_renewal_job():
                             except Exception:
                                 pass
 
+                    # ключ идемпотентности на период и попытку: повтор после таймаута/перезапуска
+                    # (failures не растёт) вернёт тот же платёж, а после отказа — новая попытка
                     payment = await asyncio.wait_for(
-                        asyncio.to_thread(partial(Payment.create, {
+                        _yookassa(partial(Payment.create, {
                             "amount": {"value": amount_rub, "currency": "RUB"},
                             "payment_method_id": pm_id,
                             "capture": True,
                             "description": f"Автопродление подписки, user_id={uid}",
                             "metadata": {"user_id": str(uid), "type": "auto_renewal"},
                             **receipt_data
-                        })),
-                        timeout=15
+                        }, f"renew:{uid}:{u['expires_at']}:{u['failures']}")),
+                        timeout=AUTO_RENEWAL_TIMEOUT
                     )
 
                     if payment.status == "succeeded":
-                        existing = await db.get_user(uid)
-                        base_expires = max(now_ts(), existing.expires_at if existing else 0)
-                        final_expires = base_expires + (PAID_DAYS + GRACE_DAYS) * 86400
-                        await db.set_user_expires(uid, final_expires, u.get("username"), u.get("full_name"))
-                        await db.reset_auto_renewal_failures(uid)
+                        await db.extend_user_expires(
+                            uid, (PAID_DAYS + GRACE_DAYS) * 86400, u.get("username"), u.get("full_name")
+                        )
+                        succeeded.append(uid)
                         await db.save_payment(uid, payment.id, MONTH_PRICE, "succeeded")
                         log.info("auto_renewal succeeded for user %s, payment %s", uid, payment.id)
 
@@ -1840,9 +2477,19 @@ async def auto_renewal_job():
                     else:
                         raise Exception(f"Payment status: {payment.status}")
 
+                except asyncio.TimeoutError:
+                    # исход неизвестен: SDK мог успеть списать. Неудачей не считаем (failures не растёт,
+                    # ключ тот же) и пользователю не пишем — следующий тик получит настоящий статус
+                    log.warning("auto_renewal timed out for user %s, outcome unknown", uid)
+                    await db.log_admin_event(
+                        "auto_renewal_unknown",
+                        f"Автосписание не ответило за {AUTO_RENEWAL_TIMEOUT} с, повторим тем же ключом",
+                        "warning",
+                        uid
+                    )
                 except Exception as e:
                     log.warning("auto_renewal failed for user %s: %s", uid, e)
-                    await db.increment_auto_renewal_failures(uid)
+                    failed.append(uid)
                     await db.log_admin_event(
                         "auto_renewal_failed",
                         f"Не удалось выполнить автосписание: {e}",
@@ -1850,10 +2497,10 @@ async def auto_renewal_job():
                         uid
                     )
 
-                    info = await db.get_auto_renewal_info(uid)
-                    if info["failures"] >= 2:
-                        await db.set_auto_renewal(uid, False)
-                        await db.save_cancellation(uid, "renewal_off_payment_failed")
+                    # счётчик из выборки + текущая неудача; в БД пишем пачкой в конце цикла,
+                    # там же increment_auto_renewal_failures_bulk выключает автопродление
+                    if u["failures"] + 1 >= 2:
+                        cancellations.append((uid, "renewal_off_payment_failed"))
                         log_cancellation(uid, "renewal_off_payment_failed")
                         try:
                             await bot.send_message(
@@ -1874,11 +2521,40 @@ async def auto_renewal_job():
                             pass
 
                 await asyncio.sleep(2)  # rate limit
+        finally:
+            await db.reset_auto_renewal_failures_bulk(succeeded)
+            await db.increment_auto_renewal_failures_bulk(failed)
+            await db.bulk_save_cancellations(cancellations)
 
-        except Exception as e:
-            log.error("auto_renewal_job error: %s", e)
+    except Exception as e:
+        log.error("auto_renewal_tick error: %s", e)
 
-        await asyncio.sleep(AUTO_RENEWAL_INTERVAL)
+
+# ---- Фоновые задачи: один планировщик вместо своего таймера у каждой ----
+BACKGROUND_JOBS = (
+    (CHECK_INTERVAL_SEC, subscription_tick),
+    (AUTO_RENEWAL_INTERVAL, auto_renewal_tick),
+)
+
+async def background_jobs():
+    """
+    Одна задача будит все периодические работы: спит до ближайшего срока,
+    запускает подошедшие. Работа, предыдущий запуск которой ещё идёт, пропускается.
+    """
+    loop = asyncio.get_running_loop()
+    due = [loop.time()] * len(BACKGROUND_JOBS)  # при старте — все сразу
+    running: list[Optional[asyncio.Task]] = [None] * len(BACKGROUND_JOBS)
+    while True:
+        now = loop.time()
+        for i, (period, job) in enumerate(BACKGROUND_JOBS):
+            if due[i] > now:
+                continue
+            due[i] = now + period
+            if running[i] is not None and not running[i].done():
+                log.warning("%s: previous run still in progress, skipping", job.__name__)
+                continue
+            running[i] = asyncio.create_task(job())
+        await asyncio.sleep(max(0.0, min(due) - loop.time()))
 
 
 # ---- Команда синхронизации для админов ----
@@ -1888,30 +2564,11 @@ async def admin_sync(m: Message):
         await m.answer("Команда доступна только админам.")
         return
 
-    processed_left = 0
-    processed_kicked = 0
-    skipped_admin = 0
-
     ids = await db.expired_user_ids(now_ts())
-    for uid in ids:
-        try:
-            member = await bot.get_chat_member(GROUP_ID, uid)
-            status = getattr(member, "status", None)
-        except Exception:
-            status = "left"
-
-        if status in ("left", "kicked", None):
-            await db.set_user_expires(uid, 0)
-            processed_left += 1
-            continue
-
-        if status in ("administrator", "creator"):
-            skipped_admin += 1
-            continue
-
-        if await ensure_user_removed(uid):
-            await db.set_user_expires(uid, 0)
-            processed_kicked += 1
+    counts = await sync_expired_users(ids)
+    processed_left = counts.get("left", 0)
+    processed_kicked = counts.get("kicked", 0)
+    skipped_admin = counts.get("admin", 0)
 
     await m.answer(
         "Синхронизация завершена:\n"
@@ -1921,17 +2578,20 @@ async def admin_sync(m: Message):
     )
 
 
+_REASON_LABELS: dict[str, str] = {
+    **CANCEL_REASONS_DICT,
+    "admin_revoke": "Отмена админом",
+    "payment_failed": "Не прошла оплата",
+}
+_REASON_PREFIX_LABELS = {
+    "renewal_off_": "Отключил автопродление",
+    "card_unlinked_": "Отвязал карту",
+    "immediate_cancel_": "Закрыл доступ сразу",
+}
+
 def _cancel_reason_title(reason: str) -> str:
-    labels = {key: title for title, key in CANCEL_REASONS}
-    labels["admin_revoke"] = "Отмена админом"
-    labels["payment_failed"] = "Не прошла оплата"
-    prefix_labels = {
-        "renewal_off": "Отключил автопродление",
-        "card_unlinked": "Отвязал карту",
-        "immediate_cancel": "Закрыл доступ сразу",
-    }
-    for prefix, title in prefix_labels.items():
-        full_prefix = f"{prefix}_"
+    labels = _REASON_LABELS
+    for full_prefix, title in _REASON_PREFIX_LABELS.items():
         if reason and reason.startswith(full_prefix):
             base = reason[len(full_prefix):]
             return f"{title}: {labels.get(base, base)}"
@@ -2025,7 +2685,6 @@ async def admin_recurring_cmd(m: Message):
     )
 
 
-@dp.callback_query(F.data == "admin_demo_autorenewal")
 async def admin_demo_autorenewal(cb: CallbackQuery):
     if not _is_admin_id(cb.from_user.id):
         await cb.answer("Только для админов", show_alert=True)
@@ -2047,7 +2706,6 @@ async def admin_demo_autorenewal(cb: CallbackQuery):
     )
 
 
-@dp.callback_query(F.data == "admin_demo_disable_reason")
 async def admin_demo_disable_reason(cb: CallbackQuery):
     if not _is_admin_id(cb.from_user.id):
         await cb.answer("Только для админов", show_alert=True)
@@ -2068,7 +2726,6 @@ async def admin_demo_disable_reason(cb: CallbackQuery):
     )
 
 
-@dp.callback_query(F.data == "admin_demo_disable_confirm")
 async def admin_demo_disable_confirm(cb: CallbackQuery):
     if not _is_admin_id(cb.from_user.id):
         await cb.answer("Только для админов", show_alert=True)
@@ -2086,7 +2743,6 @@ async def admin_demo_disable_confirm(cb: CallbackQuery):
     )
 
 
-@dp.callback_query(F.data == "admin_demo_disable_done")
 async def admin_demo_disable_done(cb: CallbackQuery):
     if not _is_admin_id(cb.from_user.id):
         await cb.answer("Только для админов", show_alert=True)
@@ -2100,7 +2756,6 @@ async def admin_demo_disable_done(cb: CallbackQuery):
     )
 
 
-@dp.callback_query(F.data == "admin_demo_unlink_reason")
 async def admin_demo_unlink_reason(cb: CallbackQuery):
     if not _is_admin_id(cb.from_user.id):
         await cb.answer("Только для админов", show_alert=True)
@@ -2121,7 +2776,6 @@ async def admin_demo_unlink_reason(cb: CallbackQuery):
     )
 
 
-@dp.callback_query(F.data == "admin_demo_unlink_confirm")
 async def admin_demo_unlink_confirm(cb: CallbackQuery):
     if not _is_admin_id(cb.from_user.id):
         await cb.answer("Только для админов", show_alert=True)
@@ -2139,7 +2793,6 @@ async def admin_demo_unlink_confirm(cb: CallbackQuery):
     )
 
 
-@dp.callback_query(F.data == "admin_demo_unlink_done")
 async def admin_demo_unlink_done(cb: CallbackQuery):
     if not _is_admin_id(cb.from_user.id):
         await cb.answer("Только для админов", show_alert=True)
@@ -2154,7 +2807,6 @@ async def admin_demo_unlink_done(cb: CallbackQuery):
     )
 
 
-@dp.callback_query(F.data == "admin_demo_noop")
 async def admin_demo_noop(cb: CallbackQuery):
     if _is_admin_id(cb.from_user.id):
         await cb.answer("Демо: данные не меняются")
@@ -2190,6 +2842,35 @@ async def admin_cancellations_cmd(m: Message):
     )
 
 
+def _write_export_csv(path: str, rows: list[tuple]):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(_CSV_HEADER)
+        w.writerows(
+            (iso_msk(created_at or 0), uid, f"@{username}" if username else "", full_name, extra)
+            for created_at, uid, username, full_name, extra in rows
+        )
+
+@dp.message(Command("export_csv"))
+async def export_csv_cmd(m: Message):
+    if not _is_admin_id(m.from_user.id):
+        await m.answer("Команда доступна только админам.")
+        return
+
+    stamp = datetime.now(MSK).strftime("%Y%m%d_%H%M")
+    for kind in ("starts", "payments", "cancellations"):
+        rows = await db.export_log_rows(kind)
+        path = os.path.join(EXPORT_DIR, f"{kind}_{stamp}.csv")
+        # запись файла — в отдельном потоке, чтобы не стопорить loop
+        await asyncio.to_thread(_write_export_csv, path, rows)
+        try:
+            await m.answer_document(FSInputFile(path), caption=f"{kind}: {len(rows)} строк")
+        except Exception as e:
+            log.warning("export_csv: send %s failed: %s", path, e)
+            await m.answer(f"Выгрузка {kind} сохранена на сервере: {path}")
+
+
 # ---- /myid: показать свой Telegram ID ----
 @dp.message(Command("myid"))
 async def myid_cmd(m: Message):
@@ -2236,13 +2917,20 @@ async def _do_comp(m: Message):
 
     await db.set_user_expires(uid, new_expires)
 
-    # Создаём одноразовую ссылку в группу, чтобы сразу выдать доступ вместе с уведомлением
-    link = await create_one_time_invite()
-    link_block = (
+    # Продление действующей подписки у участника группы — ссылка не нужна.
+    # Истёкших scheduler уже удалил из группы, их не проверяем.
+    in_group = is_active(old_expires) and await _is_in_group(uid)
+    # Иначе создаём одноразовую ссылку в группу, чтобы сразу выдать доступ вместе с уведомлением
+    link = None if in_group else await create_one_time_invite()
+    invite_text = (
         f"\n\n<b>Вход в группу:</b> {link}\nСсылка одноразовая, действует {INVITE_TTL_HOURS} часов."
-        if link else
-        "\n\nНе удалось создать ссылку приглашения (проверьте права бота в группе)."
+        if link else ""
+    )
+    link_block = invite_text or (
+        "" if in_group else "\n\nНе удалось создать ссылку приглашения (проверьте права бота в группе)."
     )
+    # одна строка даты и для пользователя, и для админа
+    dt_human = datetime.fromtimestamp(new_expires, MSK).strftime("%d.%m.%Y %H:%M")
 
     # Уведомляем пользователя
     try:
@@ -2251,7 +2939,7 @@ async def _do_comp(m: Message):
             (
                 "Ваша подписка продлена администратором на "
                 f"{days} дн. Новая дата истечения: "
-                f"{datetime.fromtimestamp(new_expires, MSK).strftime('%d.%m.%Y %H:%M')} MSK"
+                f"{dt_human} MSK"
                 + link_block
             )
         )
@@ -2261,7 +2949,6 @@ async def _do_comp(m: Message):
     # Ответ админу с итогами и (если получилось) ссылкой
     was_days = max(0, (old_expires - now) // 86400) if old_expires else 0
     now_days = max(0, (new_expires - now) // 86400)
-    dt_human = datetime.fromtimestamp(new_expires, MSK).strftime("%d.%m.%Y %H:%M")
 
     await m.answer(
         "✅ Подписка обновлена\n"
@@ -2270,24 +2957,15 @@ async def _do_comp(m: Message):
         f"Было: <b>{was_days}</b> дн.\n"
         f"Стало: <b>{now_days}</b> дн.\n"
         f"Истекает: <b>{dt_human} MSK</b>"
-        + (f"\n\n<b>Вход в группу:</b> {link}\nСсылка одноразовая, действует {INVITE_TTL_HOURS} часов." if link else "")
+        + invite_text
     )
 
-@dp.message(Command("comp"))
+# Command разбирает сам текст (entity bot_command не нужна), поэтому /comp, /COMP
+# и /comp@YourBodyPet_bot ловятся здесь без отдельного catch-all по F.text
+@dp.message(Command("comp", ignore_case=True))
 async def comp_cmd(m: Message):
-    # Основная ветка — когда Telegram корректно пометил сообщение как bot_command
     await _do_comp(m)
 
-# Fallback: если по какой-то причине entity bot_command отсутствует,
-# ловим обычный текст, начинающийся с /comp (или /comp@YourBodyPet_bot)
-@dp.message(F.text.as_("t"))
-async def comp_cmd_fallback(m: Message, t: Optional[str]):
-    if not t:
-        return
-    txt = t.strip()
-    if re.match(r"^/comp(\b|@)", txt, flags=re.IGNORECASE):
-        await _do_comp(m)
-
 # ---- /revoke: админ отменяет подписку пользователя ----
 @dp.message(Command("revoke"))
 async def revoke_subscription_cmd(m: Message):
@@ -2386,7 +3064,6 @@ async def autorenewal_cmd(m: Message):
 
     await m.answer(text, reply_markup=autorenewal_kb(info))
 
-@dp.callback_query(F.data == "autorenew_on")
 async def autorenew_on(cb: CallbackQuery):
     info = await db.get_auto_renewal_info(cb.from_user.id)
     if not info["has_payment_method"]:
@@ -2401,7 +3078,6 @@ async def autorenew_on(cb: CallbackQuery):
         "Отключить или отвязать карту можно командой /autorenewal."
     )
 
-@dp.callback_query(F.data == "autorenew_off")
 async def autorenew_off(cb: CallbackQuery):
     await cb.answer()
     await replace_with_text(
@@ -2411,7 +3087,6 @@ async def autorenew_off(cb: CallbackQuery):
         renewal_reasons_kb("disable")
     )
 
-@dp.callback_query(F.data == "autorenew_unlink")
 async def autorenew_unlink(cb: CallbackQuery):
     await cb.answer()
     await replace_with_text(
@@ -2421,7 +3096,6 @@ async def autorenew_unlink(cb: CallbackQuery):
         renewal_reasons_kb("unlink")
     )
 
-@dp.callback_query(F.data == "autorenew_keep")
 async def autorenew_keep(cb: CallbackQuery):
     await cb.answer("Хорошо!")
     info = await db.get_auto_renewal_info(cb.from_user.id)
@@ -2430,33 +3104,38 @@ async def autorenew_keep(cb: CallbackQuery):
 
 
 # ---- Команда /referral ----
-import string as _string
 import secrets as _secrets
 
-def _generate_referral_code(length: int = 6) -> str:
-    chars = _string.ascii_uppercase + _string.digits
-    return ''.join(_secrets.choice(chars) for _ in range(length))
+def _generate_referral_code(nbytes: int = 6) -> str:
+    # 48 бит энтропии → 8 символов [A-Za-z0-9_-], валидно для deep-link payload
+    return _secrets.token_urlsafe(nbytes)
 
 @dp.message(Command("referral"))
 async def referral_cmd(m: Message):
-    row = await db.get_user(m.from_user.id)
-    if not (row and is_active(row.expires_at)):
+    if not await db.has_active_sub(m.from_user.id):
         await m.answer("Реферальная программа доступна только для подписчиков. Оформите подписку: /start")
         return
 
     # Генерируем код если нет
     code = await db.get_referral_code(m.from_user.id)
     if not code:
-        for _ in range(10):
-            code = _generate_referral_code()
-            existing = await db.find_user_by_referral_code(code)
-            if not existing:
-                break
-        await db.set_referral_code(m.from_user.id, code)
+        # без предварительного SELECT: коллизию отсекает уникальный idx_users_refcode
+        for _ in range(5):
+            try:
+                code = await db.claim_referral_code(m.from_user.id, _generate_referral_code())
+            except aiosqlite.IntegrityError:
+                continue
+            if not code:
+                # код успели выставить параллельно — берём его
+                code = await db.get_referral_code(m.from_user.id)
+            break
+        if not code:
+            log.error("referral code generation failed for uid=%s", m.from_user.id)
+            await m.answer("Не удалось создать реферальную ссылку. Попробуйте ещё раз чуть позже: /referral")
+            return
 
     stats = await db.get_referral_stats(m.from_user.id)
-    bot_me = await bot.me()
-    ref_link = f"https://t.me/{bot_me.username}?start=ref_{code}"
+    ref_link = f"https://t.me/{await get_bot_username()}?start=ref_{code}"
 
     text = (
         "🎁 <b>Реферальная программа</b>\n\n"
@@ -2489,13 +3168,78 @@ except ImportError as e:
     log.warning("Habit tracker module not available: %s", e)
 
 # ---- Startup ----
+# ---- Маршрутизация callback-кнопок ----
+# Один хендлер вместо цепочки F.data-фильтров: ключ — callback_data целиком
+# либо префикс с двоеточием ("pay_check:"), если у кнопки есть аргумент.
+_CB_ROUTES = {
+    "show_formalities": show_formalities,
+    "agree_terms": agree_terms,
+    "cancel_warn": cancel_warn,
+    "cancel_reason": cancel_reason,
+    "cancel_reason:": cancel_reason_selected,
+    "cancel_keep": cancel_keep,
+    "renewal_start:": renewal_start,
+    "renewal_reason:": renewal_reason_selected,
+    "cancel_final:": cancel_final,
+    "renewal_final:": renewal_final,
+    "pay_start": pay_start,
+    "pay_check:": pay_check,
+    "admin_demo_autorenewal": admin_demo_autorenewal,
+    "admin_demo_disable_reason": admin_demo_disable_reason,
+    "admin_demo_disable_confirm": admin_demo_disable_confirm,
+    "admin_demo_disable_done": admin_demo_disable_done,
+    "admin_demo_unlink_reason": admin_demo_unlink_reason,
+    "admin_demo_unlink_confirm": admin_demo_unlink_confirm,
+    "admin_demo_unlink_done": admin_demo_unlink_done,
+    "admin_demo_noop": admin_demo_noop,
+    "autorenew_on": autorenew_on,
+    "autorenew_off": autorenew_off,
+    "autorenew_unlink": autorenew_unlink,
+    "autorenew_keep": autorenew_keep,
+}
+
+def _cb_key(data: str) -> str:
+    prefix, sep, _ = data.partition(":")
+    return prefix + sep
+
+async def _cb_route(cb: CallbackQuery):
+    handler = _CB_ROUTES.get(_cb_key(cb.data or ""))
+    return {"cb_handler": handler} if handler else False
+
+@dp.callback_query(_cb_route)
+async def route_callback(cb: CallbackQuery, cb_handler):
+    await cb_handler(cb)
+
+
+# Список команд бота (меню Telegram); команды habit tracker — только если модуль доступен
+BOT_COMMANDS: tuple[BotCommand, ...] = (
+    BotCommand(command="start", description="Начать"),
+    BotCommand(command="app", description="Открыть приложение"),
+    BotCommand(command="status", description="Статус подписки"),
+    BotCommand(command="autorenewal", description="Автопродление и карта"),
+    BotCommand(command="cancel_subscription", description="Управлять подпиской"),
+    BotCommand(command="comp", description="(admin) Выдать подписку"),
+    BotCommand(command="revoke", description="(admin) Отменить подписку пользователя"),
+    BotCommand(command="admin_stats", description="(admin) Операционная сводка"),
+    BotCommand(command="admin_web", description="(admin) Открыть админ-пульт"),
+    BotCommand(command="admin_cancellations", description="(admin) Отмены и причины"),
+    BotCommand(command="admin_recurring", description="(admin) Рекуррентные платежи"),
+    BotCommand(command="export_csv", description="(admin) Выгрузить CSV"),
+    BotCommand(command="myid", description="Показать мой ID"),
+    BotCommand(command="referral", description="Реферальная программа"),
+)
+HABIT_COMMANDS: tuple[BotCommand, ...] = (
+    BotCommand(command="habits", description="Ассистент привычек"),
+    BotCommand(command="food", description="Как добавить еду"),
+)
+
 async def on_startup():
     await db.connect()
     await db.init_schema()
-    asyncio.create_task(periodic_checks())
-    asyncio.create_task(auto_clean_expired())
-    asyncio.create_task(reminder_notifier())
-    asyncio.create_task(auto_renewal_job())
+    start_csv_writer()
+    if GROUP_ID:
+        await bot_can_restrict()
+    asyncio.create_task(background_jobs())
 
     # Инициализируем habit tracker если доступен
     if HABIT_TRACKER_ENABLED:
@@ -2507,26 +3251,7 @@ async def on_startup():
             log.error("Failed to initialize habit tracker: %s", e)
 
     # Обновляем список команд бота
-    commands = [
-        BotCommand(command="start", description="Начать"),
-        BotCommand(command="app", description="Открыть приложение"),
-        BotCommand(command="status", description="Статус подписки"),
-        BotCommand(command="autorenewal", description="Автопродление и карта"),
-        BotCommand(command="cancel_subscription", description="Управлять подпиской"),
-        BotCommand(command="comp", description="(admin) Выдать подписку"),
-        BotCommand(command="revoke", description="(admin) Отменить подписку пользователя"),
-        BotCommand(command="admin_stats", description="(admin) Операционная сводка"),
-        BotCommand(command="admin_web", description="(admin) Открыть админ-пульт"),
-        BotCommand(command="admin_cancellations", description="(admin) Отмены и причины"),
-        BotCommand(command="admin_recurring", description="(admin) Рекуррентные платежи"),
-        BotCommand(command="myid", description="Показать мой ID"),
-        BotCommand(command="referral", description="Реферальная программа"),
-    ]
-
-    # Добавляем команды habit tracker если доступен
-    if HABIT_TRACKER_ENABLED:
-        commands.append(BotCommand(command="habits", description="Ассистент привычек"))
-        commands.append(BotCommand(command="food", description="Как добавить еду"))
+    commands = list(BOT_COMMANDS + (HABIT_COMMANDS if HABIT_TRACKER_ENABLED else ()))
 
     try:
         await bot.set_my_commands(commands)
@@ -2546,12 +3271,19 @@ async def on_startup():
         except Exception as e:
             log.warning("set_chat_menu_button failed: %s", e)
 
+async def on_shutdown():
+    # Дописываем хвосты очередей записи перед выходом
+    await stop_csv_writer()
+    await db.close()
+    PAYMENT_POOL.shutdown(wait=False)
+
 def main():
     # Регистрируем обработчики habit tracker
     if HABIT_TRACKER_ENABLED:
         register_habit_handlers(dp)
 
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
     dp.run_polling(bot)
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-import os, sqlite3, time
+import asyncio, os, sqlite3, time
 from dotenv import load_dotenv
 from telethon import TelegramClient
 from telethon.errors import RPCError
@@ -12,37 +12,60 @@ DB_PATH  = os.getenv('DB_PATH', 'bot.db')
 
 assert API_ID and API_HASH and GROUP_ID, "API_ID/API_HASH/GROUP_ID должны быть заданы"
 
-now = int(time.time())
-# читаем все expires из БД
-con = sqlite3.connect(DB_PATH)
-cur = con.execute("SELECT user_id, COALESCE(expires_at,0) FROM users")
-expires = {row[0]: row[1] for row in cur.fetchall()}
-con.close()
 
-client = TelegramClient('audit_session', API_ID, API_HASH)
-client.start()  # при первом запуске спросит код подтверждения
-
-expired_in_db = {uid for uid, exp in expires.items() if exp == 0 or exp <= now}
+def _load_expired(db_path: str, now: int) -> set:
+    # истёкших отбирает сам SQLite (idx_users_expires создаёт бот); 0 и NULL — тоже истёкшие
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)  # только чтение
+    try:
+        con.execute("PRAGMA busy_timeout=5000;")  # бот может писать в это время
+        return {
+            row[0] for row in con.execute(
+                "SELECT user_id FROM users WHERE expires_at IS NULL OR expires_at <= ?", (now,)
+            )
+        }
+    finally:
+        con.close()
 
-print(f"[i] В БД истёкших: {len(expired_in_db)}. Проверяю, кто реально в чате…")
 
-still_in_chat = []
-async def main():
-    global still_in_chat
+async def _find_in_chat(client: TelegramClient, expired_in_db: set) -> list:
+    still_in_chat = []
+    if not expired_in_db:
+        return still_in_chat  # искать некого — участников не листаем вовсе
     try:
         async for p in client.iter_participants(GROUP_ID):
             if p.bot:
                 continue
             if p.id in expired_in_db:
                 still_in_chat.append((p.id, p.username or "", p.first_name or "", p.last_name or ""))
+                # все истёкшие уже нашлись — остальные страницы участников не запрашиваем
+                if len(still_in_chat) == len(expired_in_db):
+                    break
     except RPCError as e:
         print("[!] Telethon error:", e)
+    return still_in_chat
+
+
+async def main():
+    client = TelegramClient('audit_session', API_ID, API_HASH)
+    # выборка из SQLite идёт в потоке, пока клиент подключается к Telegram
+    # (при первом запуске start() спросит код подтверждения)
+    expired_in_db, _ = await asyncio.gather(
+        asyncio.to_thread(_load_expired, DB_PATH, int(time.time())),
+        client.start(),
+    )
+    try:
+        print(f"[i] В БД истёкших: {len(expired_in_db)}. Проверяю, кто реально в чате…")
+        still_in_chat = await _find_in_chat(client, expired_in_db)
+    finally:
+        await client.disconnect()
+
+    print(f"[✓] В чате найдено истёкших: {len(still_in_chat)}")
+    if still_in_chat:
+        # весь список — одной записью в stdout
+        print("\n".join(
+            ["user_id, username, first_name, last_name"]
+            + [f"{uid}, @{uname}, {fn}, {ln}" for uid, uname, fn, ln in still_in_chat]
+        ))
 
-with client:
-    client.loop.run_until_complete(main())
 
-print(f"[✓] В чате найдено истёкших: {len(still_in_chat)}")
-if still_in_chat:
-    print("user_id, username, first_name, last_name")
-    for uid, uname, fn, ln in still_in_chat:
-        print(f"{uid}, @{uname}, {fn}, {ln}")
+asyncio.run(main())
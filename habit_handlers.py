@@ -11,7 +11,8 @@ import base64
 import logging
 import os
 import re
-from datetime import datetime, timezone, timedelta
+import time
+from datetime import timezone, timedelta
 from typing import Optional
 
 from aiogram import Dispatcher, F
@@ -45,6 +46,47 @@ def webapp_url(path: str = "") -> str:
 
     return f"{base_url}{clean_path}"
 
+HABITS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(
+        text="✨ Открыть ассистент привычек",
+        web_app={"url": webapp_url()}
+    )]
+])
+
+# Vision-модели всё равно ужимают картинку примерно до 1024px по большей стороне
+VISION_MAX_SIDE = 1280
+
+
+def photo_for_vision(sizes):
+    """Самая крупная из копий фото, что не больше VISION_MAX_SIDE (иначе самая маленькая)"""
+    fitting = [p for p in sizes if max(p.width, p.height) <= VISION_MAX_SIDE]
+    return max(fitting, key=lambda p: p.width * p.height) if fitting else sizes[0]
+
+# Паттерны для определения, что текст похож на описание еды —
+# одна скомпилированная альтернатива вместо re.search по каждому паттерну
+FOOD_PATTERNS = [
+    r'^съел', r'^ел[аи]?', r'^поел', r'^обед', r'^завтрак', r'^ужин',
+    r'^перекус', r'^еда:', r'на завтрак', r'на обед', r'на ужин',
+    r'^каша', r'^салат', r'^суп', r'^курица', r'^рыба', r'^мясо',
+    r'^овощи', r'^фрукты', r'^творог', r'^йогурт', r'^яйц',
+]
+_FOOD_RE = re.compile("|".join(FOOD_PATTERNS))
+
+# Слова-продукты: ищем подстрокой, как раньше (ловит и «салатик», и «курицей»)
+FOOD_WORDS = ['салат', 'суп', 'каша', 'курица', 'рыба', 'мясо', 'овощи',
+              'творог', 'йогурт', 'яйца', 'хлеб', 'рис', 'гречка', 'макароны',
+              'сыр', 'молоко', 'кефир', 'фрукты', 'яблоко', 'банан']
+_FOOD_WORDS_RE = re.compile("|".join(map(re.escape, FOOD_WORDS)))
+
+
+def looks_like_food(text: str) -> bool:
+    """Похоже ли сообщение на описание еды."""
+    text_lower = text.lower().strip()
+    if _FOOD_RE.search(text_lower):
+        return True
+    # Также считаем едой если текст короткий и содержит слова-продукты
+    return len(text_lower.split()) <= 10 and bool(_FOOD_WORDS_RE.search(text_lower))
+
 # Database instance
 habit_db: Optional[HabitDB] = None
 
@@ -67,23 +109,15 @@ def register_habit_handlers(dp: Dispatcher):
     async def habits_command(m: Message):
         """Открыть веб-приложение ассистента привычек"""
         # Проверяем подписку (используем существующую функцию из app.py)
-        from app import db as main_db, is_active
+        from app import db as main_db
 
-        user = await main_db.get_user(m.from_user.id)
-        if not user or not is_active(user.expires_at):
+        if not await main_db.has_active_sub(m.from_user.id):
             await m.answer(
                 "Ассистент привычек доступен только с активной подпиской.\n"
                 "Нажми /start чтобы оформить доступ."
             )
             return
 
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text="✨ Открыть ассистент привычек",
-                web_app={"url": webapp_url()}
-            )]
-        ])
-
         await m.answer(
             "🌱 Ассистент привычек\n\n"
             "Помогает освоить полезные привычки без давления и подсчётов:\n"
@@ -91,7 +125,7 @@ def register_habit_handlers(dp: Dispatcher):
             "• Трекер сна\n"
             "• Вечерние итоги и недельные обзоры\n\n"
             "Нажми кнопку ниже:",
-            reply_markup=keyboard
+            reply_markup=HABITS_KB
         )
 
     @dp.message(Command("food"))
@@ -114,14 +148,8 @@ def register_habit_handlers(dp: Dispatcher):
         if not habit_db:
             return
 
-        # Проверяем, включён ли food tracker у пользователя
-        profile = await habit_db.get_user_profile(m.from_user.id)
-        if not profile or not profile.get('food_tracker_enabled'):
-            # Если food tracker не включён, игнорируем фото
-            return
-
-        # Проверяем подписку
-        if not await habit_db.is_subscription_active(m.from_user.id):
+        # Food tracker выключен или нет подписки — игнорируем фото
+        if not await habit_db.can_track_food(m.from_user.id):
             return
 
         await m.answer("📸 Анализирую фото...")
@@ -129,14 +157,19 @@ def register_habit_handlers(dp: Dispatcher):
         try:
             # Получаем фото максимального размера
             photo = m.photo[-1]
-            file = await m.bot.get_file(photo.file_id)
+            # для анализа хватает копии поменьше — её и качаем (в БД храним самую большую)
+            vision_photo = photo_for_vision(m.photo)
+            file = await m.bot.get_file(vision_photo.file_id)
             file_path = file.file_path
 
             # Скачиваем файл
             from aiogram import Bot
             bot: Bot = m.bot
             file_bytes = await bot.download_file(file_path)
-            photo_base64 = base64.b64encode(file_bytes.read()).decode('utf-8')
+            # getbuffer() — вид на буфер BytesIO без копии фото в отдельный bytes
+            raw = file_bytes.getbuffer() if hasattr(file_bytes, 'getbuffer') else file_bytes.read()
+            # base64 для фото в несколько МБ — в потоке, чтобы не держать event loop
+            photo_base64 = await asyncio.to_thread(lambda: base64.b64encode(raw).decode('ascii'))
 
             # Анализируем через LLM
             analysis = await analyze_food_photo(photo_base64, m.caption)
@@ -167,47 +200,20 @@ def register_habit_handlers(dp: Dispatcher):
 
     # ============ Обработка текста как еды ============
 
-    # Паттерны для определения, что текст похож на описание еды
-    FOOD_PATTERNS = [
-        r'^съел', r'^ел[аи]?', r'^поел', r'^обед', r'^завтрак', r'^ужин',
-        r'^перекус', r'^еда:', r'на завтрак', r'на обед', r'на ужин',
-        r'^каша', r'^салат', r'^суп', r'^курица', r'^рыба', r'^мясо',
-        r'^овощи', r'^фрукты', r'^творог', r'^йогурт', r'^яйц',
-    ]
-
-    @dp.message(F.text)
+    # Команды сюда не попадают вовсе — их отсекает фильтр
+    @dp.message(F.text, ~F.text.startswith('/'))
     async def handle_text(m: Message):
         """Обработать текст как еду если похоже на описание"""
         global habit_db
         if not habit_db:
             return
 
-        # Игнорируем команды
-        if m.text.startswith('/'):
-            return
-
-        # Проверяем, включён ли food tracker
-        profile = await habit_db.get_user_profile(m.from_user.id)
-        if not profile or not profile.get('food_tracker_enabled'):
+        # Сначала дешёвая проверка текста — до запросов в БД
+        if not looks_like_food(m.text):
             return
 
-        # Проверяем подписку
-        if not await habit_db.is_subscription_active(m.from_user.id):
-            return
-
-        # Проверяем, похож ли текст на описание еды
-        text_lower = m.text.lower().strip()
-        is_food = any(re.search(pattern, text_lower) for pattern in FOOD_PATTERNS)
-
-        # Также считаем едой если текст короткий и содержит слова-продукты
-        food_words = ['салат', 'суп', 'каша', 'курица', 'рыба', 'мясо', 'овощи',
-                      'творог', 'йогурт', 'яйца', 'хлеб', 'рис', 'гречка', 'макароны',
-                      'сыр', 'молоко', 'кефир', 'фрукты', 'яблоко', 'банан']
-
-        if not is_food and len(text_lower.split()) <= 10:
-            is_food = any(word in text_lower for word in food_words)
-
-        if not is_food:
+        # Food tracker включён и подписка активна — один запрос
+        if not await habit_db.can_track_food(m.from_user.id):
             return
 
         try:
@@ -274,10 +280,91 @@ def register_habit_handlers(dp: Dispatcher):
 
 # ============ Планировщик уведомлений ============
 
+# Клавиатуры уведомлений одинаковы для всех пользователей — собираем один раз
+SLEEP_QUESTION_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="😴 1", callback_data="sleep:1"),
+        InlineKeyboardButton(text="😕 2", callback_data="sleep:2"),
+        InlineKeyboardButton(text="😐 3", callback_data="sleep:3"),
+        InlineKeyboardButton(text="🙂 4", callback_data="sleep:4"),
+        InlineKeyboardButton(text="😊 5", callback_data="sleep:5"),
+    ]
+])
+EVENING_SUMMARY_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(
+        text="📊 Посмотреть итог",
+        web_app={"url": webapp_url("/summary")}
+    )]
+])
+WEEKLY_REVIEW_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(
+        text="📈 Посмотреть обзор",
+        web_app={"url": webapp_url("/weekly")}
+    )]
+])
+
+
+# Сколько пропущенных минут догонять, если тик запоздал (долгая отправка, подвисание)
+NOTIFY_CATCHUP_MIN = 5
+
+
+async def _notification_tick(bot, now_ts: int):
+    """Отправить все уведомления, назначенные на минуту now_ts"""
+    # ---- Утренние вопросы о сне ----
+    # только те, у кого сейчас локальное время вопроса и нет оценки сна за сегодня
+    for user_data in await habit_db.get_morning_notification_batch(now_ts):
+        user_id = user_data['user_id']
+        try:
+            await bot.send_message(
+                user_id,
+                "☀️ Доброе утро!\n\nКак ты сегодня спал(а)?",
+                reply_markup=SLEEP_QUESTION_KB
+            )
+            log.info(f"Sent morning sleep question to {user_id} (local time: {user_data['local_time']})")
+        except Exception as e:
+            log.warning(f"Failed to send sleep question to {user_id}: {e}")
+
+    # ---- Вечерние итоги ----
+    # только те, у кого сейчас локальное время итога и есть записи о еде за сегодня
+    for user_data in await habit_db.get_evening_notification_batch(now_ts):
+        user_id = user_data['user_id']
+        # Генерируем итог если нужно
+        if not user_data['has_summary']:
+            summary = await generate_daily_summary(user_data['food_entries'], user_data['goal'])
+            await habit_db.save_daily_summary(user_id, user_data['date'], summary)
+
+        try:
+            await bot.send_message(
+                user_id,
+                "🌙 Твой вечерний итог готов!\n\n"
+                "Посмотри, как прошёл день с точки зрения питания.",
+                reply_markup=EVENING_SUMMARY_KB
+            )
+            log.info(f"Sent evening summary to {user_id} (local time: {user_data['local_time']})")
+        except Exception as e:
+            log.warning(f"Failed to send evening summary to {user_id}: {e}")
+
+    # ---- Недельные обзоры (воскресенье в 12:00 по локальному времени пользователя) ----
+    for user_data in await habit_db.get_weekly_review_batch(now_ts):
+        user_id = user_data['user_id']
+        try:
+            await bot.send_message(
+                user_id,
+                "📊 Недельный обзор готов!\n\n"
+                "Посмотри паттерны и связи за прошедшую неделю.",
+                reply_markup=WEEKLY_REVIEW_KB
+            )
+            log.info(f"Sent weekly review to {user_id} (local time: {user_data['local_time']})")
+        except Exception as e:
+            log.warning(f"Failed to send weekly review to {user_id}: {e}")
+
+
 async def notification_scheduler(bot):
     """
     Планировщик уведомлений.
-    Запускается как asyncio task и проверяет каждую минуту.
+    Запускается как asyncio task и просыпается в начале каждой минуты.
+    Кому и что отправлять, выбирает SQLite: по одному запросу на тип уведомления за тик.
+    Минуты, пропущенные из-за долгого тика, догоняются (не больше NOTIFY_CATCHUP_MIN).
     """
     global habit_db
     if not habit_db:
@@ -285,128 +372,18 @@ async def notification_scheduler(bot):
         return
 
     log.info("Notification scheduler started")
+    last_minute = int(time.time()) // 60 * 60 - 60
     while True:
-        try:
-            # Получаем текущее UTC время
-            now_utc = datetime.now(timezone.utc)
-
-            # ---- Утренние вопросы о сне ----
-            morning_users = await habit_db.get_users_for_notification('morning')
-            for user_data in morning_users:
-                user_id = user_data['user_id']
-                notification_time = user_data['notification_time']  # '10:00'
-                timezone_offset = user_data['timezone_offset']  # 180 для MSK, 240 для Dubai, и т.д.
-
-                # Вычисляем локальное время пользователя
-                user_tz = timezone(timedelta(minutes=timezone_offset))
-                user_local_time = now_utc.astimezone(user_tz)
-                user_current_time = user_local_time.strftime('%H:%M')
-                user_today = user_local_time.strftime('%Y-%m-%d')
-
-                # Проверяем, совпадает ли текущее локальное время с настройкой
-                if user_current_time == notification_time:
-                    existing = await habit_db.get_sleep_entry(user_id, user_today)
-                    if existing is None:
-                        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                            [
-                                InlineKeyboardButton(text="😴 1", callback_data="sleep:1"),
-                                InlineKeyboardButton(text="😕 2", callback_data="sleep:2"),
-                                InlineKeyboardButton(text="😐 3", callback_data="sleep:3"),
-                                InlineKeyboardButton(text="🙂 4", callback_data="sleep:4"),
-                                InlineKeyboardButton(text="😊 5", callback_data="sleep:5"),
-                            ]
-                        ])
-                        try:
-                            await bot.send_message(
-                                user_id,
-                                "☀️ Доброе утро!\n\nКак ты сегодня спал(а)?",
-                                reply_markup=keyboard
-                            )
-                            log.info(f"Sent morning sleep question to {user_id} (local time: {user_current_time})")
-                        except Exception as e:
-                            log.warning(f"Failed to send sleep question to {user_id}: {e}")
-
-            # ---- Вечерние итоги ----
-            evening_users = await habit_db.get_users_for_notification('evening')
-            for user_data in evening_users:
-                user_id = user_data['user_id']
-                notification_time = user_data['notification_time']  # '21:00'
-                timezone_offset = user_data['timezone_offset']
-
-                # Вычисляем локальное время пользователя
-                user_tz = timezone(timedelta(minutes=timezone_offset))
-                user_local_time = now_utc.astimezone(user_tz)
-                user_current_time = user_local_time.strftime('%H:%M')
-                user_today = user_local_time.strftime('%Y-%m-%d')
-
-                # Проверяем, совпадает ли текущее локальное время с настройкой
-                if user_current_time == notification_time:
-                    food_entries = await habit_db.get_food_entries_for_date(user_id, user_today)
-
-                    if food_entries:
-                        # Генерируем итог если нужно
-                        existing_summary = await habit_db.get_daily_summary(user_id, user_today)
-                        if not existing_summary:
-                            profile = await habit_db.get_user_profile(user_id)
-                            user_goal = profile.get('goal', 'maintain') if profile else 'maintain'
-                            summary = await generate_daily_summary(food_entries, user_goal)
-                            await habit_db.save_daily_summary(user_id, user_today, summary)
-
-                        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(
-                                text="📊 Посмотреть итог",
-                                web_app={"url": webapp_url("/summary")}
-                            )]
-                        ])
-                        try:
-                            await bot.send_message(
-                                user_id,
-                                "🌙 Твой вечерний итог готов!\n\n"
-                                "Посмотри, как прошёл день с точки зрения питания.",
-                                reply_markup=keyboard
-                            )
-                            log.info(f"Sent evening summary to {user_id} (local time: {user_current_time})")
-                        except Exception as e:
-                            log.warning(f"Failed to send evening summary to {user_id}: {e}")
-
-            # ---- Недельные обзоры (воскресенье в 12:00 по локальному времени пользователя) ----
-            weekly_users = await habit_db.get_users_for_weekly_review()
-            for user_id in weekly_users:
-                # Получаем timezone_offset пользователя
-                profile = await habit_db.get_user_profile(user_id)
-                if not profile:
-                    continue
-
-                timezone_offset = profile.get('timezone_offset', 180)
-                user_tz = timezone(timedelta(minutes=timezone_offset))
-                user_local_time = now_utc.astimezone(user_tz)
-                user_current_time = user_local_time.strftime('%H:%M')
-                user_weekday = user_local_time.weekday()
-
-                # Проверяем: воскресенье и 12:00 по локальному времени
-                if user_weekday == 6 and user_current_time == "12:00":
-                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(
-                            text="📈 Посмотреть обзор",
-                            web_app={"url": webapp_url("/weekly")}
-                        )]
-                    ])
-                    try:
-                        await bot.send_message(
-                            user_id,
-                            "📊 Недельный обзор готов!\n\n"
-                            "Посмотри паттерны и связи за прошедшую неделю.",
-                            reply_markup=keyboard
-                        )
-                        log.info(f"Sent weekly review to {user_id} (local time: {user_current_time})")
-                    except Exception as e:
-                        log.warning(f"Failed to send weekly review to {user_id}: {e}")
-
-        except Exception as e:
-            log.error(f"Notification scheduler error: {e}")
-
-        # Ждём 60 секунд до следующей проверки
-        await asyncio.sleep(60)
+        minute = int(time.time()) // 60 * 60
+        for minute_ts in range(max(last_minute + 60, minute - 60 * NOTIFY_CATCHUP_MIN), minute + 60, 60):
+            try:
+                await _notification_tick(bot, minute_ts)
+            except Exception as e:
+                log.error(f"Notification scheduler error: {e}")
+        last_minute = max(last_minute, minute)
+
+        # Спим до начала следующей минуты
+        await asyncio.sleep(60 - time.time() % 60)
 
 
 def start_notification_scheduler(bot):
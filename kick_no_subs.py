@@ -4,6 +4,7 @@ from aiogram import Bot
 from aiogram.client.session.aiohttp import AiohttpSession
 from datetime import datetime, timezone
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,30 +16,44 @@ DB_PATH = os.getenv("DB_PATH", "bot.db")
 session = AiohttpSession(proxy="socks5://127.0.0.1:1080")
 bot = Bot(BOT_TOKEN, session=session)
 
+KICK_CONCURRENCY = 20  # одновременных ban+unban
+
+async def _kick_one(sem: asyncio.Semaphore, uid: int) -> Optional[str]:
+    """None — кикнут, иначе текст ошибки (печатаем одним отчётом в конце)"""
+    async with sem:
+        try:
+            await bot.ban_chat_member(GROUP_ID, uid, until_date=int(datetime.now(timezone.utc).timestamp()) + 60)
+            await bot.unban_chat_member(GROUP_ID, uid)
+            return None
+        except Exception as e:
+            return str(e)
+
 async def kick_no_subs():
     print("🔍 Проверяем базу...")
-    conn = await aiosqlite.connect(DB_PATH)
-    cur = await conn.execute("SELECT user_id, username, expires_at FROM users")
-    rows = await cur.fetchall()
-    await conn.close()
+    # без подписки (expires_at NULL или 0) отбирает сам SQLite
+    async with aiosqlite.connect(f"file:{DB_PATH}?mode=ro", uri=True) as conn:  # только чтение
+        async with conn.execute(
+            "SELECT user_id, username FROM users WHERE expires_at IS NULL OR expires_at = 0"
+        ) as cur:
+            rows = await cur.fetchall()
 
     total = len(rows)
-    print(f"📦 Всего пользователей в базе: {total}")
-
-    kicked = 0
-    skipped = 0
-
-    for uid, username, expires_at in rows:
-        if not expires_at or expires_at == 0:
-            try:
-                await bot.ban_chat_member(GROUP_ID, uid, until_date=int(datetime.now(timezone.utc).timestamp()) + 60)
-                await bot.unban_chat_member(GROUP_ID, uid)
-                kicked += 1
-                print(f"❌ Кикнут @{username or uid}")
-            except Exception as e:
-                print(f"⚠️ Не удалось кикнуть @{username or uid}: {e}")
-                skipped += 1
-
-    print(f"\n✅ Готово. Кикнуто: {kicked}, пропущено: {skipped}, всего проверено: {total}")
+    print(f"📦 Пользователей без подписки в базе: {total}")
+
+    # запросы к Telegram идут параллельно, но не больше KICK_CONCURRENCY сразу
+    sem = asyncio.Semaphore(KICK_CONCURRENCY)
+    results = await asyncio.gather(
+        *(_kick_one(sem, uid) for uid, _ in rows),
+        return_exceptions=True,
+    )
+    kicked = [f"@{username or uid}" for (uid, username), r in zip(rows, results) if r is None]
+    failed = [f"⚠️ Не удалось кикнуть @{username or uid}: {r}"
+              for (uid, username), r in zip(rows, results) if r is not None]
+
+    if kicked:
+        print("❌ Кикнуты: " + ", ".join(kicked))
+    if failed:
+        print("\n".join(failed))
+    print(f"\n✅ Готово. Кикнуто: {len(kicked)}, пропущено: {len(failed)}, всего проверено: {total}")
 
 asyncio.run(kick_no_subs())
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Migration script to add hunger_before and fullness_after columns to food_entries table
-Run this on the server: python3 migrate_hunger_fullness.py
+Run this on the server: python3 migrate_hunger_fullness.py [--verbose]
 """
 
 import sqlite3
@@ -10,6 +10,7 @@ import sys
 
 # Database path
 DB_PATH = os.getenv("DB_PATH", "/opt/yourbody-pro/bot.db")
+VERBOSE = "--verbose" in sys.argv
 
 def migrate():
     print(f"Connecting to database: {DB_PATH}")
@@ -19,6 +20,9 @@ def migrate():
         sys.exit(1)
 
     conn = sqlite3.connect(DB_PATH)
+    # бот работает параллельно: WAL + ожидание блокировки вместо "database is locked"
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
     cursor = conn.cursor()
 
     try:
@@ -28,6 +32,10 @@ def migrate():
 
         needs_migration = False
 
+        # Обе колонки — в одной транзакции: упадёт посередине — не останется половины.
+        # (sqlite3 сам BEGIN перед DDL не ставит, без него каждый ALTER коммитится отдельно)
+        cursor.execute("BEGIN")
+
         if 'hunger_before' not in columns:
             print("Adding hunger_before column to food_entries...")
             cursor.execute("""
@@ -44,8 +52,8 @@ def migrate():
             """)
             needs_migration = True
 
+        conn.commit()
         if needs_migration:
-            conn.commit()
             print("✓ Migration completed successfully!")
         else:
             print("✓ Columns already exist, no migration needed")
@@ -57,10 +65,11 @@ def migrate():
         if 'hunger_before' in columns and 'fullness_after' in columns:
             print("✓ Verified: hunger_before and fullness_after columns exist")
 
-            # Show current food entries count
-            cursor.execute("SELECT COUNT(*) FROM food_entries")
-            count = cursor.fetchone()[0]
-            print(f"✓ {count} existing food entries (can be updated with hunger/fullness ratings)")
+            # COUNT(*) — полный проход по таблице, на большой базе считаем только по --verbose
+            if VERBOSE:
+                cursor.execute("SELECT COUNT(*) FROM food_entries")
+                count = cursor.fetchone()[0]
+                print(f"✓ {count} existing food entries (can be updated with hunger/fullness ratings)")
         else:
             print("✗ ERROR: Columns were not added")
             sys.exit(1)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Migration script to add timezone_offset column to user_profiles table
-Run this on the server: python3 migrate_timezone.py
+Run this on the server: python3 migrate_timezone.py [--verbose]
 """
 
 import sqlite3
@@ -10,6 +10,7 @@ import sys
 
 # Database path
 DB_PATH = os.getenv("DB_PATH", "/opt/yourbody-pro/bot.db")
+VERBOSE = "--verbose" in sys.argv
 
 def migrate():
     print(f"Connecting to database: {DB_PATH}")
@@ -19,6 +20,9 @@ def migrate():
         sys.exit(1)
 
     conn = sqlite3.connect(DB_PATH)
+    # бот работает параллельно: WAL + ожидание блокировки вместо "database is locked"
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
     cursor = conn.cursor()
 
     try:
@@ -48,10 +52,11 @@ def migrate():
         if 'timezone_offset' in columns:
             print("✓ Verified: timezone_offset column exists")
 
-            # Show current user count
-            cursor.execute("SELECT COUNT(*) FROM user_profiles")
-            count = cursor.fetchone()[0]
-            print(f"✓ {count} existing user profiles will use default timezone (MSK +3)")
+            # COUNT(*) — полный проход по таблице, на большой базе считаем только по --verbose
+            if VERBOSE:
+                cursor.execute("SELECT COUNT(*) FROM user_profiles")
+                count = cursor.fetchone()[0]
+                print(f"✓ {count} existing user profiles will use default timezone (MSK +3)")
         else:
             print("✗ ERROR: Column was not added")
             sys.exit(1)
@@ -1,9 +1,9 @@
 import os, sqlite3, time
 from datetime import datetime, timezone
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
-from yookassa import Configuration, Payment
 
 # === Конфиг из .env ===
 load_dotenv()
@@ -12,13 +12,13 @@ SHOP_SECRET_KEY = os.getenv("SHOP_SECRET_KEY")
 DB_PATH = os.getenv("DB_PATH") or "bot.db"
 PAID_DAYS = int(os.getenv("PAID_DAYS") or 30)
 GRACE_DAYS = int(os.getenv("GRACE_DAYS") or 1)
+# платежи раньше SYNC_SINCE тянутся одним окном, дальше — помесячно в YK_WORKERS потоков
+SYNC_SINCE = os.getenv("SYNC_SINCE") or "2025-01-01"
+YK_WORKERS = int(os.getenv("YK_WORKERS") or 4)
 
 if not SHOP_ID or not SHOP_SECRET_KEY:
     raise SystemExit("SHOP_ID / SHOP_SECRET_KEY не заданы в .env")
 
-Configuration.account_id = SHOP_ID
-Configuration.secret_key = SHOP_SECRET_KEY
-
 paid_sec  = PAID_DAYS * 86400
 grace_sec = GRACE_DAYS * 86400
 
@@ -27,13 +27,21 @@ def to_ts(iso_str: str) -> int:
     dt = datetime.fromisoformat(s)
     return int(dt.astimezone(timezone.utc).timestamp())
 
-def fetch_all_succeeded():
+def _fetch_window(gte: str | None, lt: str | None):
     """
-    Возвращает список платежей со статусом succeeded.
+    Успешные платежи с created_at в [gte, lt) — одна цепочка курсоров.
     Каждый элемент: (user_id:int, created_ts:int)
     """
+    from yookassa import Payment  # уже загружен в fetch_all_succeeded
+
     out = []
-    params = {"limit": 100}
+    # статус фильтрует сам API ЮKassa — неуспешные платежи не листаем вовсе
+    base = {"limit": 100, "status": "succeeded"}
+    if gte:
+        base["created_at.gte"] = gte
+    if lt:
+        base["created_at.lt"] = lt
+    params = base
     while True:
         page = Payment.list(params)
         items = getattr(page, "items", []) or []
@@ -54,9 +62,37 @@ def fetch_all_succeeded():
         cursor = getattr(page, "next_cursor", None)
         if not cursor:
             break
-        params = {"limit": 100, "cursor": cursor}
+        params = {**base, "cursor": cursor}
     return out
 
+def _month_windows(since: datetime, until: datetime):
+    """[(gte, lt)] помесячно от since; первое окно — всё до since, последнее — без верхней границы"""
+    iso = lambda dt: dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    bounds = [since]
+    while bounds[-1] < until:
+        d = bounds[-1]
+        bounds.append(d.replace(year=d.year + d.month // 12, month=d.month % 12 + 1))
+    edges = [None] + [iso(b) for b in bounds[:-1]] + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+def fetch_all_succeeded():
+    """
+    Возвращает список платежей со статусом succeeded.
+    Каждый элемент: (user_id:int, created_ts:int)
+    Курсор следующей страницы известен только после текущей, поэтому параллелим
+    не страницы, а непересекающиеся помесячные окна по created_at.
+    """
+    # SDK ЮKassa тяжёлый — грузим только когда действительно идём в API
+    from yookassa import Configuration
+    Configuration.account_id = SHOP_ID
+    Configuration.secret_key = SHOP_SECRET_KEY
+
+    since = datetime.fromisoformat(SYNC_SINCE).replace(tzinfo=timezone.utc)
+    windows = _month_windows(since, datetime.now(timezone.utc))
+    with ThreadPoolExecutor(max_workers=YK_WORKERS) as ex:
+        pages = ex.map(lambda w: _fetch_window(*w), windows)
+        return [pay for window in pages for pay in window]
+
 def recompute_expiry(payments):
     """
     payments: list[(uid, ts)]
@@ -87,6 +123,11 @@ def main():
     print(f"→ Пользователей с платежами: {len(mapping)}")
 
     con = sqlite3.connect(DB_PATH)
+    # те же настройки, что у бота (DB.connect в app.py): пишем, не блокируя его читателей
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=NORMAL;")
+    con.execute("PRAGMA busy_timeout=5000;")
+    con.execute("PRAGMA temp_store=MEMORY;")
     cur = con.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -97,25 +138,33 @@ def main():
     )
     """)
 
-    updated = 0
-    inserted = 0
-    for uid, new_exp in mapping.items():
-        row = cur.execute("SELECT expires_at FROM users WHERE user_id=?", (uid,)).fetchone()
-        if row:
-            old_exp = row[0] or 0
-            eff = max(old_exp, new_exp)
-            cur.execute("UPDATE users SET expires_at=? WHERE user_id=?", (eff, uid))
-            updated += 1
-        else:
-            cur.execute("INSERT INTO users(user_id, expires_at) VALUES(?,?)", (uid, new_exp))
-            inserted += 1
+    # индекс под ORDER BY expires_at ниже (бот создаёт такой же)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_expires ON users(expires_at)")
+
+    # один UPSERT на всех в одной транзакции; срок только продлеваем, не уменьшаем
+    before = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    cur.executemany(
+        """
+        INSERT INTO users(user_id, expires_at) VALUES(?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            expires_at = MAX(COALESCE(users.expires_at, 0), excluded.expires_at)
+        """,
+        mapping.items(),
+    )
+    inserted = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0] - before
+    updated = len(mapping) - inserted
 
     con.commit()
+    # отчёт берём тем же соединением, без запуска sqlite3 CLI
+    nearest = cur.execute(
+        "SELECT user_id, expires_at FROM users WHERE expires_at>0 ORDER BY expires_at ASC LIMIT 10"
+    ).fetchall()
     con.close()
 
     print(f"✓ Готово. Обновлено: {updated}, добавлено: {inserted}")
     print("Топ 10 ближайших окончаний (локальное время сервера):")
-    os.system(f'''sqlite3 "{DB_PATH}" "SELECT user_id, datetime(expires_at,'unixepoch','localtime') FROM users WHERE expires_at>0 ORDER BY expires_at ASC LIMIT 10;"''')
+    for uid, exp in nearest:
+        print(f"{uid}|{datetime.fromtimestamp(exp).strftime('%Y-%m-%d %H:%M:%S')}")
 
 if __name__ == "__main__":
     main()
@@ -9,6 +9,8 @@ import sqlite3
 import time
 
 from telethon import TelegramClient, errors
+from telethon.tl.functions.channels import EditBannedRequest
+from telethon.tl.types import ChannelParticipantAdmin, ChannelParticipantCreator, ChatBannedRights
 
 # --- окружение ---
 API_ID = int(os.environ["TG_API_ID"])
@@ -16,6 +18,8 @@ API_HASH = os.environ["TG_API_HASH"]
 GROUP_ID = int(os.environ["GROUP_ID"])          # пример: -1002862714592
 DB_PATH = os.environ.get("DB_PATH", "bot.db")   # пример: /opt/tg-bot/bot.db
 SESSION_FILE = "tools/audit.session"            # сохраняем логин тут
+SOFT_BAN_SEC = 60                               # через сколько бан снимается сам
+KICK_ATTEMPTS = 3                               # попыток на пользователя при FLOOD_WAIT
 
 def now_ts() -> int:
     return int(time.time())
@@ -25,31 +29,44 @@ def load_active_user_ids(db_path: str) -> set[int]:
     Возвращает set user_id, у кого expires_at в будущем (строго активные).
     Все остальные считаются НЕ активными.
     """
-    con = sqlite3.connect(db_path)
+    # только чтение: shared-блокировка, писателю-боту не мешаем
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
     try:
-        cur = con.cursor()
-        cur.execute("SELECT user_id FROM users WHERE expires_at > ?", (now_ts(),))
-        return {int(r[0]) for r in cur.fetchall()}
+        con.execute("PRAGMA busy_timeout=5000;")  # бот может писать в это время
+        # строки идут прямо из курсора, без промежуточного списка; фильтр по expires_at
+        # покрывает idx_users_expires (user_id — rowid, в индексе он уже есть)
+        return {
+            int(r[0]) for r in con.execute(
+                "SELECT user_id FROM users WHERE expires_at > ?", (now_ts(),)
+            )
+        }
     finally:
         con.close()
 
 async def kick_soft(client: TelegramClient, uid: int) -> bool:
     """
-    Мягкий кик: бан (view_messages=False) + мгновенный разбан (view_messages=True),
-    чтобы можно было вернуться по новой инвайт-ссылке.
+    Мягкий кик одним запросом: бан на просмотр с истечением через SOFT_BAN_SEC —
+    Telegram удаляет из группы, а после срока можно вернуться по новой инвайт-ссылке.
+    (Срок < 30 с Telegram считает вечным баном, поэтому берём минуту, как бот.)
     """
-    try:
-        # ban
-        await client.edit_permissions(GROUP_ID, uid, view_messages=False)
-        await asyncio.sleep(0.2)
-        # unban (разбан)
-        await client.edit_permissions(GROUP_ID, uid, view_messages=True)
-        return True
-    except (errors.UserAdminInvalidError, errors.ChatAdminRequiredError):
-        return False
-    except Exception as e:
-        print(f"[ERR] kick {uid}: {e}")
-        return False
+    for _ in range(KICK_ATTEMPTS):
+        try:
+            await client(EditBannedRequest(
+                GROUP_ID, uid,
+                ChatBannedRights(until_date=now_ts() + SOFT_BAN_SEC, view_messages=True),
+            ))
+            return True
+        except errors.FloodWaitError as e:
+            # короткие FLOOD_WAIT Telethon отсыпает сам; длинные — ждём ровно сколько сказали и повторяем
+            print(f"[i] FLOOD_WAIT {e.seconds}s на {uid}")
+            await asyncio.sleep(e.seconds + 1)
+        except (errors.UserAdminInvalidError, errors.ChatAdminRequiredError):
+            return False
+        except Exception as e:
+            print(f"[ERR] kick {uid}: {e}")
+            return False
+    print(f"[ERR] kick {uid}: FLOOD_WAIT {KICK_ATTEMPTS} раза подряд, пропускаем")
+    return False
 
 async def main():
     active = load_active_user_ids(DB_PATH)
@@ -72,7 +89,12 @@ async def main():
         if uid in active:
             continue
 
-        # Пробуем бан/разбан, а если это админ — поймаем исключение и пропустим
+        # Админов видно прямо в списке участников — их не трогаем и запросов не тратим
+        if isinstance(getattr(user, "participant", None), (ChannelParticipantAdmin, ChannelParticipantCreator)):
+            skipped_admin += 1
+            continue
+
+        # Пробуем мягкий кик, а если это админ — поймаем исключение и пропустим
         ok = await kick_soft(client, uid)
         if ok:
             kicked += 1
@@ -82,10 +104,7 @@ async def main():
             skipped_error += 1
             print(f"[SKIP] не удалось кикнуть: {uid} @{getattr(user, 'username', '')}")
 
-        # Чуть-чуть замедлимся, чтобы не ловить FLOOD_WAIT
-        await asyncio.sleep(0.4)
-
-    print(f"[done] Кикнуто: {kicked}, пропущено(ошибки/админы): {skipped_error}, админов (по ошибкам): {skipped_admin}")
+    print(f"[done] Кикнуто: {kicked}, пропущено(ошибки/админы): {skipped_error}, админов: {skipped_admin}")
     await client.disconnect()
 
 if __name__ == "__main__":
@@ -23,20 +23,25 @@ async def main():
     await client.start()  # авторизация по телефону произойдёт автоматически
 
     entity = await resolve_chat(client, CHAT_ID)
-    members = []
-    async for u in client.iter_participants(entity, aggressive=True):
-        members.append({
-            "id": u.id,
-            "username": u.username,
-            "first_name": u.first_name,
-            "last_name": u.last_name,
-            "bot": bool(u.bot),
-            "is_self": getattr(u, "is_self", False)
-        })
     out = "tools/members.json"
+    count = 0
+    # пишем по мере получения: в памяти один участник, а не весь список;
+    # формат прежний — JSON-массив, по записи на строку
     with open(out, "w", encoding="utf-8") as f:
-        json.dump(members, f, ensure_ascii=False, indent=2)
-    print(f"Сохранено участников: {len(members)} -> {out}")
+        f.write("[")
+        async for u in client.iter_participants(entity, aggressive=True):
+            f.write(",\n" if count else "\n")
+            f.write(json.dumps({
+                "id": u.id,
+                "username": u.username,
+                "first_name": u.first_name,
+                "last_name": u.last_name,
+                "bot": bool(u.bot),
+                "is_self": getattr(u, "is_self", False)
+            }, ensure_ascii=False))
+            count += 1
+        f.write("\n]\n")
+    print(f"Сохранено участников: {count} -> {out}")
     await client.disconnect()
 
 if __name__ == "__main__":
@@ -4,7 +4,7 @@ import aiosqlite
 from datetime import datetime, timezone
 from aiogram import Bot
 from aiogram.client.session.aiohttp import AiohttpSession
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 
 # Берём из .env
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -14,44 +14,58 @@ GROUP_ID  = int(os.getenv("GROUP_ID", "0"))
 def now_ts() -> int:
     return int(datetime.now(timezone.utc).timestamp())
 
-async def kick(bot: Bot, uid: int) -> bool:
+KICK_CONCURRENCY = 20  # одновременных ban+unban
+KICK_ATTEMPTS = 3  # попыток на пользователя при flood control (RetryAfter)
+
+# «уже не в чате» — по тексту ошибки ban, без предварительного get_chat_member
+NOT_MEMBER_ERRORS = ("USER_NOT_PARTICIPANT", "PARTICIPANT_ID_INVALID")
+
+async def kick(bot: Bot, uid: int) -> str:
     """
     Пытаемся удалить пользователя из группы.
-    True  — кик сработал или его уже нет в чате,
-    False — кикнуть не удалось (нет прав/пользователь админ/владелец и т.п.)
+    "ok"    — кик сработал или его уже нет в чате,
+    "skip"  — кикнуть не удалось (нет прав/пользователь админ/владелец и т.п.),
+    "flood" — Telegram так и не пустил за KICK_ATTEMPTS попыток (flood control)
     """
-    try:
-        member = await bot.get_chat_member(GROUP_ID, uid)
-        status = getattr(member, "status", None)
-        if status in ("left", "kicked"):
-            return True  # уже не в чате — считаем успех
-        if status in ("administrator", "creator"):
-            return False  # админ/владелец — не трогаем
-        # мягкий кик: бан на минуту и тут же анбан, чтобы удалить
-        await bot.ban_chat_member(GROUP_ID, uid, until_date=now_ts() + 60)
-        await bot.unban_chat_member(GROUP_ID, uid)
-        return True
-    except TelegramBadRequest as e:
-        # Частые кейсы: "USER_NOT_PARTICIPANT", "can't remove chat owner" и т.п.
-        text = str(e)
-        if "USER_NOT_PARTICIPANT" in text:
-            return True
-        return False
-    except TelegramForbiddenError:
-        # Нет прав кикать
-        return False
-    except Exception:
-        return False
+    for _ in range(KICK_ATTEMPTS):
+        try:
+            # мягкий кик: бан на минуту и тут же анбан, чтобы удалить
+            await bot.ban_chat_member(GROUP_ID, uid, until_date=now_ts() + 60)
+            await bot.unban_chat_member(GROUP_ID, uid)
+            return "ok"
+        except TelegramRetryAfter as e:
+            # параллельные кики упираются в лимиты — ждём сколько сказал Telegram и повторяем
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest as e:
+            # Частые кейсы: "USER_NOT_PARTICIPANT", "user is an administrator", "can't remove chat owner"
+            text = str(e).upper()
+            return "ok" if any(code in text for code in NOT_MEMBER_ERRORS) else "skip"
+        except TelegramForbiddenError:
+            # Нет прав кикать
+            return "skip"
+        except Exception:
+            return "skip"
+    return "flood"
+
+async def kick_bounded(sem: asyncio.Semaphore, bot: Bot, uid: int, verbose: bool) -> str:
+    async with sem:
+        status = await kick(bot, uid)
+    if verbose:
+        print({
+            "ok": f"OK  кикнут/нет в чате: {uid}",
+            "skip": f"SKIP админ/нет прав/ошибка: {uid}",
+            "flood": f"FLOOD не успели из-за лимитов Telegram: {uid}",
+        }[status])
+    return status
 
 async def main(dry_run: bool = False, limit: int | None = None, verbose: bool = False):
     if not BOT_TOKEN or not GROUP_ID:
         raise SystemExit("Нет BOT_TOKEN или GROUP_ID в окружении (.env).")
 
-    session = AiohttpSession(proxy="socks5://127.0.0.1:1080")
-    bot = Bot(BOT_TOKEN, session=session)
     n_now = now_ts()
 
-    async with aiosqlite.connect("bot.db") as db:
+    # только чтение: shared-блокировка, писателю-боту не мешаем
+    async with aiosqlite.connect("file:bot.db?mode=ro", uri=True) as db:
         q = "SELECT user_id FROM users WHERE expires_at>0 AND expires_at < ?"
         params = [n_now]
         if limit:
@@ -63,21 +77,26 @@ async def main(dry_run: bool = False, limit: int | None = None, verbose: bool =
     expired = [r[0] for r in rows]
     print(f"Найдено просроченных: {len(expired)}")
 
-    kicked = 0
-    skipped = 0
-    for uid in expired:
-        if dry_run:
-            if verbose: print(f"[DRY] Проверка {uid}")
-            continue
-        ok = await kick(bot, uid)
-        if ok:
-            kicked += 1
-            if verbose: print(f"OK  кикнут/нет в чате: {uid}")
-        else:
-            skipped += 1
-            if verbose: print(f"SKIP админ/нет прав/ошибка: {uid}")
+    if dry_run:
+        if verbose:
+            for uid in expired:
+                print(f"[DRY] Проверка {uid}")
+        return
+
+    # одна сессия (keep-alive) на все запросы; параллельно, но не больше KICK_CONCURRENCY сразу
+    session = AiohttpSession(proxy="socks5://127.0.0.1:1080")
+    bot = Bot(BOT_TOKEN, session=session)
+    try:
+        sem = asyncio.Semaphore(KICK_CONCURRENCY)
+        results = await asyncio.gather(*(kick_bounded(sem, bot, uid, verbose) for uid in expired))
+    finally:
+        await bot.session.close()
 
-    print(f"Готово. Кикнуты: {kicked}, пропущены: {skipped}, всего просроченных: {len(expired)}")
+    kicked = results.count("ok")
+    skipped = results.count("skip")
+    flooded = results.count("flood")
+    print(f"Готово. Кикнуты: {kicked}, пропущены: {skipped}, упёрлись в flood control: {flooded}, "
+          f"всего просроченных: {len(expired)}")
 
 if __name__ == "__main__":
     import argparse
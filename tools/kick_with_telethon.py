@@ -13,26 +13,28 @@ async def main():
     client = TelegramClient("session", api_id, api_hash)
     await client.start()
 
-    conn = sqlite3.connect(db_path)
+    # только чтение: shared-блокировка, писателю-боту не мешаем
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.execute("PRAGMA busy_timeout=5000;")  # бот может писать в это время
     cur = conn.cursor()
-    cur.execute("SELECT user_id, expires_at FROM users")
-    users = cur.fetchall()
-
-    now = datetime.now().timestamp()
-    expired_users = [u for u in users if u[1] and u[1] < now]
+    # просроченных (0/NULL — не трогаем) отбирает SQLite по idx_users_expires
+    cur.execute(
+        "SELECT user_id FROM users WHERE expires_at > 0 AND expires_at < ?",
+        (datetime.now().timestamp(),)
+    )
+    expired_ids = {row[0] for row in cur.fetchall()}
+    conn.close()
 
-    print(f"Просроченных подписок: {len(expired_users)}")
+    print(f"Просроченных подписок: {len(expired_ids)}")
 
     async for member in client.iter_participants(group_id):
-        for user_id, expires_at in expired_users:
-            if member.id == user_id:
-                try:
-                    await client.kick_participant(group_id, user_id)
-                    print(f"❌ Кикнут: {user_id}")
-                except Exception as e:
-                    print(f"Ошибка кика {user_id}: {e}")
+        if member.id in expired_ids:
+            try:
+                await client.kick_participant(group_id, member.id)
+                print(f"❌ Кикнут: {member.id}")
+            except Exception as e:
+                print(f"Ошибка кика {member.id}: {e}")
 
     await client.disconnect()
-    conn.close()
 
 asyncio.run(main())
@@ -5,11 +5,18 @@ import asyncio
 import logging
 import os
 import base64
+import json
 from datetime import datetime, timezone, timedelta
-from typing import Optional
+from typing import Optional, Union
 
 import httpx
 
+try:
+    import h2  # noqa: F401  — ставится вместе с httpx[http2]
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 # Загружаем переменные окружения
 from dotenv import load_dotenv
 load_dotenv(os.path.join(os.path.dirname(__file__), '../../.env'))
@@ -38,6 +45,46 @@ def webapp_url(path: str = "") -> str:
     return f"{base_url}{clean_path}"
 
 
+# Клавиатуры уведомлений одинаковы для всех пользователей — собираем и сериализуем
+# в JSON один раз: Bot API принимает reply_markup строкой, на отправке остаётся только текст
+SLEEP_QUESTION_KB = json.dumps(
+    {
+        "inline_keyboard": [
+            [
+                {"text": "😴 1", "callback_data": "sleep:1"},
+                {"text": "😕 2", "callback_data": "sleep:2"},
+                {"text": "😐 3", "callback_data": "sleep:3"},
+                {"text": "🙂 4", "callback_data": "sleep:4"},
+                {"text": "😊 5", "callback_data": "sleep:5"},
+            ]
+        ]
+    }, ensure_ascii=False)
+EVENING_SUMMARY_KB = json.dumps(
+    {
+        "inline_keyboard": [
+            [
+                {"text": "📊 Посмотреть итог", "web_app": {"url": webapp_url("/summary")}}
+            ]
+        ]
+    }, ensure_ascii=False)
+WEEKLY_REVIEW_KB = json.dumps(
+    {
+        "inline_keyboard": [
+            [
+                {"text": "📈 Посмотреть обзор", "web_app": {"url": webapp_url("/weekly")}}
+            ]
+        ]
+    }, ensure_ascii=False)
+WEBAPP_BUTTON_KB = json.dumps(
+    {
+        "inline_keyboard": [
+            [
+                {"text": "✨ Открыть ассистент привычек", "web_app": {"url": webapp_url()}}
+            ]
+        ]
+    }, ensure_ascii=False)
+
+
 class BotIntegration:
     """
     Класс для интеграции habit tracker с основным Telegram ботом.
@@ -50,31 +97,42 @@ class BotIntegration:
     def __init__(self, db: HabitDB):
         self.db = db
         self.bot_api_url = f"https://api.telegram.org/bot{BOT_TOKEN}"
+        # Один клиент на все запросы: keep-alive соединения к api.telegram.org
+        # переиспользуются, TLS-рукопожатие не повторяется на каждое уведомление.
+        # С h2 всплеск уведомлений мультиплексируется в одном HTTP/2-соединении
+        self._client = httpx.AsyncClient(
+            timeout=10.0,
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=50),
+        )
+
+    async def aclose(self):
+        """Закрыть HTTP-клиент"""
+        await self._client.aclose()
 
     async def send_message(
         self,
         chat_id: int,
         text: str,
-        reply_markup: Optional[dict] = None,
+        reply_markup: Optional[Union[dict, str]] = None,
         parse_mode: str = "HTML"
     ) -> bool:
-        """Отправить сообщение пользователю"""
+        """Отправить сообщение пользователю (reply_markup — dict или готовый JSON)"""
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                payload = {
-                    "chat_id": chat_id,
-                    "text": text,
-                    "parse_mode": parse_mode,
-                }
-                if reply_markup:
-                    payload["reply_markup"] = reply_markup
-
-                response = await client.post(
-                    f"{self.bot_api_url}/sendMessage",
-                    json=payload
-                )
-                response.raise_for_status()
-                return True
+            payload = {
+                "chat_id": chat_id,
+                "text": text,
+                "parse_mode": parse_mode,
+            }
+            if reply_markup:
+                payload["reply_markup"] = reply_markup
+
+            response = await self._client.post(
+                f"{self.bot_api_url}/sendMessage",
+                json=payload
+            )
+            response.raise_for_status()
+            return True
         except Exception as e:
             log.error(f"Failed to send message to {chat_id}: {e}")
             return False
@@ -82,20 +140,20 @@ class BotIntegration:
     async def download_file(self, file_id: str) -> Optional[bytes]:
         """Скачать файл по file_id"""
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                # Получаем путь к файлу
-                response = await client.get(
-                    f"{self.bot_api_url}/getFile",
-                    params={"file_id": file_id}
-                )
-                response.raise_for_status()
-                file_path = response.json()["result"]["file_path"]
-
-                # Скачиваем файл
-                file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-                file_response = await client.get(file_url)
-                file_response.raise_for_status()
-                return file_response.content
+            # Получаем путь к файлу
+            response = await self._client.get(
+                f"{self.bot_api_url}/getFile",
+                params={"file_id": file_id},
+                timeout=30.0
+            )
+            response.raise_for_status()
+            file_path = response.json()["result"]["file_path"]
+
+            # Скачиваем файл
+            file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+            file_response = await self._client.get(file_url, timeout=30.0)
+            file_response.raise_for_status()
+            return file_response.content
         except Exception as e:
             log.error(f"Failed to download file {file_id}: {e}")
             return None
@@ -117,8 +175,8 @@ class BotIntegration:
         if not photo_bytes:
             return {"success": False, "error": "Не удалось загрузить фото"}
 
-        # Конвертируем в base64 для Vision API
-        photo_base64 = base64.b64encode(photo_bytes).decode('utf-8')
+        # Конвертируем в base64 для Vision API — в потоке, чтобы не держать event loop
+        photo_base64 = await asyncio.to_thread(lambda: base64.b64encode(photo_bytes).decode('ascii'))
 
         # Анализируем через LLM
         analysis = await analyze_food_photo(photo_base64, caption)
@@ -163,22 +221,10 @@ class BotIntegration:
 
     async def send_morning_sleep_question(self, user_id: int) -> bool:
         """Отправить утренний вопрос о сне с inline-кнопками"""
-        keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "😴 1", "callback_data": "sleep:1"},
-                    {"text": "😕 2", "callback_data": "sleep:2"},
-                    {"text": "😐 3", "callback_data": "sleep:3"},
-                    {"text": "🙂 4", "callback_data": "sleep:4"},
-                    {"text": "😊 5", "callback_data": "sleep:5"},
-                ]
-            ]
-        }
-
         return await self.send_message(
             user_id,
             "☀️ Доброе утро!\n\nКак ты сегодня спал(а)?",
-            reply_markup=keyboard
+            reply_markup=SLEEP_QUESTION_KB
         )
 
     async def handle_sleep_callback(self, user_id: int, score: int) -> bool:
@@ -200,46 +246,22 @@ class BotIntegration:
 
     async def send_evening_summary_notification(self, user_id: int) -> bool:
         """Отправить уведомление о готовности вечернего итога"""
-        keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "📊 Посмотреть итог", "web_app": {"url": webapp_url("/summary")}}
-                ]
-            ]
-        }
-
         return await self.send_message(
             user_id,
             "🌙 Твой вечерний итог готов!\n\nПосмотри, как прошёл день с точки зрения питания.",
-            reply_markup=keyboard
+            reply_markup=EVENING_SUMMARY_KB
         )
 
     async def send_weekly_review_notification(self, user_id: int) -> bool:
         """Отправить уведомление о недельном обзоре"""
-        keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "📈 Посмотреть обзор", "web_app": {"url": webapp_url("/weekly")}}
-                ]
-            ]
-        }
-
         return await self.send_message(
             user_id,
             "📊 Недельный обзор готов!\n\nПосмотри паттерны и связи за прошедшую неделю.",
-            reply_markup=keyboard
+            reply_markup=WEEKLY_REVIEW_KB
         )
 
     async def send_webapp_button(self, user_id: int) -> bool:
         """Отправить кнопку для открытия WebApp (после оплаты)"""
-        keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "✨ Открыть ассистент привычек", "web_app": {"url": webapp_url()}}
-                ]
-            ]
-        }
-
         return await self.send_message(
             user_id,
             "🎉 Теперь тебе доступен ассистент привычек!\n\n"
@@ -248,12 +270,14 @@ class BotIntegration:
             "• Трекер сна\n"
             "• Персональные итоги и обзоры\n\n"
             "Нажми кнопку ниже, чтобы начать:",
-            reply_markup=keyboard
+            reply_markup=WEBAPP_BUTTON_KB
         )
 
 
 # ============ Планировщик уведомлений ============
 
+NOTIFY_CONCURRENCY = 20  # одновременных отправок (глобальный лимит Telegram ~30 сообщений/с)
+
 class NotificationScheduler:
     """
     Планировщик уведомлений.
@@ -286,45 +310,52 @@ class NotificationScheduler:
         log.info("Notification scheduler stopped")
 
     async def _check_notifications(self):
-        """Проверить и отправить уведомления"""
-        now = datetime.now(MSK)
-        current_time = now.strftime('%H:%M')
-        current_weekday = now.weekday()  # 0 = понедельник, 6 = воскресенье
-
-        # Утренние вопросы о сне
-        morning_users = await self.db.get_users_for_notification('morning', current_time)
-        for user_id in morning_users:
-            # Проверяем, не отвечал ли уже сегодня
-            today = now.strftime('%Y-%m-%d')
-            existing = await self.db.get_sleep_entry(user_id, today)
-            if existing is None:
-                await self.bot.send_morning_sleep_question(user_id)
-                log.info(f"Sent morning sleep question to {user_id}")
-
-        # Вечерние итоги
-        evening_users = await self.db.get_users_for_notification('evening', current_time)
-        for user_id in evening_users:
-            # Проверяем, есть ли еда за сегодня
-            today = now.strftime('%Y-%m-%d')
-            food_entries = await self.db.get_food_entries_for_date(user_id, today)
-            if food_entries:
+        """
+        Проверить и отправить уведомления.
+        Кому пора (по локальному времени пользователя), отбирает SQLite — по одному
+        запросу на тип уведомления; в минуты без назначенных уведомлений они пустые.
+        Отправка идёт параллельно, но не больше NOTIFY_CONCURRENCY запросов сразу.
+        """
+        now_ts = int(datetime.now(timezone.utc).timestamp())
+        sem = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+        # Утренние вопросы о сне — только тем, кто ещё не отвечал сегодня
+        async def send_morning(user_data):
+            async with sem:
+                await self.bot.send_morning_sleep_question(user_data['user_id'])
+            log.info(f"Sent morning sleep question to {user_data['user_id']}")
+
+        # Вечерние итоги — только тем, у кого есть еда за сегодня
+        async def send_evening(user_data):
+            user_id = user_data['user_id']
+            async with sem:
                 # Генерируем итог если ещё не сгенерирован
-                existing_summary = await self.db.get_daily_summary(user_id, today)
-                if not existing_summary:
-                    profile = await self.db.get_user_profile(user_id)
-                    user_goal = profile.get('goal', 'maintain') if profile else 'maintain'
-                    summary = await generate_daily_summary(food_entries, user_goal)
-                    await self.db.save_daily_summary(user_id, today, summary)
-
+                if not user_data['has_summary']:
+                    summary = await generate_daily_summary(user_data['food_entries'], user_data['goal'])
+                    await self.db.save_daily_summary(user_id, user_data['date'], summary)
                 await self.bot.send_evening_summary_notification(user_id)
-                log.info(f"Sent evening summary notification to {user_id}")
-
-        # Недельные обзоры (воскресенье)
-        if current_weekday == 6 and current_time == "12:00":  # Воскресенье в 12:00
-            weekly_users = await self.db.get_users_for_weekly_review()
-            for user_id in weekly_users:
-                await self.bot.send_weekly_review_notification(user_id)
-                log.info(f"Sent weekly review notification to {user_id}")
+            log.info(f"Sent evening summary notification to {user_id}")
+
+        # Недельные обзоры (воскресенье в 12:00 по локальному времени)
+        async def send_weekly(user_data):
+            async with sem:
+                await self.bot.send_weekly_review_notification(user_data['user_id'])
+            log.info(f"Sent weekly review notification to {user_data['user_id']}")
+
+        morning, evening, weekly = await asyncio.gather(
+            self.db.get_morning_notification_batch(now_ts),
+            self.db.get_evening_notification_batch(now_ts),
+            self.db.get_weekly_review_batch(now_ts),
+        )
+        results = await asyncio.gather(
+            *(send_morning(u) for u in morning),
+            *(send_evening(u) for u in evening),
+            *(send_weekly(u) for u in weekly),
+            return_exceptions=True,
+        )
+        for r in results:
+            if isinstance(r, Exception):
+                log.error(f"Notification failed: {r}")
 
 
 # Singleton instances
@@ -345,6 +376,17 @@ async def init_bot_integration(db: HabitDB) -> BotIntegration:
     return _bot_integration
 
 
+async def close_bot_integration():
+    """Остановить планировщик и закрыть HTTP-клиент"""
+    global _bot_integration, _scheduler
+    if _scheduler:
+        _scheduler.stop()
+        _scheduler = None
+    if _bot_integration:
+        await _bot_integration.aclose()
+        _bot_integration = None
+
+
 def get_bot_integration() -> Optional[BotIntegration]:
     """Получить экземпляр BotIntegration"""
     return _bot_integration
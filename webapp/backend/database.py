@@ -2,12 +2,29 @@
 # Расширение схемы БД для habit tracker
 
 import aiosqlite
+from functools import lru_cache
 from datetime import datetime, timezone, timedelta
 from typing import Optional, List, Dict, Any
 import json
 import os
+import time
+
+try:
+    import orjson
+
+    def _json_dumps(obj: Any) -> str:
+        # NON_STR_KEYS — как json.dumps, допускаем int-ключи в сводках
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+    _json_loads = json.loads
 
 MSK = timezone(timedelta(hours=3))
+_MSK_OFFSET_SEC = 3 * 3600  # для time.gmtime: дата/время по МСК без tz-объектов
 DB_PATH = os.getenv("DB_PATH", "../../bot.db")
 
 # DDL для новых таблиц
@@ -172,18 +189,121 @@ DDL_INDEXES = [
     "CREATE INDEX IF NOT EXISTS idx_referral_rewards_user ON referral_rewards(user_id)",
     "CREATE INDEX IF NOT EXISTS idx_achievements_user ON user_achievements(user_id)",
     "CREATE INDEX IF NOT EXISTS idx_admin_events_open ON admin_events(resolved, created_at)",
+    # частичные покрывающие индексы под тики уведомлений: сканируем только включивших трекер
+    "CREATE INDEX IF NOT EXISTS idx_profiles_morning ON user_profiles(morning_question_time, timezone_offset) "
+    "WHERE sleep_tracker_enabled = 1",
+    "CREATE INDEX IF NOT EXISTS idx_profiles_evening ON user_profiles(user_id, evening_summary_time, timezone_offset, goal) "
+    "WHERE food_tracker_enabled = 1",
 ]
 
+# Кэш в процессе: подписку и профиль спрашивают почти на каждый запрос и тик,
+# а меняются они редко. Кэшируем только найденное — поэтому свежая оплата/онбординг
+# из другого процесса (бот) видны сразу. А вот отзыв/возврат/кик, сделанные ботом,
+# webapp не видит, пока запись не истечёт, — отсюда короткий TTL подписки (как _CACHE_TTL в app.py)
+_SUB_CACHE_TTL = 5.0  # сек
+_PROFILE_CACHE_TTL = 60.0  # сек
+_CACHE_MAX = 4096
+
+# Колонки профиля перечислены явно: без SELECT * и разбора cur.description на каждый вызов
+_PROFILE_COLS = (
+    'user_id', 'goal', 'training_type', 'activity_level', 'gender',
+    'food_tracker_enabled', 'sleep_tracker_enabled', 'weekly_review_enabled',
+    'evening_summary_time', 'morning_question_time', 'timezone_offset',
+    'onboarding_completed', 'created_at', 'updated_at',
+)
+_SQL_GET_PROFILE = f"SELECT {', '.join(_PROFILE_COLS)} FROM user_profiles WHERE user_id = ?"
+
+# SQL планировщика уведомлений собирается один раз при импорте: на каждом тике
+# уходит одна и та же строка, и sqlite3 берёт готовый statement из своего кэша.
+# Локальные дата/время пользователя считаются прямо в SQLite:
+# unixepoch + смещение в минутах (NULL/0 -> MSK)
+_LOCAL_SHIFT = "printf('%+d minutes', COALESCE(NULLIF(up.timezone_offset, 0), 180))"
+_WEEKLY_SHIFT = "printf('%+d minutes', COALESCE(up.timezone_offset, 180))"
+
+_SQL_MORNING_BATCH = f"""
+    WITH due AS (
+        SELECT up.user_id, up.morning_question_time AS notification_time,
+               date(?, 'unixepoch', {_LOCAL_SHIFT}) AS local_date,
+               strftime('%H:%M', ?, 'unixepoch', {_LOCAL_SHIFT}) AS local_time
+        FROM user_profiles up
+        JOIN users u ON up.user_id = u.user_id
+        WHERE up.sleep_tracker_enabled = 1
+        AND u.expires_at > ?
+    )
+    SELECT due.user_id, due.local_time
+    FROM due
+    LEFT JOIN sleep_entries s
+        ON s.user_id = due.user_id AND s.entry_date = due.local_date
+    WHERE due.local_time = due.notification_time
+    AND s.id IS NULL
+    """
+
+_SQL_EVENING_BATCH = f"""
+    WITH due AS (
+        SELECT up.user_id, up.goal, up.evening_summary_time AS notification_time,
+               date(?, 'unixepoch', {_LOCAL_SHIFT}) AS local_date,
+               strftime('%H:%M', ?, 'unixepoch', {_LOCAL_SHIFT}) AS local_time
+        FROM user_profiles up
+        JOIN users u ON up.user_id = u.user_id
+        WHERE up.food_tracker_enabled = 1
+        AND u.expires_at > ?
+    )
+    SELECT f.id, f.entry_time, f.description, f.photo_file_id, f.categories,
+           f.raw_input, f.source, f.hunger_before, f.fullness_after, f.ate_without_gadgets,
+           due.user_id, due.goal, due.local_date, due.local_time,
+           EXISTS(
+               SELECT 1 FROM daily_summaries ds
+               WHERE ds.user_id = due.user_id AND ds.summary_date = due.local_date
+           )
+    FROM due
+    JOIN food_entries f
+        ON f.user_id = due.user_id AND f.entry_date = due.local_date
+    WHERE due.local_time = due.notification_time
+    ORDER BY due.user_id, f.entry_time ASC
+    """
+
+_SQL_WEEKLY_BATCH = f"""
+    SELECT up.user_id, strftime('%H:%M', ?, 'unixepoch', {_WEEKLY_SHIFT}) AS local_time
+    FROM user_profiles up
+    JOIN users u ON up.user_id = u.user_id
+    WHERE up.weekly_review_enabled = 1
+    AND u.expires_at > ?
+    AND strftime('%w', ?, 'unixepoch', {_WEEKLY_SHIFT}) = '0'
+    AND local_time = '12:00'
+    """
+
+
+@lru_cache(maxsize=64)
+def _upsert_profile_sql(fields: tuple) -> str:
+    """UPSERT профиля под конкретный набор полей — строка строится один раз на набор"""
+    columns = fields + ('user_id', 'created_at', 'updated_at')
+    updates = [f"{key} = excluded.{key}" for key in fields] + ["updated_at = excluded.updated_at"]
+    return (
+        f"INSERT INTO user_profiles ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))}) "
+        f"ON CONFLICT(user_id) DO UPDATE SET {', '.join(updates)}"
+    )
+
 
 class HabitDB:
     def __init__(self, db_path: str = None):
         self.db_path = db_path or DB_PATH
         self.conn: Optional[aiosqlite.Connection] = None
+        self._sub_cache: Dict[int, tuple] = {}
+        self._profile_cache: Dict[int, tuple] = {}
 
     async def connect(self):
         self.conn = await aiosqlite.connect(self.db_path)
         await self.conn.execute("PRAGMA journal_mode=WAL;")
+        # в WAL NORMAL не делает fsync на каждый commit — как у основного DB в app.py.
+        # При отключении питания можно потерять последние транзакции, но не целостность БД
+        await self.conn.execute("PRAGMA synchronous=NORMAL;")
         await self.conn.execute("PRAGMA foreign_keys=ON;")
+        await self.conn.execute("PRAGMA temp_store=MEMORY;")
+        await self.conn.execute("PRAGMA cache_size=-20000;")  # ~20 МБ
+        await self.conn.execute("PRAGMA mmap_size=268435456;")  # 256 МБ
+        await self.conn.execute("PRAGMA wal_autocheckpoint=1000;")
+        # бот и webapp пишут в один bot.db — ждём блокировку, а не падаем с "database is locked"
+        await self.conn.execute("PRAGMA busy_timeout=5000;")
         await self.conn.commit()
 
     async def init_schema(self):
@@ -248,58 +368,80 @@ class HabitDB:
         if self.conn:
             await self.conn.close()
 
+    @staticmethod
+    def _cache_get(cache: dict, user_id: int):
+        hit = cache.get(user_id)
+        if hit is not None and hit[0] > time.monotonic():
+            return hit[1]
+        return None
+
+    @staticmethod
+    def _cache_put(cache: dict, user_id: int, value, ttl: float):
+        if len(cache) >= _CACHE_MAX:
+            now = time.monotonic()
+            for k in [k for k, (exp, _) in cache.items() if exp <= now]:
+                del cache[k]
+            if len(cache) >= _CACHE_MAX:
+                cache.clear()
+        cache[user_id] = (time.monotonic() + ttl, value)
+
+    def _evict(self, *user_ids: int):
+        for user_id in user_ids:
+            self._sub_cache.pop(user_id, None)
+            self._profile_cache.pop(user_id, None)
+
     # ============ User Profiles (Onboarding) ============
 
     async def get_user_profile(self, user_id: int) -> Optional[Dict[str, Any]]:
-        cur = await self.conn.execute(
-            "SELECT * FROM user_profiles WHERE user_id = ?", (user_id,)
-        )
+        cached = self._cache_get(self._profile_cache, user_id)
+        if cached is not None:
+            return dict(cached)  # копия: вызывающий может менять словарь
+        cur = await self.conn.execute(_SQL_GET_PROFILE, (user_id,))
         row = await cur.fetchone()
         if not row:
             return None
-        columns = [d[0] for d in cur.description]
-        return dict(zip(columns, row))
+        profile = dict(zip(_PROFILE_COLS, row))
+        self._cache_put(self._profile_cache, user_id, profile, _PROFILE_CACHE_TTL)
+        return dict(profile)
 
     async def upsert_user_profile(self, user_id: int, data: Dict[str, Any]):
-        now_ts = int(datetime.now(MSK).timestamp())
-        existing = await self.get_user_profile(user_id)
-
-        if existing:
-            # Update
-            fields = []
-            values = []
-            for key, value in data.items():
-                if key != 'user_id':
-                    fields.append(f"{key} = ?")
-                    values.append(value)
-            fields.append("updated_at = ?")
-            values.append(now_ts)
-            values.append(user_id)
-
-            sql = f"UPDATE user_profiles SET {', '.join(fields)} WHERE user_id = ?"
-            await self.conn.execute(sql, values)
-        else:
-            # Insert
-            data['user_id'] = user_id
-            data['created_at'] = now_ts
-            data['updated_at'] = now_ts
-
-            columns = ', '.join(data.keys())
-            placeholders = ', '.join(['?'] * len(data))
-            sql = f"INSERT INTO user_profiles ({columns}) VALUES ({placeholders})"
-            await self.conn.execute(sql, list(data.values()))
-
+        """Создать или обновить профиль одним UPSERT; created_at при обновлении не трогаем"""
+        now_ts = int(time.time())
+        fields = tuple(key for key in data if key != 'user_id')
+        await self.conn.execute(
+            _upsert_profile_sql(fields), [data[key] for key in fields] + [user_id, now_ts, now_ts]
+        )
         await self.conn.commit()
+        self._evict(user_id)
 
     async def is_subscription_active(self, user_id: int) -> bool:
         """Проверяем подписку в основной таблице users"""
+        now_ts = int(time.time())
+        cached = self._cache_get(self._sub_cache, user_id)
+        if cached is not None and cached > now_ts:
+            return True
         cur = await self.conn.execute(
             "SELECT expires_at FROM users WHERE user_id = ?", (user_id,)
         )
         row = await cur.fetchone()
-        if not row or not row[0]:
+        if not row or not row[0] or row[0] <= now_ts:
             return False
-        return row[0] > int(datetime.now(MSK).timestamp())
+        self._cache_put(self._sub_cache, user_id, row[0], _SUB_CACHE_TTL)
+        return True
+
+    async def can_track_food(self, user_id: int) -> bool:
+        """Включён food tracker и активна подписка — одним запросом"""
+        cur = await self.conn.execute(
+            """
+            SELECT 1 FROM user_profiles up
+            JOIN users u ON up.user_id = u.user_id
+            WHERE up.user_id = ?
+            AND up.food_tracker_enabled
+            AND u.expires_at > ?
+            """,
+            (user_id, int(time.time()))
+        )
+        return await cur.fetchone() is not None
 
     # ============ Food Entries ============
 
@@ -316,10 +458,10 @@ class HabitDB:
         fullness_after: Optional[int] = None,  # 1-5
         ate_without_gadgets: bool = False  # ел без гаджетов
     ) -> int:
-        now = datetime.now(MSK)
-        now_ts = int(now.timestamp())
-        entry_date = now.strftime('%Y-%m-%d')
-        entry_time = custom_time if custom_time else now.strftime('%H:%M')
+        now_ts = int(time.time())
+        tm = time.gmtime(now_ts + _MSK_OFFSET_SEC)
+        entry_date = time.strftime('%Y-%m-%d', tm)
+        entry_time = custom_time if custom_time else time.strftime('%H:%M', tm)
 
         cur = await self.conn.execute(
             """
@@ -333,7 +475,7 @@ class HabitDB:
                 entry_time,
                 description,
                 photo_file_id,
-                json.dumps(categories) if categories else None,
+                _json_dumps(categories) if categories else None,
                 raw_input,
                 source,
                 hunger_before,
@@ -383,31 +525,24 @@ class HabitDB:
     async def get_food_entries_for_date(
         self, user_id: int, date: str
     ) -> List[Dict[str, Any]]:
-        cur = await self.conn.execute(
-            """
-            SELECT id, entry_time, description, photo_file_id, categories, raw_input, source, hunger_before, fullness_after, ate_without_gadgets
-            FROM food_entries
-            WHERE user_id = ? AND entry_date = ?
-            ORDER BY entry_time ASC
-            """,
-            (user_id, date)
-        )
-        rows = await cur.fetchall()
-        result = []
-        for row in rows:
-            result.append({
-                'id': row[0],
-                'time': row[1],
-                'description': row[2],
-                'photo_file_id': row[3],
-                'categories': json.loads(row[4]) if row[4] else None,
-                'raw_input': row[5],
-                'source': row[6],
-                'hunger_before': row[7],
-                'fullness_after': row[8],
-                'ate_without_gadgets': bool(row[9])
-            })
-        return result
+        # тот же SQL, что у недели/месяца — один statement в кэше sqlite3 на все представления
+        by_date = await self.get_food_entries_for_range(user_id, date, date)
+        return by_date.get(date, [])
+
+    @staticmethod
+    def _food_entry(row) -> Dict[str, Any]:
+        return {
+            'id': row[0],
+            'time': row[1],
+            'description': row[2],
+            'photo_file_id': row[3],
+            'categories': _json_loads(row[4]) if row[4] else None,
+            'raw_input': row[5],
+            'source': row[6],
+            'hunger_before': row[7],
+            'fullness_after': row[8],
+            'ate_without_gadgets': bool(row[9])
+        }
 
     async def get_food_entries_for_week(
         self, user_id: int, week_start: str
@@ -418,9 +553,26 @@ class HabitDB:
         start = dt.strptime(week_start, '%Y-%m-%d')
         dates = [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(7)]
 
-        result = {}
-        for date in dates:
-            result[date] = await self.get_food_entries_for_date(user_id, date)
+        by_date = await self.get_food_entries_for_range(user_id, dates[0], dates[-1])
+        return {date: by_date.get(date, []) for date in dates}
+
+    async def get_food_entries_for_range(
+        self, user_id: int, date_from: str, date_to: str
+    ) -> Dict[str, List[Dict]]:
+        """Еда за период [date_from, date_to] одним запросом: {дата: записи}, дни без еды не попадают"""
+        cur = await self.conn.execute(
+            """
+            SELECT id, entry_time, description, photo_file_id, categories, raw_input, source, hunger_before, fullness_after, ate_without_gadgets,
+                   entry_date
+            FROM food_entries
+            WHERE user_id = ? AND entry_date BETWEEN ? AND ?
+            ORDER BY entry_date ASC, entry_time ASC
+            """,
+            (user_id, date_from, date_to)
+        )
+        result: Dict[str, List[Dict]] = {}
+        for row in await cur.fetchall():
+            result.setdefault(row[10], []).append(self._food_entry(row))
         return result
 
     async def update_food_entry_description(
@@ -452,9 +604,8 @@ class HabitDB:
     # ============ Sleep Entries ============
 
     async def add_sleep_entry(self, user_id: int, score: int, date: Optional[str] = None) -> bool:
-        now = datetime.now(MSK)
-        now_ts = int(now.timestamp())
-        entry_date = date or now.strftime('%Y-%m-%d')
+        now_ts = int(time.time())
+        entry_date = date or time.strftime('%Y-%m-%d', time.gmtime(now_ts + _MSK_OFFSET_SEC))
 
         try:
             await self.conn.execute(
@@ -492,10 +643,12 @@ class HabitDB:
         start = dt.strptime(week_start, '%Y-%m-%d')
         dates = [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(7)]
 
-        result = {}
-        for date in dates:
-            result[date] = await self.get_sleep_entry(user_id, date)
-        return result
+        cur = await self.conn.execute(
+            "SELECT entry_date, score FROM sleep_entries WHERE user_id = ? AND entry_date BETWEEN ? AND ?",
+            (user_id, dates[0], dates[-1])
+        )
+        scores = dict(await cur.fetchall())
+        return {date: scores.get(date) for date in dates}
 
     # ============ Workout Entries ============
 
@@ -508,9 +661,8 @@ class HabitDB:
         date: Optional[str] = None
     ) -> int:
         """Добавить тренировку"""
-        now = datetime.now(MSK)
-        now_ts = int(now.timestamp())
-        entry_date = date or now.strftime('%Y-%m-%d')
+        now_ts = int(time.time())
+        entry_date = date or time.strftime('%Y-%m-%d', time.gmtime(now_ts + _MSK_OFFSET_SEC))
 
         cur = await self.conn.execute(
             """
@@ -564,9 +716,24 @@ class HabitDB:
         start = dt.strptime(week_start, '%Y-%m-%d')
         dates = [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(7)]
 
-        result = {}
-        for date in dates:
-            result[date] = await self.get_workout_entries_for_date(user_id, date)
+        # одна выборка по диапазону (idx_workout_user_date) вместо запроса на каждый день
+        cur = await self.conn.execute(
+            """
+            SELECT id, workout_name, duration_minutes, intensity, entry_date
+            FROM workout_entries
+            WHERE user_id = ? AND entry_date BETWEEN ? AND ?
+            ORDER BY entry_date ASC, created_at ASC
+            """,
+            (user_id, dates[0], dates[-1])
+        )
+        result: Dict[str, List[Dict]] = {date: [] for date in dates}
+        for row in await cur.fetchall():
+            result[row[4]].append({
+                'id': row[0],
+                'workout_name': row[1],
+                'duration_minutes': row[2],
+                'intensity': row[3]
+            })
         return result
 
     # ============ Daily Summaries ============
@@ -574,7 +741,7 @@ class HabitDB:
     async def save_daily_summary(
         self, user_id: int, date: str, content: Dict[str, Any]
     ):
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         await self.conn.execute(
             """
             INSERT INTO daily_summaries (user_id, summary_date, content, sent_at)
@@ -583,7 +750,7 @@ class HabitDB:
                 content = excluded.content,
                 sent_at = excluded.sent_at
             """,
-            (user_id, date, json.dumps(content, ensure_ascii=False), now_ts)
+            (user_id, date, _json_dumps(content), now_ts)
         )
         await self.conn.commit()
 
@@ -595,14 +762,14 @@ class HabitDB:
             (user_id, date)
         )
         row = await cur.fetchone()
-        return json.loads(row[0]) if row else None
+        return _json_loads(row[0]) if row else None
 
     # ============ Weekly Summaries ============
 
     async def save_weekly_summary(
         self, user_id: int, week_start: str, content: Dict[str, Any]
     ):
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         await self.conn.execute(
             """
             INSERT INTO weekly_summaries (user_id, week_start, content, sent_at)
@@ -611,7 +778,7 @@ class HabitDB:
                 content = excluded.content,
                 sent_at = excluded.sent_at
             """,
-            (user_id, week_start, json.dumps(content, ensure_ascii=False), now_ts)
+            (user_id, week_start, _json_dumps(content), now_ts)
         )
         await self.conn.commit()
 
@@ -623,51 +790,10 @@ class HabitDB:
             (user_id, week_start)
         )
         row = await cur.fetchone()
-        return json.loads(row[0]) if row else None
+        return _json_loads(row[0]) if row else None
 
     # ============ Helpers ============
 
-    async def get_users_for_notification(
-        self, notification_type: str
-    ) -> List[Dict[str, Any]]:
-        """
-        Получить пользователей для отправки уведомлений с их настройками времени и часового пояса
-        notification_type: 'morning' | 'evening'
-        Возвращает список dict с полями: user_id, notification_time, timezone_offset
-        """
-        if notification_type == 'morning':
-            cur = await self.conn.execute(
-                """
-                SELECT up.user_id, up.morning_question_time, up.timezone_offset
-                FROM user_profiles up
-                JOIN users u ON up.user_id = u.user_id
-                WHERE up.sleep_tracker_enabled = 1
-                AND u.expires_at > ?
-                """,
-                (int(datetime.now(timezone.utc).timestamp()),)
-            )
-        else:  # evening
-            cur = await self.conn.execute(
-                """
-                SELECT up.user_id, up.evening_summary_time, up.timezone_offset
-                FROM user_profiles up
-                JOIN users u ON up.user_id = u.user_id
-                WHERE up.food_tracker_enabled = 1
-                AND u.expires_at > ?
-                """,
-                (int(datetime.now(timezone.utc).timestamp()),)
-            )
-
-        rows = await cur.fetchall()
-        return [
-            {
-                'user_id': row[0],
-                'notification_time': row[1],
-                'timezone_offset': row[2] or 180  # Default to MSK if null
-            }
-            for row in rows
-        ]
-
     async def get_users_for_weekly_review(self) -> List[int]:
         """Получить пользователей с включённым недельным обзором и активной подпиской"""
         cur = await self.conn.execute(
@@ -677,11 +803,66 @@ class HabitDB:
             WHERE up.weekly_review_enabled = 1
             AND u.expires_at > ?
             """,
-            (int(datetime.now(MSK).timestamp()),)
+            (int(time.time()),)
         )
         rows = await cur.fetchall()
         return [row[0] for row in rows]
 
+    async def get_morning_notification_batch(
+        self, now_ts: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Пользователи, которым прямо сейчас (по их локальному времени) пора задать
+        утренний вопрос о сне и у которых ещё нет оценки сна за сегодня.
+        Один запрос на тик вместо запроса на каждого пользователя.
+        """
+        now_ts = now_ts or int(time.time())
+        cur = await self.conn.execute(
+            _SQL_MORNING_BATCH,
+            (now_ts, now_ts, now_ts)
+        )
+        rows = await cur.fetchall()
+        return [{'user_id': row[0], 'local_time': row[1]} for row in rows]
+
+    async def get_evening_notification_batch(
+        self, now_ts: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Пользователи, которым прямо сейчас пора отправить вечерний итог и у которых
+        есть записи о еде за сегодня. Вместе с ними приходят цель, записи о еде
+        и флаг has_summary — чтобы сгенерировать итог без дополнительных запросов.
+        """
+        now_ts = now_ts or int(time.time())
+        cur = await self.conn.execute(
+            _SQL_EVENING_BATCH,
+            (now_ts, now_ts, now_ts)
+        )
+        rows = await cur.fetchall()
+        batch: Dict[int, Dict[str, Any]] = {}
+        for row in rows:
+            item = batch.get(row[10])
+            if item is None:
+                item = batch[row[10]] = {
+                    'user_id': row[10],
+                    'goal': row[11],
+                    'date': row[12],
+                    'local_time': row[13],
+                    'has_summary': bool(row[14]),
+                    'food_entries': [],
+                }
+            item['food_entries'].append(self._food_entry(row))
+        return list(batch.values())
+
+    async def get_weekly_review_batch(self, now_ts: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Пользователи, у которых сейчас воскресенье 12:00 по локальному времени"""
+        now_ts = now_ts or int(time.time())
+        cur = await self.conn.execute(
+            _SQL_WEEKLY_BATCH,
+            (now_ts, now_ts, now_ts)
+        )
+        rows = await cur.fetchall()
+        return [{'user_id': row[0], 'local_time': row[1]} for row in rows]
+
 
     async def get_user_phone(self, user_id: int) -> Optional[str]:
         """Получить телефон пользователя"""
@@ -693,7 +874,7 @@ class HabitDB:
 
     async def activate_subscription(self, user_id: int, paid_days: int, grace_days: int):
         """Активировать подписку для пользователя"""
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         desired_expires = now_ts + (paid_days + grace_days) * 86400
 
         # Берём текущий expires_at чтобы не уменьшить
@@ -710,11 +891,12 @@ class HabitDB:
             (new_expires, user_id)
         )
         await self.conn.commit()
+        self._evict(user_id)
         return new_expires
 
     async def save_payment(self, user_id: int, payment_id: str, amount: int, status: str):
         """Сохранить платёж в таблицу payments"""
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         await self.conn.execute(
             """INSERT OR REPLACE INTO payments (user_id, payment_id, amount, status, created_at)
                VALUES (?, ?, ?, ?, ?)""",
@@ -758,13 +940,13 @@ class HabitDB:
                 auto_renewal_failures=0
             WHERE user_id=?
             """,
-            (payment_method_id, int(datetime.now(MSK).timestamp()), user_id)
+            (payment_method_id, int(time.time()), user_id)
         )
         await self.conn.commit()
 
     async def set_auto_renewal(self, user_id: int, enabled: bool, agreed_at: int = None):
         if enabled:
-            agreed_at = agreed_at or int(datetime.now(MSK).timestamp())
+            agreed_at = agreed_at or int(time.time())
             await self.conn.execute(
                 "UPDATE users SET auto_renewal=1, auto_renewal_agreed_at=?, auto_renewal_failures=0 WHERE user_id=?",
                 (agreed_at, user_id)
@@ -814,7 +996,7 @@ class HabitDB:
     async def save_cancellation(self, user_id: int, reason: str):
         await self.conn.execute(
             "INSERT INTO cancellations(user_id, reason, created_at) VALUES (?, ?, ?)",
-            (user_id, reason, int(datetime.now(MSK).timestamp()))
+            (user_id, reason, int(time.time()))
         )
         await self.conn.commit()
 
@@ -840,8 +1022,19 @@ class HabitDB:
         row = await cur.fetchone()
         return row[0] if row else None
 
+    async def find_used_referral_codes(self, codes: List[str]) -> set:
+        """Какие из кодов уже заняты (без учёта регистра) — одним запросом"""
+        if not codes:
+            return set()
+        cur = await self.conn.execute(
+            f"SELECT UPPER(referral_code) FROM users WHERE UPPER(referral_code) IN ({','.join('?' * len(codes))})",
+            [c.upper() for c in codes]
+        )
+        rows = await cur.fetchall()
+        return {row[0] for row in rows}
+
     async def create_referral(self, referrer_id: int, referred_id: int):
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         try:
             await self.conn.execute(
                 "INSERT OR IGNORE INTO referrals (referrer_id, referred_id, created_at) VALUES (?,?,?)",
@@ -871,7 +1064,7 @@ class HabitDB:
         if not row:
             return None
         referrer_id = row[0]
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         await self.conn.execute(
             "UPDATE referrals SET referred_paid=1, reward_granted=1 WHERE referred_id=?",
             (referred_id,)
@@ -965,7 +1158,7 @@ class HabitDB:
 
     async def unlock_achievement(self, user_id: int, achievement_id: str) -> bool:
         """Returns True if newly unlocked, False if already had it."""
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         try:
             await self.conn.execute(
                 "INSERT INTO user_achievements (user_id, achievement_id, unlocked_at) VALUES (?,?,?)",
@@ -979,7 +1172,7 @@ class HabitDB:
     async def check_achievements(self, user_id: int) -> List[str]:
         """Check and unlock any new achievements. Returns list of newly unlocked IDs."""
         existing = set(await self.get_user_achievements(user_id))
-        newly_unlocked = []
+        to_unlock = []
 
         # first_food: at least 1 food entry
         if 'first_food' not in existing:
@@ -987,17 +1180,14 @@ class HabitDB:
                 "SELECT COUNT(*) FROM food_entries WHERE user_id=?", (user_id,)
             )
             if (await cur.fetchone())[0] > 0:
-                if await self.unlock_achievement(user_id, 'first_food'):
-                    newly_unlocked.append('first_food')
+                to_unlock.append('first_food')
 
         # streak_7, streak_30
         streak = await self.get_food_streak(user_id)
         if 'streak_7' not in existing and streak['current'] >= 7:
-            if await self.unlock_achievement(user_id, 'streak_7'):
-                newly_unlocked.append('streak_7')
+            to_unlock.append('streak_7')
         if 'streak_30' not in existing and streak['current'] >= 30:
-            if await self.unlock_achievement(user_id, 'streak_30'):
-                newly_unlocked.append('streak_30')
+            to_unlock.append('streak_30')
 
         # sleep_7: 7 consecutive days of sleep logging
         if 'sleep_7' not in existing:
@@ -1018,8 +1208,7 @@ class HabitDB:
                     elif d < check:
                         break
                 if sleep_streak >= 7:
-                    if await self.unlock_achievement(user_id, 'sleep_7'):
-                        newly_unlocked.append('sleep_7')
+                    to_unlock.append('sleep_7')
 
         # workouts_10, workouts_30
         cur = await self.conn.execute(
@@ -1027,11 +1216,9 @@ class HabitDB:
         )
         workout_count = (await cur.fetchone())[0]
         if 'workouts_10' not in existing and workout_count >= 10:
-            if await self.unlock_achievement(user_id, 'workouts_10'):
-                newly_unlocked.append('workouts_10')
+            to_unlock.append('workouts_10')
         if 'workouts_30' not in existing and workout_count >= 30:
-            if await self.unlock_achievement(user_id, 'workouts_30'):
-                newly_unlocked.append('workouts_30')
+            to_unlock.append('workouts_30')
 
         # mindful_10: 10 meals without gadgets
         if 'mindful_10' not in existing:
@@ -1039,8 +1226,7 @@ class HabitDB:
                 "SELECT COUNT(*) FROM food_entries WHERE user_id=? AND ate_without_gadgets=1", (user_id,)
             )
             if (await cur.fetchone())[0] >= 10:
-                if await self.unlock_achievement(user_id, 'mindful_10'):
-                    newly_unlocked.append('mindful_10')
+                to_unlock.append('mindful_10')
 
         # weekly_first: viewed at least one weekly summary
         if 'weekly_first' not in existing:
@@ -1048,9 +1234,22 @@ class HabitDB:
                 "SELECT COUNT(*) FROM weekly_summaries WHERE user_id=?", (user_id,)
             )
             if (await cur.fetchone())[0] > 0:
-                if await self.unlock_achievement(user_id, 'weekly_first'):
-                    newly_unlocked.append('weekly_first')
+                to_unlock.append('weekly_first')
 
+        # все разблокировки — одним commit; OR IGNORE — если параллельный запрос успел раньше
+        newly_unlocked = []
+        now_ts = int(time.time())
+        for achievement_id in to_unlock:
+            cur = await self.conn.execute(
+                "INSERT OR IGNORE INTO user_achievements (user_id, achievement_id, unlocked_at) VALUES (?,?,?)",
+                (user_id, achievement_id, now_ts)
+            )
+            if cur.rowcount:
+                newly_unlocked.append(achievement_id)
+        if to_unlock:
+            # даже если все INSERT проигнорированы, неявная транзакция открыта и держит
+            # блокировку записи в общем bot.db — закрываем её всегда
+            await self.conn.commit()
         return newly_unlocked
 
     # ============ Admin Analytics ============
@@ -1060,14 +1259,14 @@ class HabitDB:
         return (await cur.fetchone())[0]
 
     async def count_active_users(self) -> int:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         cur = await self.conn.execute(
             "SELECT COUNT(*) FROM users WHERE expires_at > ?", (now_ts,)
         )
         return (await cur.fetchone())[0]
 
     async def count_new_users(self, days: int) -> int:
-        cutoff = int(datetime.now(MSK).timestamp()) - days * 86400
+        cutoff = int(time.time()) - days * 86400
         cur = await self.conn.execute(
             "SELECT COUNT(*) FROM payments WHERE created_at > ? AND status='succeeded'",
             (cutoff,)
@@ -1075,7 +1274,7 @@ class HabitDB:
         return (await cur.fetchone())[0]
 
     async def sum_revenue(self, days: int) -> int:
-        cutoff = int(datetime.now(MSK).timestamp()) - days * 86400
+        cutoff = int(time.time()) - days * 86400
         cur = await self.conn.execute(
             "SELECT COALESCE(SUM(amount), 0) FROM payments WHERE created_at > ? AND status='succeeded'",
             (cutoff,)
@@ -1125,7 +1324,7 @@ class HabitDB:
         user_id: int = None,
         payment_id: str = None,
     ) -> int:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         cur = await self.conn.execute(
             """
             INSERT INTO admin_events (event_type, severity, user_id, payment_id, message, created_at)
@@ -1137,7 +1336,7 @@ class HabitDB:
         return cur.lastrowid
 
     async def get_admin_operations_summary(self) -> Dict[str, Any]:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         today = datetime.now(MSK).replace(hour=0, minute=0, second=0, microsecond=0)
         today_ts = int(today.timestamp())
         pending_cutoff = now_ts - 15 * 60
@@ -1296,7 +1495,7 @@ class HabitDB:
         return "no_access"
 
     async def get_admin_console_summary(self) -> Dict[str, int]:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         soon_ts = now_ts + 3 * 86400
         pending_cutoff = now_ts - 15 * 60
 
@@ -1353,7 +1552,7 @@ class HabitDB:
         limit: int = 50,
         offset: int = 0,
     ) -> Dict[str, Any]:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         soon_ts = now_ts + 3 * 86400
         where = []
         params: list[Any] = []
@@ -1473,7 +1672,7 @@ class HabitDB:
         return {"items": users, "total": total, "limit": limit, "offset": offset}
 
     async def get_admin_user_detail(self, user_id: int) -> Optional[Dict[str, Any]]:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         cur = await self.conn.execute(
             """
             SELECT
@@ -1665,7 +1864,7 @@ class HabitDB:
                     "created_at": r[4],
                     "username": r[5],
                     "full_name": r[6],
-                    "user_status": self._admin_user_status(r[7] or 0, int(datetime.now(MSK).timestamp())),
+                    "user_status": self._admin_user_status(r[7] or 0, int(time.time())),
                 }
                 for r in rows
             ],
@@ -1738,7 +1937,7 @@ class HabitDB:
         return cur.rowcount > 0
 
     async def admin_extend_subscription(self, user_id: int, days: int, admin_id: int) -> int:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         cur = await self.conn.execute(
             "SELECT COALESCE(expires_at, 0) FROM users WHERE user_id = ?",
             (user_id,)
@@ -1765,10 +1964,11 @@ class HabitDB:
             user_id
         )
         await self.conn.commit()
+        self._evict(user_id)
         return new_expires
 
     async def admin_revoke_subscription(self, user_id: int, admin_id: int, reason: str = "admin_revoke_web") -> int:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         await self.conn.execute(
             """
             UPDATE users
@@ -1785,11 +1985,12 @@ class HabitDB:
             user_id
         )
         await self.conn.commit()
+        self._evict(user_id)
         return now_ts - 1
 
     async def get_daily_new_users(self, days: int) -> List[Dict]:
         """Daily count of first-time paying users."""
-        cutoff = int(datetime.now(MSK).timestamp()) - days * 86400
+        cutoff = int(time.time()) - days * 86400
         cur = await self.conn.execute(
             """
             SELECT date(created_at, 'unixepoch', '+3 hours') as d, COUNT(DISTINCT user_id)
@@ -1801,7 +2002,7 @@ class HabitDB:
         return [{"date": row[0], "count": row[1]} for row in await cur.fetchall()]
 
     async def get_daily_revenue(self, days: int) -> List[Dict]:
-        cutoff = int(datetime.now(MSK).timestamp()) - days * 86400
+        cutoff = int(time.time()) - days * 86400
         cur = await self.conn.execute(
             """
             SELECT date(created_at, 'unixepoch', '+3 hours') as d, COALESCE(SUM(amount), 0)
@@ -1813,7 +2014,7 @@ class HabitDB:
         return [{"date": row[0], "amount": row[1]} for row in await cur.fetchall()]
 
     async def get_feature_usage_stats(self) -> Dict:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         cur = await self.conn.execute(
             """
             SELECT
@@ -1836,7 +2037,7 @@ class HabitDB:
         }
 
     async def get_avg_food_entries_per_day(self) -> float:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         cur = await self.conn.execute(
             """
             SELECT CAST(COUNT(*) AS FLOAT) / MAX(1, COUNT(DISTINCT entry_date))
@@ -1871,7 +2072,7 @@ class HabitDB:
         return [r[0] for r in await cur.fetchall()]
 
     async def get_expired_user_ids(self) -> List[int]:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         cur = await self.conn.execute(
             "SELECT user_id FROM users WHERE expires_at IS NULL OR expires_at = 0 OR expires_at <= ?",
             (now_ts,)
@@ -1879,7 +2080,7 @@ class HabitDB:
         return [r[0] for r in await cur.fetchall()]
 
     async def get_active_user_ids(self) -> List[int]:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         cur = await self.conn.execute(
             "SELECT user_id FROM users WHERE expires_at > ?", (now_ts,)
         )
@@ -1887,7 +2088,7 @@ class HabitDB:
 
     async def log_broadcast(self, admin_id: int, segment: str, message_text: str,
                              sent: int, failed: int, blocked: int):
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         await self.conn.execute(
             """INSERT INTO broadcast_log (admin_id, segment, message_text, sent_count, failed_count, blocked_count, created_at)
                VALUES (?, ?, ?, ?, ?, ?, ?)""",
@@ -1897,7 +2098,7 @@ class HabitDB:
 
 
     async def save_feedback(self, user_id: int, username: str, full_name: str, message: str) -> int:
-        now_ts = int(datetime.now(MSK).timestamp())
+        now_ts = int(time.time())
         cur = await self.conn.execute(
             "INSERT INTO feedback (user_id, username, full_name, message, created_at) VALUES (?, ?, ?, ?, ?)",
             (user_id, username, full_name, message, now_ts)
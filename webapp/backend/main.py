@@ -33,7 +33,7 @@ MSK = timezone(timedelta(hours=3))
 GROUP_ID = os.getenv("GROUP_ID", "")
 INVITE_TTL_HOURS = int(os.getenv("INVITE_TTL_HOURS", "24"))
 ADMIN_IDS_ENV = os.getenv("ADMIN_IDS", "")
-ADMIN_IDS_SET = {int(x) for x in ADMIN_IDS_ENV.replace(",", " ").split() if x.strip().isdigit()}
+ADMIN_IDS_SET = frozenset(int(x) for x in ADMIN_IDS_ENV.replace(",", " ").split() if x.strip().isdigit())
 
 # YooKassa configuration
 YOOKASSA_SHOP_ID = os.getenv("SHOP_ID", "")
@@ -244,7 +244,7 @@ async def get_admin_user(
             raise HTTPException(status_code=401, detail="Invalid Telegram init data")
 
     user_id = user_data.get("user_id")
-    if not ADMIN_IDS_SET or user_id not in ADMIN_IDS_SET:
+    if user_id not in ADMIN_IDS_SET:
         raise HTTPException(status_code=403, detail="Access denied")
     return user_data
 
@@ -663,18 +663,17 @@ async def get_food_calendar(
     else:
         end_date = datetime(year, month + 1, 1, tzinfo=MSK) - timedelta(days=1)
 
-    # Получаем все записи за месяц
-    days_data = {}
-    current = start_date
-    while current <= end_date:
-        date_str = current.strftime('%Y-%m-%d')
-        entries = await db.get_food_entries_for_date(user['user_id'], date_str)
-        if entries:
-            days_data[date_str] = {
-                'count': len(entries),
-                'entries': entries
-            }
-        current += timedelta(days=1)
+    # Получаем все записи за месяц одним запросом
+    by_date = await db.get_food_entries_for_range(
+        user['user_id'], start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+    )
+    days_data = {
+        date_str: {
+            'count': len(entries),
+            'entries': entries
+        }
+        for date_str, entries in by_date.items()
+    }
 
     return {
         'year': year,
@@ -1295,11 +1294,10 @@ async def get_referral_info(user: Dict = Depends(get_current_user)):
     # Генерируем код если нет
     code = await db.get_referral_code(user_id)
     if not code:
-        for _ in range(10):
-            code = _generate_ref_code()
-            existing = await db.find_user_by_referral_code(code)
-            if not existing:
-                break
+        # все кандидаты проверяются одним запросом
+        candidates = [_generate_ref_code() for _ in range(10)]
+        used = await db.find_used_referral_codes(candidates)
+        code = next((c for c in candidates if c.upper() not in used), candidates[-1])
         await db.set_referral_code(user_id, code)
 
     stats = await db.get_referral_stats(user_id)